@@ -1,47 +1,33 @@
   -- This query is used to calculate the CLV and Churn probability Segment when new predictions are made. It is used both for weekly calculations where calculations are calculated all all customers we can make predictions for.
   -- Steps in query:
-  -- Step 1: Calculate quantiles on the CLV of all customers with predictions
-  -- Step 2: Canculate 25%, 50% and 75% percentiles
-  -- Step 3: Set new customer Segments
+  -- Step 1: Get all customers with predictions
+  -- Step 2: Set new customer Segments
+  -- The 25%, 50% and 75% percentiles of the CLV are computed while the predictions are made and passed as the
+  -- query parameters @p25, @p50 and @p75, so the table is written in a single pass
+  -- When no customers were sketched update_query computes clv_percentiles with APPROX_QUANTILES over the table instead
+  -- update_query in main.py fills in a predicted_value_next_<n>_month column for each prediction horizon
   --Save to table with clv and churn predictions
 CREATE OR REPLACE TABLE `your-project.customer_predictions.clv_and_churn_predictions`
 CLUSTER BY userId AS
 WITH
-  -- Step 1: Calculate quantiles on the CLV of all customers with predictions
+  -- Step 1: Get all customers with predictions
   all_customers_with_clv_predictions AS (
   SELECT
     userId,
     clv,
     churn_probability,
-    predicted_value_next_6_month,
+    $predicted_value_columns
     current_total_revenue
   FROM
     `your-project.ml_models_production.new_predictions`),
-  approx_quantiles_data AS (
-  SELECT
-    APPROX_QUANTILES(clv, 100) percentiles
-  FROM
-    all_customers_with_clv_predictions ),
-  -- Step 2: Canculate 25%, 50% and 75% percentiles
   clv_percentiles AS (
-  SELECT
-    percentiles[
-  OFFSET
-    (25)] AS p25,
-    percentiles[
-  OFFSET
-    (50)] AS p50,
-    percentiles[
-  OFFSET
-    (75)] AS p75
-  FROM
-    approx_quantiles_data )
-  -- Step 3: Set new customer Segments
+  $clv_percentiles)
+  -- Step 2: Set new customer Segments
 SELECT
   userId,
   clv,
   churn_probability,
-  predicted_value_next_6_month,
+  $predicted_value_columns
   current_total_revenue,
   (CASE
       WHEN clv < p25 THEN "Lowest 25% Customers"
@@ -65,4 +51,4 @@ SELECT
 FROM
   all_customers_with_clv_predictions
 CROSS JOIN
-  clv_percentiles clv_percentiles
+  clv_percentiles
@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import json
+import numpy as np
+import pandas as pd
+from scipy.special import expit, exprel, gammaln, hyp2f1
+
+# Length of a period in days, matching np.timedelta64(1, freq) used by lifetimes
+PERIOD_LENGTH_IN_DAYS = {'D': 1.0, 'W': 7.0, 'M': 30.436875}
+# Gauss-Legendre nodes and weights used on each half of the Pareto/NBD integral
+PARETO_NBD_QUADRATURE = np.polynomial.legendre.leggauss(24)
+# The Pareto/NBD integral is taken where its integrand is within e^-40 of the peak
+PARETO_NBD_LOG_RANGE = 40.0
+PARETO_NBD_NEWTON_STEPS = 12
+
+
+def summary_data_from_transaction_data(transactions, frequency='M',
+                                       observation_period_end=None):
+    """Build the RFM summary table without importing lifetimes.
+    Gives the same frequency, recency, T and monetary_value as
+    lifetimes.utils.summary_data_from_transaction_data for the userId,
+    order_date and order_value columns.
+    Args:
+        transactions:           Transactions with userId, order_date, order_value
+        frequency:              The frequency used to calculate your summary table (D, W, M)
+        observation_period_end: Last date of the observation period, defaults to the last order
+    Returns:
+        Dataframe indexed on userId with frequency, recency, T and monetary_value
+    """
+    periods = pd.to_datetime(transactions['order_date']).dt.to_period(frequency).dt.to_timestamp()
+    if observation_period_end is None:
+        observation_period_end = periods.max()
+    else:
+        observation_period_end = pd.Timestamp(observation_period_end).to_period(frequency).to_timestamp()
+
+    in_period = periods <= observation_period_end
+    period_values = pd.DataFrame({'userId': transactions['userId'][in_period],
+                                  'period': periods[in_period],
+                                  'order_value': transactions['order_value'][in_period]}) \
+        .groupby(['userId', 'period'], sort=False)['order_value'].sum().reset_index()
+    period_values = period_values.sort_values(['userId', 'period'])
+    customers = period_values.groupby('userId').agg(first=('period', 'min'),
+                                                    last=('period', 'max'),
+                                                    count=('period', 'count'),
+                                                    total_value=('order_value', 'sum'),
+                                                    first_value=('order_value', 'first'))
+
+    period_length = pd.Timedelta(days=PERIOD_LENGTH_IN_DAYS[frequency])
+    summary = pd.DataFrame(index=customers.index)
+    summary['frequency'] = customers['count'] - 1
+    summary['recency'] = (customers['last'] - customers['first']) / period_length
+    summary['T'] = (observation_period_end - customers['first']) / period_length
+    # the first purchase is not part of the monetary value
+    summary['monetary_value'] = ((customers['total_value'] - customers['first_value'])
+                                 / summary['frequency'].where(summary['frequency'] > 0)).fillna(0)
+    return summary.astype(float)
+
+
+class BetaGeoModel(object):
+    """Scoring-only BG/NBD model with the prediction methods of lifetimes.BetaGeoFitter.
+    Parameters may be scalars or arrays that broadcast against the customers.
+    """
+
+    def __init__(self, params):
+        self.params_ = params
+
+    def conditional_expected_number_of_purchases_up_to_time(self, t, frequency, recency, T):
+        """Expected number of repeat purchases up to time t, equation (10) of Fader, Hardie and Lee (2005a)."""
+        r, alpha, a, b = [self.params_[name] for name in ('r', 'alpha', 'a', 'b')]
+        x = np.asarray(frequency, dtype=float)
+        recency = np.asarray(recency, dtype=float)
+        T = np.asarray(T, dtype=float)
+
+        _a = r + x
+        _b = b + x
+        _c = a + b + x - 1
+        _z = t / (alpha + T + t)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ln_hyp_term = np.log(hyp2f1(_a, _b, _c, _z))
+            # if the value is inf, use a different but equivalent formula
+            ln_hyp_term_alt = np.log(hyp2f1(_c - _a, _c - _b, _c, _z)) + (_c - _a - _b) * np.log(1 - _z)
+        ln_hyp_term = np.where(np.isinf(ln_hyp_term), ln_hyp_term_alt, ln_hyp_term)
+        first_term = (a + b + x - 1) / (a - 1)
+        second_term = 1 - np.exp(ln_hyp_term + (r + x) * np.log((alpha + T) / (alpha + t + T)))
+
+        numerator = first_term * second_term
+        denominator = 1 + (x > 0) * (a / (b + x - 1)) * ((alpha + T) / (alpha + recency)) ** (r + x)
+        return numerator / denominator
+
+    def conditional_probability_alive(self, frequency, recency, T):
+        """Probability that a customer with history (frequency, recency, T) is alive."""
+        r, alpha, a, b = [self.params_[name] for name in ('r', 'alpha', 'a', 'b')]
+        x = np.asarray(frequency, dtype=float)
+        recency = np.asarray(recency, dtype=float)
+        T = np.asarray(T, dtype=float)
+
+        log_div = (r + x) * np.log((alpha + T) / (alpha + recency)) \
+            + np.log(a / (b + np.maximum(x, 1) - 1))
+        return np.where(x == 0, 1.0, expit(-log_div))
+
+    def log_likelihood(self, frequency, recency, T):
+        """Log-likelihood of each customer's history, section 7 of Fader, Hardie and Lee (2005a)."""
+        r, alpha, a, b = [self.params_[name] for name in ('r', 'alpha', 'a', 'b')]
+        x = np.asarray(frequency, dtype=float)
+        recency = np.asarray(recency, dtype=float)
+        T = np.asarray(T, dtype=float)
+
+        A_1 = gammaln(r + x) - gammaln(r) + r * np.log(alpha)
+        A_2 = gammaln(a + b) + gammaln(b + x) - gammaln(b) - gammaln(a + b + x)
+        A_3 = -(r + x) * np.log(alpha + T)
+        A_4 = np.log(a) - np.log(b + np.maximum(x, 1) - 1) - (r + x) * np.log(recency + alpha)
+        return A_1 + A_2 + np.logaddexp(A_3, np.where(x > 0, A_4, -np.inf))
+
+
+def pareto_nbd_log_integral(r, alpha, s, beta, x, recency, T, gradient=False):
+    """Log of the integral over the time of death in the Pareto/NBD likelihood.
+    The integral of (alpha + tau)^-(r + x) (beta + tau)^-(s + 1) from recency
+    to T is the A_0 of equation (19) of
+    http://brucehardie.com/notes/009/pareto_nbd_derivations_2005-11-05.pdf
+    divided by r + s + x. It is evaluated by Gauss-Legendre quadrature in
+    log(min(alpha, beta) + tau), where the log of the integrand is concave,
+    on the range around its peak that holds all but exp(-PARETO_NBD_LOG_RANGE)
+    of it. Unlike the hypergeometric function this stays finite for any
+    number of purchases.
+    Args:
+        r, alpha, s, beta:  Parameters, scalars or arrays that broadcast against the customers
+        x, recency, T:      Frequency, recency and T of the customers
+        gradient:           Also return the derivatives of the log with respect to r, alpha, s and beta
+    Returns:
+        Array with the log of the integral, -inf when recency equals T, and
+        with gradient a list with the four derivatives
+    """
+    (r, alpha, s, beta, x, recency, T) = np.broadcast_arrays(r, alpha, s, beta, x, recency, T)
+    # With kappa the smaller of alpha and beta, the log of the integrand in
+    # l = log(kappa + tau) is p * l - q * log(|alpha - beta| + e^l)
+    alpha_is_larger = alpha >= beta
+    kappa = np.minimum(alpha, beta)
+    with np.errstate(divide='ignore'):
+        log_c = np.log(np.abs(alpha - beta))
+    p = np.where(alpha_is_larger, -s, 1 - r - x)
+    q = np.where(alpha_is_larger, r + x, s + 1)
+
+    def log_integrand(l):
+        return p * l - q * np.logaddexp(log_c, l)
+
+    def log_integrand_slope(l):
+        return p - q * np.exp(l - np.logaddexp(log_c, l))
+
+    start = np.log(kappa + recency)
+    end = np.log(kappa + T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stationary = log_c + np.log(p) - np.log(q - p)
+    interior = (p > 0) & (p < q) & (stationary > start) & (stationary < end)
+    peak_at = np.where(interior, stationary,
+                       np.where(log_integrand(start) >= log_integrand(end), start, end))
+    peak = log_integrand(peak_at)
+    cutoff = peak - PARETO_NBD_LOG_RANGE
+
+    # Newton steps from the ends move inwards to the cutoff without passing it
+    bounds = []
+    for bound in [start, end]:
+        for _ in range(PARETO_NBD_NEWTON_STEPS):
+            value = log_integrand(bound)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bound = bound + np.where(value < cutoff, (cutoff - value) / log_integrand_slope(bound), 0)
+        bounds.append(bound)
+    # Split at the peak, or at the bend of the integrand when the peak is at an end
+    split = np.where(interior, peak_at, np.clip(log_c, bounds[0], bounds[1]))
+
+    (nodes, weights) = PARETO_NBD_QUADRATURE
+    integral = np.zeros(peak.shape)
+    derivatives = [np.zeros(peak.shape) for _ in range(4)]
+    for (lower, upper) in [(bounds[0], split), (split, bounds[1])]:
+        half_width = (upper - lower) / 2
+        for (node, weight) in zip(nodes, weights):
+            l = lower + half_width * (1 + node)
+            value = half_width * weight * np.exp(log_integrand(l) - peak)
+            integral += value
+            if gradient:
+                log_alpha_tau = np.where(alpha_is_larger, np.logaddexp(log_c, l), l)
+                log_beta_tau = np.where(alpha_is_larger, l, np.logaddexp(log_c, l))
+                derivatives[0] -= value * log_alpha_tau
+                derivatives[1] -= value * (r + x) * np.exp(-log_alpha_tau)
+                derivatives[2] -= value * log_beta_tau
+                derivatives[3] -= value * (s + 1) * np.exp(-log_beta_tau)
+    with np.errstate(divide='ignore'):
+        log_integral = peak + np.log(integral)
+    if not gradient:
+        return log_integral
+    nonzero = integral > 0
+    return (log_integral,
+            [np.where(nonzero, derivative / np.where(nonzero, integral, 1), 0)
+             for derivative in derivatives])
+
+
+class ParetoNBDModel(object):
+    """Scoring-only Pareto/NBD model with the prediction methods of lifetimes.ParetoNBDFitter.
+    Everything is computed in log space from pareto_nbd_log_integral, so
+    customers with many purchases get a probability and expected purchases
+    where the hypergeometric function of lifetimes gives NaN.
+    Parameters may be scalars or arrays that broadcast against the customers.
+    """
+
+    def __init__(self, params):
+        self.params_ = params
+        self._last_log_integral = (None, None)
+
+    def _log_integral(self, x, recency, T):
+        """pareto_nbd_log_integral of the customers, kept for the last customers asked
+        for, as predictions call it again for every month of the horizon."""
+        r, alpha, s, beta = [self.params_[name] for name in ('r', 'alpha', 's', 'beta')]
+        key = tuple(hash(np.asarray(values, dtype=float).tobytes()) for values in (r, alpha, s, beta, x, recency, T)) \
+            + (np.shape(x), np.shape(r))
+        if self._last_log_integral[0] != key:
+            self._last_log_integral = (key, pareto_nbd_log_integral(r, alpha, s, beta, x, recency, T))
+        return self._last_log_integral[1]
+
+    def _log_odds_dead(self, x, recency, T):
+        """Log of the odds that the customer died before T rather than being alive at T."""
+        r, alpha, s, beta = [self.params_[name] for name in ('r', 'alpha', 's', 'beta')]
+        return np.log(s) + self._log_integral(x, recency, T) \
+            + (r + x) * np.log(alpha + T) + s * np.log(beta + T)
+
+    def log_likelihood(self, frequency, recency, T):
+        """Log-likelihood of each customer's history, equation (18) of
+        http://brucehardie.com/notes/009/pareto_nbd_derivations_2005-11-05.pdf"""
+        r, alpha, s, beta = [self.params_[name] for name in ('r', 'alpha', 's', 'beta')]
+        x = np.asarray(frequency, dtype=float)
+        recency = np.asarray(recency, dtype=float)
+        T = np.asarray(T, dtype=float)
+
+        A_1 = gammaln(r + x) - gammaln(r) + r * np.log(alpha) + s * np.log(beta)
+        A_2 = -(r + x) * np.log(alpha + T) - s * np.log(beta + T)
+        return A_1 + A_2 + np.logaddexp(0, self._log_odds_dead(x, recency, T))
+
+    def conditional_expected_number_of_purchases_up_to_time(self, t, frequency, recency, T):
+        """Expected number of repeat purchases up to time t, equation (22) of
+        http://brucehardie.com/notes/009/pareto_nbd_derivations_2005-11-05.pdf"""
+        r, alpha, s, beta = [self.params_[name] for name in ('r', 'alpha', 's', 'beta')]
+        x = np.asarray(frequency, dtype=float)
+        recency = np.asarray(recency, dtype=float)
+        T = np.asarray(T, dtype=float)
+
+        log_p_alive = -np.logaddexp(0, self._log_odds_dead(x, recency, T))
+        # (1 - ((beta + T) / (beta + T + t))^(s - 1)) / (s - 1), also at s = 1
+        log_growth = np.log1p(t / (beta + T))
+        log_lifetime = np.log(log_growth) + np.log(exprel(-(s - 1) * log_growth))
+        return np.exp(log_p_alive + np.log(r + x) + np.log(beta + T) - np.log(alpha + T) + log_lifetime)
+
+    def conditional_probability_alive(self, frequency, recency, T):
+        """Probability that a customer with history (frequency, recency, T) is alive."""
+        x = np.asarray(frequency, dtype=float)
+        recency = np.asarray(recency, dtype=float)
+        T = np.asarray(T, dtype=float)
+        return expit(-self._log_odds_dead(x, recency, T))
+
+
+class GammaGammaModel(object):
+    """Scoring-only Gamma-Gamma model with the prediction methods of lifetimes.GammaGammaFitter."""
+
+    def __init__(self, params):
+        self.params_ = params
+
+    def conditional_expected_average_profit(self, frequency, monetary_value):
+        """Expected average profit per transaction, a weighted average of the
+        customer's own monetary value and the population mean."""
+        p, q, v = [self.params_[name] for name in ('p', 'q', 'v')]
+        individual_weight = p * frequency / (p * frequency + q - 1)
+        population_mean = v * p / (q - 1)
+        return (1 - individual_weight) * population_mean + individual_weight * monetary_value
+
+    def log_likelihood(self, frequency, monetary_value):
+        """Log-likelihood of each customer's average order value, equation (1a) of
+        http://www.brucehardie.com/notes/025/"""
+        p, q, v = [self.params_[name] for name in ('p', 'q', 'v')]
+        x = np.asarray(frequency, dtype=float)
+        m = np.asarray(monetary_value, dtype=float)
+        return gammaln(p * x + q) - gammaln(p * x) - gammaln(q) + q * np.log(v) \
+            + (p * x - 1) * np.log(m) + (p * x) * np.log(x) - (p * x + q) * np.log(x * m + v)
+
+
+MODELS = {'BGNBD': BetaGeoModel,
+          'PARETO': ParetoNBDModel,
+          'GGF': GammaGammaModel}
+
+
+def scoring_model(model):
+    """Model to predict with, a lifetimes Pareto/NBD fitter is replaced by a
+    ParetoNBDModel with its parameters, other models are returned as they are.
+    Compares the class name, so lifetimes does not have to be imported.
+    """
+    if type(model).__name__ == 'ParetoNBDFitter':
+        return ParetoNBDModel({name: float(value) for name, value in model.params_.items()})
+    return model
+
+
+def load_model_params(file_path):
+    """Load a model saved as parameters by the weekly training function.
+    Args:
+        file_path: path+filename of a JSON file with model_type and params
+    Returns:
+        BetaGeoModel, ParetoNBDModel or GammaGammaModel
+    """
+    with open(file_path, 'r') as params_file:
+        model_params = json.load(params_file)
+    return MODELS[model_params['model_type']](model_params['params'])
@@ -3,6 +3,8 @@ config_vars = {
     'PENALIZER_COEF': 0.03,
     'DISCOUNT_RATE': 0.01,
     'PREDICTION_LENGTH_IN_MONTHS': 6,
+    # A predicted_value_next_<n>_month column is written for each horizon and filled in in the update SQL
+    'PREDICTION_HORIZONS_IN_MONTHS': [1, 3, 6, 12],
     'MODEL_TYPE':'BGNBD',
     'FREQUENZY':'M',
     'GCS_BUCKET_MODELS': 'your_company_trained_ml_models_production',
@@ -10,5 +12,64 @@ config_vars = {
     'LOCAL_STORAGE_FOLDER': '/tmp/',
     'TRAINING_DATA_QUERY': 'CLV-dataset-weekly-training-and-prediction.sql',
     'ACTUAL_CUSTOMER_VALUE_QUERY': 'CLV-dataset-weekly-training-and-prediction-customer-summary.sql',
-    'UPDATE_BIGQUERY_RESULT_TABLE': 'CLV-weekly-update-result-bigquery-table.sql'
+    'UPDATE_BIGQUERY_RESULT_TABLE': 'CLV-weekly-update-result-bigquery-table.sql',
+    # Scoring cache reused across runs while the model parameters are unchanged, customers are scored on their RFM
+    # values rounded to the decimals, within a relative 1e-4 of the exact scores at 4 decimals. T grows by a week
+    # between runs, so only reruns on the same data hit it. Off by default, set file, e.g. 'clv_scoring_cache.pkl'
+    'SCORING_CACHE_FILE': None,
+    'SCORING_CACHE_MAX_ENTRIES': 2000000,
+    'SCORING_CACHE_DECIMALS': 4,
+    # Out of core transform for large transaction tables. Set budget in MB to enable, None keeps all data in memory.
+    # The actual values, the BigQuery pages and the summaries of all customers count against the budget
+    'OUT_OF_CORE_MEMORY_BUDGET_MB': None,
+    'OUT_OF_CORE_SPILL_FOLDER': '/tmp/clv_spill/',
+    # Grid evaluated by tune.py on a calibration/holdout split of the training data
+    'TUNING_MODEL_TYPES': ['BGNBD', 'PARETO'],
+    'TUNING_FREQUENCIES': ['D', 'W', 'M'],
+    'TUNING_PENALIZER_COEFS': [0.0, 0.001, 0.01, 0.03, 0.1],
+    'TUNING_HOLDOUT_MONTHS': 6,
+    # clv and churn intervals over parameter samples, written to their own table. Set samples to 0 to disable
+    'UNCERTAINTY_SAMPLES': 0,
+    'UNCERTAINTY_METHOD': 'HESSIAN',
+    'UNCERTAINTY_PERCENTILES': [10, 90],
+    'UNCERTAINTY_MEMORY_BUDGET_MB': 256,
+    'UNCERTAINTY_WORKERS': None,
+    'UNCERTAINTY_TABLE_ID': 'ml_models_production.clv_and_churn_prediction_intervals',
+    # Transfers to GCS, several files at a time. Files up to 8 MB go in one request, larger ones in resumable chunks
+    # of this size. Transient errors are retried for up to TRANSFER_RETRY_SECONDS
+    'TRANSFER_CHUNK_SIZE_MB': 8,
+    'TRANSFER_WORKERS': 4,
+    'TRANSFER_RETRY_SECONDS': 120,
+    # Compression of the predictions CSV while it is uploaded, BigQuery only loads gzip, not zstd
+    'TRANSFER_COMPRESSION': 'gzip',
+    # Folder used as a local stand-in for the buckets, None uses Google Cloud Storage
+    'GCS_LOCAL_ROOT': None,
+    # Score and upload the predictions as Parquet this many customers at a time, None writes one CSV after scoring everyone
+    'STREAM_EXPORT_CHUNK_SIZE': 100000,
+    # Only fit the models again when the customer base drifted from the data they were fit on. Set file to None to fit every run
+    'DRIFT_BASELINE_FILE': 'clv_drift_baseline.json',
+    'DRIFT_PSI_THRESHOLD': 0.1,
+    'DRIFT_LOG_LIKELIHOOD_THRESHOLD': 0.05,
+    'DRIFT_MAX_MODEL_AGE_DAYS': 28,
+    'DRIFT_HISTOGRAM_BINS': 10,
+    # Data-quality and throughput report of each run, saved next to the models and compared with the previous run.
+    # Set file to None to disable
+    'RUN_REPORT_FILE': 'clv_run_report_weekly.json',
+    'RUN_REPORT_CHANGE_THRESHOLD': 0.5,
+    # Run once per Pub/Sub event and one run at a time, with leases and run records under this prefix in the models
+    # bucket. The daily function runs in parallel and waits to publish. Set prefix to None to run on every event
+    'RUN_COORDINATOR_PREFIX': 'clv_runs/',
+    # Seconds after which the lease of a run that was killed can be taken over, keep it above the function timeout
+    'RUN_LEASE_SECONDS': 900,
+    'RUN_PUBLISH_WAIT_SECONDS': 300,
+    # Schedule window of the function as a pandas period, UTC. Once a run of a window completed, other events of the same
+    # window are skipped. None only skips redelivered events
+    'RUN_WINDOW': 'W',
+    # Events published longer ago than this are dropped, Pub/Sub retries a failing event for up to 7 days. None runs
+    # every event
+    'RUN_MAX_EVENT_AGE_SECONDS': 172800,
+    # Sketch of the clv of the customer base in the models bucket, the thresholds of the clv segments are read from it.
+    # The weekly function builds it, the daily function adds the customers it scores. A larger k is more accurate
+    'SEGMENT_SKETCH_FILE': 'clv_segment_sketch.json',
+    'SEGMENT_SKETCH_K': 1000
     }
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+from datetime import datetime
+import json
+import logging
+import time
+import numpy as np
+import btyd_scoring
+
+# Set variables
+logger = logging.getLogger(__name__)
+SUMMARY_COLUMNS = ['frequency', 'recency', 'T', 'monetary_value']
+# Floor for empty histogram bins, so the stability index stays finite
+MIN_PROPORTION = 1e-4
+# A log-likelihood drop also has to exceed this many standard errors, so sampling noise does not trigger a refit
+LOG_LIKELIHOOD_STANDARD_ERRORS = 3
+
+
+def histogram_edges(values, bins=10):
+    """Inner bin edges at the quantiles of values, repeated quantiles are merged."""
+    return np.unique(np.quantile(np.asarray(values, dtype=float),
+                                 np.linspace(0, 1, bins + 1)[1:-1])).tolist()
+
+
+def histogram(values, edges):
+    """Share of values in each bin, the outer bins are open ended."""
+    counts = np.bincount(np.searchsorted(edges, np.asarray(values, dtype=float), side='right'),
+                         minlength=len(edges) + 1)
+    return (counts / max(1, counts.sum())).tolist()
+
+
+def population_stability_index(expected, actual):
+    """Population stability index between two histograms over the same bins.
+    Below 0.1 is usually read as no change and above 0.25 as a large shift.
+    """
+    expected = np.maximum(np.asarray(expected, dtype=float), MIN_PROPORTION)
+    actual = np.maximum(np.asarray(actual, dtype=float), MIN_PROPORTION)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def log_likelihood_stats(summary, model_type, fitter_params, ggf_params):
+    """Mean and standard deviation of the log-likelihood per customer of the models on a summary.
+    The gamma-gamma model only describes customers with repeat purchases.
+    Args:
+        summary:        RFM transaction data
+        model_type:     model type (PARETO, BGNBD)
+        fitter_params:  dict with the fitted parameters of the fitter
+        ggf_params:     dict with the fitted parameters of the gamma-gamma model
+    Returns:
+        Dict with {'mean', 'std', 'customers'} for the fitter and ggf
+    """
+    fitter = btyd_scoring.MODELS[model_type](fitter_params)
+    ggf = btyd_scoring.GammaGammaModel(ggf_params)
+    returning = summary[summary['frequency'] > 0]
+    log_likelihoods = {
+        'fitter': fitter.log_likelihood(summary['frequency'], summary['recency'], summary['T']),
+        'ggf': ggf.log_likelihood(returning['frequency'], returning['monetary_value'])}
+    return {model: {'mean': float(np.mean(values)),
+                    'std': float(np.std(values)),
+                    'customers': int(len(values))}
+            for model, values in log_likelihoods.items()}
+
+
+def log_likelihood_drop(expected, actual):
+    """Drop in mean log-likelihood and its standard error between two log_likelihood_stats entries."""
+    standard_error = np.sqrt(expected['std'] ** 2 / max(1, expected['customers'])
+                             + actual['std'] ** 2 / max(1, actual['customers']))
+    return (expected['mean'] - actual['mean'], float(standard_error))
+
+
+def build_baseline(summary,
+                   fitter,
+                   ggf,
+                   model_type,
+                   frequency,
+                   penalizer_coef,
+                   fitter_model_name,
+                   ggf_model_name,
+                   fit_seconds,
+                   bins=10):
+    """Describe the data a model was fit on, for later drift checks.
+    Args:
+        summary:            RFM transaction data the models were fit on
+        fitter:             lifetimes fitter, already fit to summary
+        ggf:                lifetimes gamma/gamma fitter, already fit to summary
+        model_type:         model type (PARETO, BGNBD)
+        frequency:          The frequency used to calculate the summary table
+        penalizer_coef:     Penalizer used in fitter and ggf models
+        fitter_model_name:  Name of the saved fitter in GCS
+        ggf_model_name:     Name of the saved gamma-gamma model in GCS
+        fit_seconds:        Time it took to fit both models
+        bins:               Number of histogram bins per summary column
+    Returns:
+        Dict that can be saved as JSON with save_baseline
+    """
+    fitter_params = {name: float(value) for name, value in fitter.params_.items()}
+    ggf_params = {name: float(value) for name, value in ggf.params_.items()}
+    histograms = {}
+    for column in SUMMARY_COLUMNS:
+        edges = histogram_edges(summary[column], bins)
+        histograms[column] = {'edges': edges, 'proportions': histogram(summary[column], edges)}
+    return {'created': datetime.today().strftime('%Y-%m-%d'),
+            'model_type': model_type,
+            'frequency': frequency,
+            'penalizer_coef': penalizer_coef,
+            'fitter_model_name': fitter_model_name,
+            'ggf_model_name': ggf_model_name,
+            'fitter_params': fitter_params,
+            'ggf_params': ggf_params,
+            'customers': len(summary),
+            'fit_seconds': fit_seconds,
+            'log_likelihood': log_likelihood_stats(summary, model_type, fitter_params, ggf_params),
+            'histograms': histograms}
+
+
+def check_drift(baseline,
+                summary,
+                model_type,
+                frequency,
+                penalizer_coef,
+                psi_threshold=0.1,
+                log_likelihood_threshold=0.05,
+                max_model_age_days=28,
+                today=None):
+    """Decide whether the models have to be fit again on a new summary.
+    The models are refit when the settings changed, the models are older
+    than max_model_age_days, a summary column histogram moved more than
+    psi_threshold, or the mean log-likelihood per customer of the saved
+    models dropped more than log_likelihood_threshold and more than
+    LOG_LIKELIHOOD_STANDARD_ERRORS standard errors.
+    Args:
+        baseline:                   Dict made by build_baseline when the models were fit
+        summary:                    RFM transaction data of this run
+        model_type:                 model type (PARETO, BGNBD)
+        frequency:                  The frequency used to calculate the summary table
+        penalizer_coef:             Penalizer used in fitter and ggf models
+        psi_threshold:              Largest population stability index allowed per column
+        log_likelihood_threshold:   Largest drop in mean log-likelihood per customer allowed
+        max_model_age_days:         Refit models older than this, None never refits on age
+        today:                      Date of this run, defaults to today
+    Returns:
+        (refit, report) where report holds the measured drift and the reasons to refit
+    """
+    start_time = time.time()
+    today = today or datetime.today()
+    reasons = []
+    report = {'model_date': baseline['created']}
+
+    settings = {'model_type': model_type, 'frequency': frequency, 'penalizer_coef': penalizer_coef}
+    changed = [name for name, value in settings.items() if baseline.get(name) != value]
+    if changed:
+        reasons.append('settings changed: {}'.format(', '.join(changed)))
+
+    model_age_days = (today - datetime.strptime(baseline['created'], '%Y-%m-%d')).days
+    report['model_age_days'] = model_age_days
+    if max_model_age_days is not None and model_age_days > max_model_age_days:
+        reasons.append('model is {} days old'.format(model_age_days))
+
+    report['psi'] = {}
+    for column in SUMMARY_COLUMNS:
+        column_baseline = baseline['histograms'][column]
+        report['psi'][column] = population_stability_index(
+            column_baseline['proportions'], histogram(summary[column], column_baseline['edges']))
+    drifted = [column for column, psi in report['psi'].items() if psi > psi_threshold]
+    if drifted:
+        reasons.append('histogram drift in {}'.format(', '.join(drifted)))
+
+    if not changed:
+        stats = log_likelihood_stats(summary, model_type,
+                                     baseline['fitter_params'], baseline['ggf_params'])
+        report['log_likelihood_drop'] = {}
+        worse = []
+        for model in ['fitter', 'ggf']:
+            (drop, standard_error) = log_likelihood_drop(baseline['log_likelihood'][model], stats[model])
+            report['log_likelihood_drop'][model] = {'drop': drop, 'standard_error': standard_error}
+            # not <= so a NaN log-likelihood also refits
+            if not (drop <= log_likelihood_threshold
+                    or drop <= LOG_LIKELIHOOD_STANDARD_ERRORS * standard_error):
+                worse.append(model)
+        if worse:
+            reasons.append('log-likelihood dropped for {}'.format(', '.join(worse)))
+
+    refit = bool(reasons)
+    report['reasons'] = reasons
+    report['refit'] = refit
+    report['seconds'] = time.time() - start_time
+    logging.info('Drift check: psi {} (threshold {}), log-likelihood drop {} (threshold {}), '
+                 'model age {} days'.format(
+                     {column: round(psi, 4) for column, psi in report['psi'].items()},
+                     psi_threshold,
+                     {model: '{:.4f} +/- {:.4f}'.format(drop['drop'], drop['standard_error'])
+                      for model, drop in report.get('log_likelihood_drop', {}).items()},
+                     log_likelihood_threshold,
+                     model_age_days))
+    if refit:
+        logging.info('Drift check decided to refit in {:.2f}s: {}'.format(
+            report['seconds'], '; '.join(reasons)))
+    else:
+        logging.info('Drift check decided to skip the fit in {:.2f}s, rescoring with the models '
+                     'from {} (that fit took {:.1f}s)'.format(
+                         report['seconds'], baseline['created'], baseline['fit_seconds']))
+    return (refit, report)
+
+
+def save_baseline(baseline, file_path):
+    """Save a baseline made by build_baseline to a local JSON file."""
+    with open(file_path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file)
+
+
+def load_baseline(file_path):
+    """Load a baseline saved with save_baseline."""
+    with open(file_path, 'r') as baseline_file:
+        return json.load(baseline_file)
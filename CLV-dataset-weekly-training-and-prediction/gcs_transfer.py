@@ -0,0 +1,565 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+# google.cloud and zstandard are imported in the functions that use them,
+# so the local stand-in and gzip work without them.
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import io
+import logging
+import os
+import random
+import time
+import uuid
+import zlib
+
+# Set variables
+logger = logging.getLogger(__name__)
+# GCS only accepts resumable upload chunks in multiples of 256 KiB, except the last
+CHUNK_ALIGNMENT = 256 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# The GCS client sends an object of known size up to 8 MiB in a single request
+SINGLE_REQUEST_SIZE = 8 * 1024 * 1024
+DEFAULT_RETRY_SECONDS = 120
+READ_SIZE = 1024 * 1024
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+class TransientTransferError(ConnectionError):
+    """A request of the local stand-in failed in a way that is worth retrying."""
+
+
+class PreconditionFailed(Exception):
+    """The generation of a LocalBlob did not match, like a 412 response of GCS."""
+    code = 412
+
+
+def storage_client(local_root=None):
+    """Create the client used for transfers.
+    Args:
+        local_root: Folder used as a local stand-in for GCS, None uses Google Cloud Storage
+    Returns:
+        google.cloud.storage.Client or LocalStorageClient
+    """
+    if local_root:
+        return LocalStorageClient(local_root)
+    from google.cloud import storage
+    return storage.Client()
+
+
+def retry_policy(retry_seconds=DEFAULT_RETRY_SECONDS):
+    """Retry policy of the GCS client for transient errors, retrying for at most retry_seconds.
+    The client does not retry uploads without a generation precondition by
+    default. Every upload here replaces the whole blob, so retrying them is safe.
+    """
+    from google.cloud.storage.retry import DEFAULT_RETRY
+    return DEFAULT_RETRY.with_timeout(retry_seconds)
+
+
+def compressed_name(name, compression=None):
+    """Name of a file once compressed, data.csv becomes data.csv.gz with gzip."""
+    return name + COMPRESSION_EXTENSIONS[compression] if compression else name
+
+
+def blob_size(client, blob_link):
+    """Size in bytes of the blob at gs://bucket/name, None when there is no such blob."""
+    if not blob_link:
+        return None
+    (bucket_name, blob_name) = blob_link[len('gs://'):].split('/', 1)
+    blob = client.bucket(bucket_name).blob(blob_name)
+    if not blob.exists():
+        return None
+    blob.reload()
+    return blob.size
+
+
+def _aligned(chunk_size):
+    """chunk_size rounded down to a multiple of 256 KiB, at least 256 KiB."""
+    return max(CHUNK_ALIGNMENT, chunk_size // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT)
+
+
+def _compressor(compression, level=None):
+    """Streaming compressor with compress and flush, None when not compressing.
+    gzip defaults to level 1, level 6 is about five times slower on prediction
+    CSV files for 10% smaller output.
+    """
+    if not compression:
+        return None
+    if compression == 'gzip':
+        # wbits 31 writes a gzip header
+        return zlib.compressobj(1 if level is None else level, zlib.DEFLATED, 31)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise ValueError('Unknown compression {}, use gzip or zstd'.format(compression))
+
+
+def _decompressor(compression):
+    """Streaming decompressor with decompress, None when not compressed."""
+    if not compression:
+        return None
+    if compression == 'gzip':
+        return zlib.decompressobj(31)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('Unknown compression {}, use gzip or zstd'.format(compression))
+
+
+def _payload(file_path, compression=None):
+    """Yield the bytes of a file, compressed on the fly."""
+    compressor = _compressor(compression)
+    with open(file_path, 'rb') as source_file:
+        for block in iter(lambda: source_file.read(READ_SIZE), b''):
+            yield compressor.compress(block) if compressor else block
+    if compressor:
+        yield compressor.flush()
+
+
+class PayloadReader(object):
+    """Readable file object over the bytes of a file, compressed on the fly.
+    Only reads forward, which is all upload_from_file needs of a stream of
+    unknown size.
+    """
+
+    def __init__(self, file_path, compression=None):
+        self.payload = _payload(file_path, compression)
+        self.buffer = bytearray()
+        self.position = 0
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self.buffer) < size:
+            piece = next(self.payload, None)
+            if piece is None:
+                break
+            self.buffer += piece
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.payload.close()
+
+
+class LocalStorageClient(object):
+    """Stand-in for google.cloud.storage.Client that keeps buckets as folders.
+    Covers the calls used by the functions, so they can run and be
+    benchmarked without GCS.
+    """
+
+    def __init__(self, root, failure_rate=0.0, seed=None):
+        """
+        Args:
+            root:           Folder with one sub folder per bucket
+            failure_rate:   Share of requests that fail with a transient error
+            seed:           Seed for the failures
+        """
+        self.root = root
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self, bucket_name)
+
+    def list_blobs(self, bucket_name, prefix=None, delimiter=None):
+        bucket = self.bucket(bucket_name)
+        names = []
+        for folder, folders, files in os.walk(bucket.path):
+            folders[:] = [name for name in folders if name not in ('.uploads', '.locks')]
+            for file_name in files:
+                names.append(os.path.relpath(os.path.join(folder, file_name), bucket.path)
+                             .replace(os.sep, '/'))
+        names = sorted(name for name in names if name.startswith(prefix or ''))
+        if delimiter:
+            names = [name for name in names
+                     if delimiter not in name[len(prefix or ''):]]
+        return [bucket.blob(name) for name in names]
+
+    def request(self, retry=None):
+        """Count one request, failing a share of them like a transient error.
+        Args:
+            retry: Retry policy of the GCS client that retries the failures, None fails at once
+        """
+        def send():
+            self.requests += 1
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                raise TransientTransferError('Injected transfer failure')
+        (retry(send) if retry else send)()
+
+
+class LocalBucket(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+
+class LocalBlob(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.client = bucket.client
+        self.name = name
+        self.path = os.path.join(bucket.path, *name.split('/'))
+        self.size = None
+        self.generation = None
+        self.chunk_size = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def reload(self, retry=None):
+        self.client.request(retry)
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+
+    def _generation_lock(self):
+        """Open lock file held while the generation is checked and changed, closing it releases the lock."""
+        import fcntl
+        lock_path = os.path.join(self.bucket.path, '.locks', *self.name.split('/')) + '.lock'
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        lock_file = open(lock_path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _check_generation(self, if_generation_match):
+        """Raise PreconditionFailed unless the blob has generation if_generation_match, 0 when it must not exist."""
+        if if_generation_match is None:
+            return
+        generation = os.stat(self.path).st_mtime_ns if self.exists() else 0
+        if generation != if_generation_match:
+            raise PreconditionFailed('{} has generation {}, not {}'.format(
+                self.name, generation, if_generation_match))
+
+    def _part_path(self):
+        part_path = os.path.join(self.bucket.path, '.uploads', uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        return part_path
+
+    def _replace(self, part_path, if_generation_match=None):
+        """Move a complete part file into place as the new generation of the blob."""
+        with self._generation_lock():
+            self._check_generation(if_generation_match)
+            previous_generation = os.stat(self.path).st_mtime_ns if self.exists() else 0
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            os.replace(part_path, self.path)
+            # a rewrite within the resolution of the clock still gets a new generation
+            generation = max(time.time_ns(), previous_generation + 1)
+            os.utime(self.path, ns=(generation, generation))
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+
+    def _read(self, file_obj, request_size, start=None, end=None, if_generation_match=None, retry=None):
+        """Write bytes start to end of the blob to file_obj, request_size bytes per request."""
+        with self._generation_lock() if if_generation_match is not None else contextlib.nullcontext():
+            self._check_generation(if_generation_match)
+            with open(self.path, 'rb') as blob_file:
+                position = start or 0
+                last = os.fstat(blob_file.fileno()).st_size - 1 if end is None else end
+                blob_file.seek(position)
+                # Like GCS, even an empty blob takes a request
+                while True:
+                    size = last - position + 1 if request_size < 0 else min(request_size, last - position + 1)
+                    self.client.request(retry)
+                    data = blob_file.read(max(size, 0))
+                    file_obj.write(data)
+                    position += len(data)
+                    if position > last or not data:
+                        break
+
+    def download_as_bytes(self, start=None, end=None, if_generation_match=None, retry=None):
+        """Bytes start to end, both inclusive like the GCS client."""
+        data = io.BytesIO()
+        self._read(data, -1, start, end, if_generation_match, retry)
+        return data.getvalue()
+
+    def download_to_file(self, file_obj, if_generation_match=None, retry=None):
+        """Write the blob to file_obj, in chunk_size requests when chunk_size is set."""
+        self._read(file_obj, self.chunk_size or -1, if_generation_match=if_generation_match, retry=retry)
+
+    def upload_from_file(self, file_obj, size=None, content_type=None, if_generation_match=None, retry=None):
+        """Replace the blob with the rest of file_obj, only when it has generation if_generation_match if given.
+        Like the GCS client, a file of known size up to SINGLE_REQUEST_SIZE is
+        sent in one request and others in chunk_size requests.
+        """
+        if size is not None and size <= SINGLE_REQUEST_SIZE:
+            request_size = max(size, 1)
+        else:
+            request_size = self.chunk_size or DEFAULT_CHUNK_SIZE
+        part_path = self._part_path()
+        try:
+            with open(part_path, 'wb') as part_file:
+                for data in iter(lambda: file_obj.read(request_size), b''):
+                    self.client.request(retry)
+                    part_file.write(data)
+            self._replace(part_path, if_generation_match)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, retry=None):
+        """Replace the blob with data, only when it has generation if_generation_match if given."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.upload_from_file(io.BytesIO(data), len(data), content_type, if_generation_match, retry)
+
+    def open(self, mode='wb', chunk_size=None, ignore_flush=None, retry=None, content_type=None):
+        """Writable file object like the BlobWriter of the GCS client, only mode wb is supported."""
+        if mode != 'wb':
+            raise ValueError('LocalBlob only opens for writing, not {}'.format(mode))
+        return LocalBlobWriter(self, chunk_size, retry)
+
+    def delete(self, if_generation_match=None):
+        with self._generation_lock():
+            self._check_generation(if_generation_match)
+            os.remove(self.path)
+
+
+class LocalBlobWriter(object):
+    """Stand-in for the BlobWriter of the GCS client.
+    Sends a request whenever a chunk is full and moves the blob into place
+    on close. terminate, or leaving its with block on an error, leaves the
+    blob as it was.
+    """
+
+    def __init__(self, blob, chunk_size=None, retry=None):
+        self.blob = blob
+        self.chunk_size = chunk_size or blob.chunk_size or DEFAULT_CHUNK_SIZE
+        self.retry = retry
+        self.buffer = bytearray()
+        self.position = 0
+        self.part_path = blob._part_path()
+        self.part_file = open(self.part_path, 'wb')
+
+    @property
+    def closed(self):
+        return self.part_file.closed
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def _send(self, data):
+        self.blob.client.request(self.retry)
+        self.part_file.write(data)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('Write to closed LocalBlobWriter')
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) > self.chunk_size:
+            self._send(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def close(self):
+        """Send the last chunk and complete the upload."""
+        if self.closed:
+            return
+        try:
+            self._send(bytes(self.buffer))
+            self.part_file.close()
+            self.blob._replace(self.part_path)
+        except Exception:
+            self.terminate()
+            raise
+
+    def terminate(self):
+        """Cancel the upload, the blob is not changed."""
+        self.part_file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def upload_file(client,
+                bucket_name,
+                file_path,
+                blob_name,
+                chunk_size=DEFAULT_CHUNK_SIZE,
+                compression=None,
+                retry_seconds=DEFAULT_RETRY_SECONDS,
+                content_type='application/octet-stream'):
+    """Upload a file with upload_from_file of the GCS client.
+    A file up to SINGLE_REQUEST_SIZE is sent in a single request, a larger
+    one in resumable chunks that the client retries one at a time. A failed
+    upload starts again from the first byte the next time it is called.
+    Args:
+        client:         google.cloud.storage.Client or LocalStorageClient
+        bucket_name:    Bucket to upload to
+        file_path:      path+filename of local file
+        blob_name:      Name of the file in the bucket
+        chunk_size:     Bytes per request, rounded down to a multiple of 256 KiB
+        compression:    None, gzip or zstd, the file is compressed while it is uploaded
+        retry_seconds:  Seconds transient errors are retried for
+        content_type:   Content type of the blob
+    Returns:
+        Dict with blob, file and payload bytes and seconds
+    """
+    start_time = time.time()
+    blob = client.bucket(bucket_name).blob(blob_name)
+    blob.chunk_size = _aligned(chunk_size)
+    blob_link = 'gs://{}/{}'.format(bucket_name, blob_name)
+    file_bytes = os.path.getsize(file_path)
+    if not compression:
+        (source, size) = (open(file_path, 'rb'), file_bytes)
+    elif file_bytes <= SINGLE_REQUEST_SIZE:
+        # Compressed in memory, so the size is known and the client sends it in one request
+        source = io.BytesIO(b''.join(_payload(file_path, compression)))
+        size = source.getbuffer().nbytes
+    else:
+        (source, size) = (PayloadReader(file_path, compression), None)
+    try:
+        blob.upload_from_file(source, size=size, content_type=content_type,
+                              retry=retry_policy(retry_seconds))
+        sent_bytes = source.tell()
+    finally:
+        source.close()
+
+    seconds = time.time() - start_time
+    logging.info('Uploaded {} to {}: {:.1f} MB as {:.1f} MB in {:.2f}s, {:.1f} MB/s'.format(
+        file_path, blob_link, file_bytes / 1024 ** 2, sent_bytes / 1024 ** 2, seconds,
+        file_bytes / 1024 ** 2 / seconds if seconds else float('nan')))
+    return {'blob': blob_link, 'file_bytes': file_bytes, 'bytes': sent_bytes, 'seconds': seconds}
+
+
+def open_upload_stream(client,
+                       bucket_name,
+                       blob_name,
+                       chunk_size=DEFAULT_CHUNK_SIZE,
+                       retry_seconds=DEFAULT_RETRY_SECONDS,
+                       content_type='application/octet-stream'):
+    """Writable file object that uploads what is written in resumable chunks.
+    A chunk is sent whenever chunk_size bytes have been written, and closing
+    it completes the upload. terminate, or leaving its with block on an
+    error, cancels the upload and the blob is not created.
+    Args:
+        client:         google.cloud.storage.Client or LocalStorageClient
+        bucket_name:    Bucket to upload to
+        blob_name:      Name of the file in the bucket
+        chunk_size:     Bytes per request, rounded down to a multiple of 256 KiB
+        retry_seconds:  Seconds transient errors are retried for
+        content_type:   Content type of the blob
+    Returns:
+        google.cloud.storage.fileio.BlobWriter or LocalBlobWriter
+    """
+    blob = client.bucket(bucket_name).blob(blob_name)
+    # pyarrow flushes the file it writes to, which BlobWriter refuses unless flushes are ignored
+    return blob.open('wb', chunk_size=_aligned(chunk_size), ignore_flush=True,
+                     retry=retry_policy(retry_seconds), content_type=content_type)
+
+
+def download_file(client,
+                  bucket_name,
+                  blob_name,
+                  file_path,
+                  chunk_size=DEFAULT_CHUNK_SIZE,
+                  compression=None,
+                  retry_seconds=DEFAULT_RETRY_SECONDS):
+    """Download a blob in chunks with download_to_file of the GCS client, decompressing it once complete.
+    The download is pinned to the generation the blob had when it started,
+    so a blob replaced during the download fails it instead of mixing two
+    versions.
+    Args:
+        client:         google.cloud.storage.Client or LocalStorageClient
+        bucket_name:    Bucket to download from
+        blob_name:      Name of the file in the bucket
+        file_path:      path+filename of local file
+        chunk_size:     Bytes per request
+        compression:    None, gzip or zstd, how the blob is compressed
+        retry_seconds:  Seconds transient errors are retried for
+    Returns:
+        Dict with blob, file and payload bytes and seconds
+    """
+    start_time = time.time()
+    retry = retry_policy(retry_seconds)
+    blob = client.bucket(bucket_name).blob(blob_name)
+    blob.chunk_size = _aligned(chunk_size)
+    blob_link = 'gs://{}/{}'.format(bucket_name, blob_name)
+    blob.reload(retry=retry)
+    part_path = file_path + '.part'
+    try:
+        with open(part_path, 'wb') as part_file:
+            blob.download_to_file(part_file, if_generation_match=blob.generation, retry=retry)
+        if compression:
+            decompressor = _decompressor(compression)
+            with open(part_path, 'rb') as part_file, open(file_path, 'wb') as destination_file:
+                for block in iter(lambda: part_file.read(READ_SIZE), b''):
+                    destination_file.write(decompressor.decompress(block))
+                if hasattr(decompressor, 'flush'):
+                    destination_file.write(decompressor.flush())
+        else:
+            os.replace(part_path, file_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    seconds = time.time() - start_time
+    file_bytes = os.path.getsize(file_path)
+    logging.info('Downloaded {} to {}: {:.1f} MB as {:.1f} MB in {:.2f}s, {:.1f} MB/s'.format(
+        blob_link, file_path, file_bytes / 1024 ** 2, blob.size / 1024 ** 2, seconds,
+        file_bytes / 1024 ** 2 / seconds if seconds else float('nan')))
+    return {'blob': blob_link, 'file_bytes': file_bytes, 'bytes': blob.size, 'seconds': seconds}
+
+
+def transfer_files(client,
+                   transfers,
+                   workers=4,
+                   chunk_size=DEFAULT_CHUNK_SIZE,
+                   retry_seconds=DEFAULT_RETRY_SECONDS):
+    """Move several files concurrently.
+    Args:
+        client:         google.cloud.storage.Client or LocalStorageClient
+        transfers:      List of dicts with direction (upload or download), bucket,
+                        file, blob and optionally compression
+        workers:        Number of files moved at the same time
+        chunk_size:     Bytes per request
+        retry_seconds:  Seconds transient errors are retried for
+    Returns:
+        List with the result of each transfer, in the order of transfers
+    """
+    start_time = time.time()
+
+    def transfer(item):
+        if item['direction'] == 'upload':
+            return upload_file(client, item['bucket'], item['file'], item['blob'],
+                               chunk_size, item.get('compression'), retry_seconds)
+        return download_file(client, item['bucket'], item['blob'], item['file'],
+                             chunk_size, item.get('compression'), retry_seconds)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(transfer, transfers))
+    seconds = time.time() - start_time
+    file_bytes = sum(result['file_bytes'] for result in results)
+    logging.info('Transferred {} files, {:.1f} MB in {:.2f}s, {:.1f} MB/s on {} workers'.format(
+        len(results), file_bytes / 1024 ** 2, seconds,
+        file_bytes / 1024 ** 2 / seconds if seconds else float('nan'), workers))
+    return results
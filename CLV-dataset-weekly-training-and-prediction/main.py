@@ -2,25 +2,30 @@
 # -*- coding: utf-8 -*- 
 
 # Load Libaries
-from google.cloud import bigquery
-from google.cloud import bigquery_storage
-from google.cloud import storage
+# google.cloud, lifetimes, pyarrow and the modules of optional features are
+# imported in the functions that use them, so a run only pays for what it uses.
 from datetime import datetime
-from lifetimes import BetaGeoFitter, ParetoNBDFitter, GammaGammaFitter, utils
-import math
-import os
+import json
+import numpy as np
 import pandas as pd
 import logging
 import config
 import time
-from string import Template, capwords
-import pyarrow
+from string import Template
+import contextlib
+import gcs_transfer
+import drift
+import btyd_scoring
+import run_report
+import run_coordinator
+import quantile_sketch
 
 # Set variables
 logger = logging.getLogger(__name__)
 PENALIZER_COEF = config.config_vars['PENALIZER_COEF']
 DISCOUNT_RATE = config.config_vars['DISCOUNT_RATE']
 PREDICTION_LENGTH_IN_MONTHS = config.config_vars['PREDICTION_LENGTH_IN_MONTHS']
+PREDICTION_HORIZONS_IN_MONTHS = config.config_vars['PREDICTION_HORIZONS_IN_MONTHS']
 MODEL_TYPE=config.config_vars['MODEL_TYPE']
 FREQUENZY= config.config_vars['FREQUENZY']
 GCS_BUCKET_MODELS = config.config_vars['GCS_BUCKET_MODELS']
@@ -29,6 +34,37 @@ LOCAL_STORAGE_FOLDER = config.config_vars['LOCAL_STORAGE_FOLDER']
 TRAINING_DATA_QUERY = config.config_vars['TRAINING_DATA_QUERY']
 ACTUAL_CUSTOMER_VALUE_QUERY = config.config_vars['ACTUAL_CUSTOMER_VALUE_QUERY']
 UPDATE_BIGQUERY_RESULT_TABLE = config.config_vars['UPDATE_BIGQUERY_RESULT_TABLE']
+SCORING_CACHE_FILE = config.config_vars['SCORING_CACHE_FILE']
+SCORING_CACHE_MAX_ENTRIES = config.config_vars['SCORING_CACHE_MAX_ENTRIES']
+SCORING_CACHE_DECIMALS = config.config_vars['SCORING_CACHE_DECIMALS']
+OUT_OF_CORE_MEMORY_BUDGET_MB = config.config_vars['OUT_OF_CORE_MEMORY_BUDGET_MB']
+OUT_OF_CORE_SPILL_FOLDER = config.config_vars['OUT_OF_CORE_SPILL_FOLDER']
+UNCERTAINTY_SAMPLES = config.config_vars['UNCERTAINTY_SAMPLES']
+UNCERTAINTY_METHOD = config.config_vars['UNCERTAINTY_METHOD']
+UNCERTAINTY_PERCENTILES = config.config_vars['UNCERTAINTY_PERCENTILES']
+UNCERTAINTY_MEMORY_BUDGET_MB = config.config_vars['UNCERTAINTY_MEMORY_BUDGET_MB']
+UNCERTAINTY_WORKERS = config.config_vars['UNCERTAINTY_WORKERS']
+UNCERTAINTY_TABLE_ID = config.config_vars['UNCERTAINTY_TABLE_ID']
+TRANSFER_CHUNK_SIZE_MB = config.config_vars['TRANSFER_CHUNK_SIZE_MB']
+TRANSFER_WORKERS = config.config_vars['TRANSFER_WORKERS']
+TRANSFER_RETRY_SECONDS = config.config_vars['TRANSFER_RETRY_SECONDS']
+TRANSFER_COMPRESSION = config.config_vars['TRANSFER_COMPRESSION']
+GCS_LOCAL_ROOT = config.config_vars['GCS_LOCAL_ROOT']
+STREAM_EXPORT_CHUNK_SIZE = config.config_vars['STREAM_EXPORT_CHUNK_SIZE']
+DRIFT_BASELINE_FILE = config.config_vars['DRIFT_BASELINE_FILE']
+DRIFT_PSI_THRESHOLD = config.config_vars['DRIFT_PSI_THRESHOLD']
+DRIFT_LOG_LIKELIHOOD_THRESHOLD = config.config_vars['DRIFT_LOG_LIKELIHOOD_THRESHOLD']
+DRIFT_MAX_MODEL_AGE_DAYS = config.config_vars['DRIFT_MAX_MODEL_AGE_DAYS']
+DRIFT_HISTOGRAM_BINS = config.config_vars['DRIFT_HISTOGRAM_BINS']
+RUN_REPORT_FILE = config.config_vars['RUN_REPORT_FILE']
+RUN_REPORT_CHANGE_THRESHOLD = config.config_vars['RUN_REPORT_CHANGE_THRESHOLD']
+RUN_COORDINATOR_PREFIX = config.config_vars['RUN_COORDINATOR_PREFIX']
+RUN_LEASE_SECONDS = config.config_vars['RUN_LEASE_SECONDS']
+RUN_PUBLISH_WAIT_SECONDS = config.config_vars['RUN_PUBLISH_WAIT_SECONDS']
+RUN_WINDOW = config.config_vars['RUN_WINDOW']
+RUN_MAX_EVENT_AGE_SECONDS = config.config_vars['RUN_MAX_EVENT_AGE_SECONDS']
+SEGMENT_SKETCH_FILE = config.config_vars['SEGMENT_SKETCH_FILE']
+SEGMENT_SKETCH_K = config.config_vars['SEGMENT_SKETCH_K']
 
 
 def file_to_string(sql_path):
@@ -56,6 +92,8 @@ def load_data_from_bq(training_data_query, actual_customer_value_query):
         training_df, actual_customer_value_df
     """
     try:
+        from google.cloud import bigquery
+
         #Load training data
         query = file_to_string(training_data_query)
         client = bigquery.Client()
@@ -72,29 +110,66 @@ def load_data_from_bq(training_data_query, actual_customer_value_query):
         logger.error("Fatal in error load_data_from_bq function", exc_info=True)
 
 
+# Function that loads the training data from Bigquery page by page
+def load_data_from_bq_in_chunks(training_data_query, actual_customer_value_query,
+                                page_size=100000):
+    """ Load data from Bigquery without holding all transactions in memory
+    Args:
+        training_data_query: Query that returns userId, order_date, order_value
+        actual_customer_value_query: query that returns userId, current_total_revenue
+        page_size: Number of transactions in each chunk
+    Returns: 
+        training_data_chunks, total_rows, actual_customer_value_df
+    """
+    try:
+        from google.cloud import bigquery
+
+        #Load training data one page at a time
+        query = file_to_string(training_data_query)
+        client = bigquery.Client()
+        rows = client.query(query).result(page_size=page_size)
+        training_data_chunks = rows.to_dataframe_iterable()
+
+        # Load historical customer value
+        query = file_to_string(actual_customer_value_query)
+        actual_customer_value_df = client.query(query).to_dataframe()
+        actual_customer_value_df = \
+            actual_customer_value_df.set_index('userId')
+        return (training_data_chunks, rows.total_rows, actual_customer_value_df)
+    except Exception as error_message:
+        logger.error("Fatal in error load_data_from_bq_in_chunks function", exc_info=True)
+
+
 # Function that transforms data into RFM summary DF and actual_df
-def transform_data(training_df, actual_customer_value_df, frequency='M'
-                   ):
+def transform_data(training_df, actual_customer_value_df, frequency='M',
+                   report=None):
     """ transforms data into RFM summary DF and actual_df.
     Takes the two dataframes you have generated with load_data_from_bq
     as input
     Args:
         training_df: The dataset that will be transformed to summary table
         actual_customer_value_df: Information used for testing
+        report: RunReport that counts the customers dropped, None does not count
     Returns: 
         
         summary, actual_df
     """
     try:
+        from lifetimes import utils
+
         logging.info('Loading data...')
 
         summary = utils.summary_data_from_transaction_data(training_df,
                 'userId', 'order_date', monetary_value_col='order_value',
                 freq=frequency)
+        if report is not None:
+            report.count_filtered_customers(summary)
         summary = summary[(summary['monetary_value'] > 0)
                         & (summary['frequency'] > 0)]
         actual_df = pd.merge(summary, actual_customer_value_df,
                             left_index=True, right_index=True)
+        if report is not None:
+            report.count('customers_without_actual_value', len(summary) - len(actual_df))
 
         logging.info('Data loaded.')
         return (summary, actual_df)
@@ -112,6 +187,7 @@ def bgnbd_model(summary, penalizer_coef=0):
         bgnbd model fit to the data
     """
     try:
+        from lifetimes import BetaGeoFitter
         bgf = BetaGeoFitter(penalizer_coef=penalizer_coef)
         bgf.fit(summary['frequency'], summary['recency'], summary['T'])
         return bgf
@@ -121,6 +197,8 @@ def bgnbd_model(summary, penalizer_coef=0):
 
 def paretonbd_model(summary, penalizer_coef=0):
     """Instantiate and fit a Pareto/NBD model.
+    Fit on the log-space likelihood of pareto_nbd, which stays finite for
+    customers with many purchases and is faster than the lifetimes fit.
     Args:
         summary: RFM transaction data
         penalizer_coef: n typical applications, 
@@ -129,8 +207,9 @@ def paretonbd_model(summary, penalizer_coef=0):
         bgnbd model fit to the data
     """
     try:
-        paretof = ParetoNBDFitter(penalizer_coef=penalizer_coef)
-        paretof.fit(summary['frequency'], summary['recency'], summary['T'])
+        import pareto_nbd
+        paretof = pareto_nbd.fit(summary['frequency'], summary['recency'], summary['T'],
+                                 penalizer_coef)
         return paretof
     except Exception as error_message:
         logger.error("Fatal in error paretonbd_model function", exc_info=True)
@@ -146,6 +225,7 @@ def gammagamma_model(summary, penalizer_coef=0):
         bgnbd model fit to the data
     """
     try:
+        from lifetimes import GammaGammaFitter
         ggf = GammaGammaFitter(penalizer_coef=penalizer_coef)
         ggf.fit(summary['frequency'], summary['monetary_value'])
         return ggf
@@ -153,27 +233,256 @@ def gammagamma_model(summary, penalizer_coef=0):
         logger.error("Fatal in error gammagamma_model function", exc_info=True)
 
 
+# Function that saves the fitted parameters of a model
+def save_model_params(model, model_type, file_path):
+    """Saves the fitted parameters of a model to a JSON file.
+    The daily function scores with these parameters without loading lifetimes.
+    Args:
+        model: lifetimes fitter, already fit to data
+        model_type: model type (PARETO, BGNBD, GGF)
+        file_path: path+filename of local file
+    """
+    try:
+        with open(file_path, 'w') as params_file:
+            json.dump({'model_type': model_type,
+                       'params': {name: float(value)
+                                  for name, value in model.params_.items()}},
+                      params_file)
+    except Exception as error_message:
+        logger.error("Fatal in error save_model_params function", exc_info=True)
+
+
 # Function that uploads local file to GCS
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    """Uploads a file to the bucket.
+def upload_blob(bucket_name, source_file_name, destination_blob_name, compression=None):
+    """Uploads a file to the bucket in chunks.
     Args:
         bucket_name: Your Google Cloud Storage bucket name
         source_file_name: path+filename of local file
         destination_blob_name: Name of file in Google Cloud Storage
+        compression: None, gzip or zstd, the file is compressed while it is uploaded
     Returns: 
         blob_link: The uri of the file that has been uploaded
     """
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(destination_blob_name)
-
-        blob.upload_from_filename(source_file_name)
-        blob_link = 'gs://{}/{}'.format(bucket_name, destination_blob_name)
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        result = gcs_transfer.upload_file(storage_client,
+                                          bucket_name,
+                                          source_file_name,
+                                          destination_blob_name,
+                                          TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                          compression,
+                                          TRANSFER_RETRY_SECONDS)
+        blob_link = result['blob']
         return blob_link
     except Exception as error_message:
         logger.error("Fatal in error upload_blob function", exc_info=True)
 
+
+# Function that uploads several local files to GCS at the same time
+def upload_blobs(bucket_name, files):
+    """Uploads files to the bucket concurrently in chunks.
+    Args:
+        bucket_name: Your Google Cloud Storage bucket name
+        files: List of (source_file_name, destination_blob_name)
+    Returns: 
+        blob_links: The uris of the files that have been uploaded
+    """
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        transfers = [{'direction': 'upload',
+                      'bucket': bucket_name,
+                      'file': source_file_name,
+                      'blob': destination_blob_name}
+                     for source_file_name, destination_blob_name in files]
+        results = gcs_transfer.transfer_files(storage_client,
+                                              transfers,
+                                              TRANSFER_WORKERS,
+                                              TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                              TRANSFER_RETRY_SECONDS)
+        return [result['blob'] for result in results]
+    except Exception as error_message:
+        logger.error("Fatal in error upload_blobs function", exc_info=True)
+
+
+def download_blob(bucket_name, 
+                  source_blob_name, 
+                  destination_file_name, 
+                  destination_file_location,
+                  compression=None):
+    """Downloads a blob from a GCS bucket in chunks.
+    Args:
+        bucket_name = "your-bucket-name"
+        source_blob_name = "storage-object-name"
+        destination_file_name = "local/path/to/file"
+        compression = None, gzip or zstd, how the blob is compressed
+    Returns:
+        Downloads file to local storage
+    """
+    try:
+        destination_file_path = destination_file_location+destination_file_name
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+
+        gcs_transfer.download_file(storage_client,
+                                   bucket_name,
+                                   source_blob_name,
+                                   destination_file_path,
+                                   TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                   compression,
+                                   TRANSFER_RETRY_SECONDS)
+        print(
+            "Blob {} downloaded to {}.".format(
+                source_blob_name, destination_file_path
+            )
+        )
+    except Exception as error_message:
+        logger.error("Fatal in error download_blob function", exc_info=True)
+
+
+# Function that loads the scoring cache from the previous run
+def load_scoring_cache(bucket_name, cache_file_name, local_storage_folder,
+                       max_entries, decimals):
+    """Downloads the scoring cache saved by the previous run, if any.
+    Args:
+        bucket_name: Google Cloud Storage bucket the cache is stored in
+        cache_file_name: Name of the cache file in Google Cloud Storage
+        local_storage_folder: The local folder the cache is downloaded to
+        max_entries: Maximum number of entries kept in the cache
+        decimals: Number of decimals RFM values are rounded to in cache keys
+    Returns:
+        ScoringCache, empty when no cache has been saved yet
+    """
+    import scoring_cache
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        blob = storage_client.bucket(bucket_name).blob(cache_file_name)
+        if blob.exists():
+            download_blob(bucket_name, cache_file_name, cache_file_name,
+                          local_storage_folder)
+        return scoring_cache.ScoringCache.load(local_storage_folder+cache_file_name,
+                                               max_entries, decimals)
+    except Exception as error_message:
+        logger.error("Fatal in error load_scoring_cache function", exc_info=True)
+        return scoring_cache.ScoringCache(max_entries, decimals)
+
+
+def download_blobs(bucket_name, 
+                   source_blob_names, 
+                   destination_file_location):
+    """Downloads blobs from a GCS bucket concurrently in chunks.
+    Args:
+        bucket_name = "your-bucket-name"
+        source_blob_names = names of the blobs, each is saved under its own name
+        destination_file_location = "local/path/"
+    Returns:
+        Downloads files to local storage
+    """
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        transfers = [{'direction': 'download',
+                      'bucket': bucket_name,
+                      'blob': source_blob_name,
+                      'file': destination_file_location+source_blob_name}
+                     for source_blob_name in source_blob_names]
+        gcs_transfer.transfer_files(storage_client,
+                                    transfers,
+                                    TRANSFER_WORKERS,
+                                    TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                    TRANSFER_RETRY_SECONDS)
+    except Exception as error_message:
+        logger.error("Fatal in error download_blobs function", exc_info=True)
+
+
+# Function that loads the drift baseline of the current models
+def load_drift_baseline(bucket_name, baseline_file_name, local_storage_folder):
+    """Downloads the drift baseline saved when the current models were fit.
+    Args:
+        bucket_name: Google Cloud Storage bucket the baseline is stored in
+        baseline_file_name: Name of the baseline file in Google Cloud Storage
+        local_storage_folder: The local folder the baseline is downloaded to
+    Returns:
+        Dict made by drift.build_baseline, None when no baseline has been saved yet
+    """
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        blob = storage_client.bucket(bucket_name).blob(baseline_file_name)
+        if not blob.exists():
+            return None
+        download_blob(bucket_name, baseline_file_name, baseline_file_name,
+                      local_storage_folder)
+        return drift.load_baseline(local_storage_folder+baseline_file_name)
+    except Exception as error_message:
+        logger.error("Fatal in error load_drift_baseline function", exc_info=True)
+
+
+# Function that saves the report of a run next to the models in GCS
+def save_run_report(report, bucket_name, report_file_name, local_storage_folder,
+                    change_threshold=0.5):
+    """Compares the report of this run with the previous run and uploads it.
+    The report is uploaded under report_file_name, which the next run
+    compares with, and under a name with the run date, so the reports of
+    all runs are kept.
+    Args:
+        report: RunReport of this run
+        bucket_name: Google Cloud Storage bucket the reports are stored in
+        report_file_name: Name of the report of the last run in Google Cloud Storage
+        local_storage_folder: The local folder the reports are saved to
+        change_threshold: Relative change of a count or drop in throughput that gives a warning
+    Returns:
+        The report as a dict
+    """
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        previous = None
+        if storage_client.bucket(bucket_name).blob(report_file_name).exists():
+            download_blob(bucket_name, report_file_name, report_file_name,
+                          local_storage_folder)
+            previous = run_report.load_report(local_storage_folder+report_file_name)
+        finished_report = report.finish(previous, change_threshold)
+        dated_file_name = run_report.suffixed_name(report_file_name, finished_report['run_date'])
+        # The latest and the dated copy are saved as separate files and both uploaded
+        run_report.save_report(finished_report, local_storage_folder+report_file_name)
+        run_report.save_report(finished_report, local_storage_folder+dated_file_name)
+        # The report is finished, so a failed upload can only be logged
+        if upload_blobs(bucket_name,
+                        [(local_storage_folder+report_file_name, report_file_name),
+                         (local_storage_folder+dated_file_name, dated_file_name)]) is None:
+            logging.error('Uploading the run report failed')
+        return finished_report
+    except Exception as error_message:
+        logger.error("Fatal in error save_run_report function", exc_info=True)
+
+
+# Function that loads previously fitted models from GCS
+def load_models(bucket_name, fitter_model_name, ggf_model_name, model_type,
+                penalizer_coef, local_storage_folder):
+    """Downloads and loads a saved fitter and gamma-gamma model.
+    Args:
+        bucket_name: Google Cloud Storage bucket the models are stored in
+        fitter_model_name: Name of the saved fitter in Google Cloud Storage
+        ggf_model_name: Name of the saved gamma-gamma model in Google Cloud Storage
+        model_type: model type (PARETO, BGNBD)
+        penalizer_coef: Penalizer used in fitter and ggf models
+        local_storage_folder: The local folder the models are downloaded to
+    Returns:
+        fitter, ggf, both None when the models could not be loaded
+    """
+    try:
+        from lifetimes import BetaGeoFitter, ParetoNBDFitter, GammaGammaFitter
+
+        download_blobs(bucket_name, [fitter_model_name, ggf_model_name],
+                       local_storage_folder)
+        if model_type == 'PARETO':
+            fitter = ParetoNBDFitter(penalizer_coef=penalizer_coef)
+        else:
+            fitter = BetaGeoFitter(penalizer_coef=penalizer_coef)
+        fitter.load_model(local_storage_folder+fitter_model_name)
+        ggf = GammaGammaFitter(penalizer_coef=penalizer_coef)
+        ggf.load_model(local_storage_folder+ggf_model_name)
+        return (fitter, ggf)
+    except Exception as error_message:
+        logger.error("Fatal in error load_models function", exc_info=True)
+        return (None, None)
+
 # Function that uploads GCS CSV file to BQ
 def upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id):
     """Truncates BigQuery table with CSV file stored in Google Cloud Storage.
@@ -181,8 +490,12 @@ def upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id):
         blob_link: The uri of the file that will be written to BigQuery
         temporary_table_id: The table is being overwritten with data from the CSV file.
         Make sure the provided table id does not contain any data that should not be overwriten.
+    Returns:
+        True when the table was loaded, None when loading it failed
     """
     try: 
+        from google.cloud import bigquery
+
         # Construct a BigQuery client object.
         client = bigquery.Client()
 
@@ -198,9 +511,66 @@ def upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id):
         load_job.result()  # Waits for the job to complete.
         destination_table = client.get_table(temporary_table_id)
         print("Loaded {} rows to {}.".format(destination_table.num_rows, temporary_table_id))
+        return True
     except Exception as error_message:
         logger.error("Fatal in error upload_cloud_storage_csv_file_to_bq_table function", exc_info=True)
 
+# Function that uploads GCS Parquet file to BQ
+def upload_cloud_storage_parquet_file_to_bq_table(blob_link, temporary_table_id):
+    """Truncates BigQuery table with Parquet file stored in Google Cloud Storage.
+    Args:
+        blob_link: The uri of the file that will be written to BigQuery
+        temporary_table_id: The table is being overwritten with data from the Parquet file.
+        Make sure the provided table id does not contain any data that should not be overwriten.
+    Returns:
+        True when the table was loaded, None when loading it failed
+    """
+    try: 
+        from google.cloud import bigquery
+
+        # Construct a BigQuery client object.
+        client = bigquery.Client()
+
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            source_format=bigquery.SourceFormat.PARQUET
+        )
+        load_job = client.load_table_from_uri(
+            blob_link, temporary_table_id, job_config=job_config
+        )  # Make an API request.
+        load_job.result()  # Waits for the job to complete.
+        destination_table = client.get_table(temporary_table_id)
+        print("Loaded {} rows to {}.".format(destination_table.num_rows, temporary_table_id))
+        return True
+    except Exception as error_message:
+        logger.error("Fatal in error upload_cloud_storage_parquet_file_to_bq_table function", exc_info=True)
+
+# Function that saves a dataframe as CSV file in GCS
+def upload_predictions_to_gcs(df,
+                              gcs_bucket_predictions,
+                              localFolderPath,
+                              csv_file_name):
+    """Saves a local CSV file and uploads it to GCS
+    Args:
+        df: A dataframe with the same schema as destination table
+        gcs_bucket_predictions: Google Cloud Storage bucket name that the CSV file with new predictions will be uploaded to.
+        csv_file_name: The name of the csv file that will be created for GCS
+    Returns:
+        blob_link: The uri of the uploaded CSV file
+    """
+    try:
+        # Save local file
+        csv_file_path = localFolderPath+csv_file_name
+        df.to_csv(csv_file_path, encoding="utf-8", index=False)
+        #Upload local CSV file to GCS, BigQuery loads gzip compressed CSV files as is
+        return upload_blob(bucket_name=gcs_bucket_predictions,
+                           source_file_name = csv_file_path,
+                           destination_blob_name = gcs_transfer.compressed_name(csv_file_name, TRANSFER_COMPRESSION),
+                           compression = TRANSFER_COMPRESSION)
+    except Exception as error_message:
+        logger.error("Fatal in error upload_predictions_to_gcs function", exc_info=True)
+
+
 # Function that append dataframe to a BigQuery Table
 def upload_new_predictions_to_bigquery(df,
                             gcs_bucket_predictions,
@@ -216,34 +586,222 @@ def upload_new_predictions_to_bigquery(df,
     returns:
         The function first saves a local csv file, uploads it to GCS, writes 
         csv file to a temporary table in BigQuery.
+        blob_link: The uri of the uploaded CSV file
     """
     try:
-        # Save local file
-        csv_file_path = localFolderPath+csv_file_name
-        df.to_csv(csv_file_path, encoding="utf-8", index=False)
-        #Upload local CSV file to GCS
-        blob_link = upload_blob(bucket_name=gcs_bucket_predictions,
-                                source_file_name = csv_file_path,
-                                destination_blob_name = csv_file_name)
+        blob_link = upload_predictions_to_gcs(df,
+                                              gcs_bucket_predictions,
+                                              localFolderPath,
+                                              csv_file_name)
         # Upload CSV file from GCS to temporary BQ table
-        upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id)
+        if blob_link is None or not upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id):
+            return None
+        return blob_link
     except Exception as error_message:
         logger.error("Fatal in error upload_new_predictions_to_bigquery function", exc_info=True)
 
 
+# Function that streams prediction chunks to a Parquet file in GCS
+def stream_predictions_to_gcs(output_chunks,
+                              gcs_bucket_predictions,
+                              parquet_file_name):
+    """Writes prediction chunks to a Parquet file that is uploaded while it is written.
+    Each chunk becomes a row group and is encoded and handed to the upload
+    as soon as it has been scored, so only a chunk of predictions and a few
+    upload chunks are held in memory.
+    Args:
+        output_chunks: Iterable of dataframes with the same schema as destination table
+        gcs_bucket_predictions: Google Cloud Storage bucket name that the Parquet file with new predictions will be uploaded to.
+        parquet_file_name: The name of the Parquet file in GCS
+    Returns:
+        blob_link: The uri of the file that has been uploaded, None when there are no predictions
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet as pq
+
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        writer = None
+        rows = 0
+        blob_link = 'gs://{}/{}'.format(gcs_bucket_predictions, parquet_file_name)
+        with gcs_transfer.open_upload_stream(storage_client,
+                                             gcs_bucket_predictions,
+                                             parquet_file_name,
+                                             TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                             TRANSFER_RETRY_SECONDS) as upload_stream:
+            for chunk in output_chunks:
+                if chunk is None:
+                    raise ValueError('Scoring a chunk of customers failed')
+                table = pyarrow.Table.from_pandas(chunk, preserve_index=False,
+                                                  schema=writer.schema if writer else None)
+                if writer is None:
+                    writer = pq.ParquetWriter(upload_stream, table.schema)
+                writer.write_table(table)
+                rows += len(chunk)
+            if writer is None:
+                logging.warning('No predictions to upload')
+                upload_stream.terminate()
+                return None
+            writer.close()
+        logging.info('Streamed {} predictions to {}'.format(rows, blob_link))
+        return blob_link
+    except Exception as error_message:
+        logger.error("Fatal in error stream_predictions_to_gcs function", exc_info=True)
+
+
+# Function that writes a predictions file in GCS to the clv_and_churn_predictions table
+def publish_predictions(blob_link,
+                        sql_path,
+                        temporary_table_id = 'ml_models_production.new_predictions',
+                        publish_lease=None,
+                        clv_thresholds=None,
+                        time_months=None):
+    """Overwrites the temporary table with a predictions file and merges it into clv_and_churn_predictions.
+    Runs of the daily function write the same tables, so both steps are
+    done while holding publish_lease.
+    Args:
+        blob_link: The uri of the CSV or Parquet file with new predictions
+        sql_path: Query that merges the temporary table into clv_and_churn_predictions
+        temporary_table_id: The table Id for a temporary table that will be overwritten. Is used for deduplication
+        publish_lease: run_coordinator.Lease shared by the runs that publish, None publishes without it
+        clv_thresholds: Thresholds of the clv segments, see quantile_sketch.clv_thresholds
+        time_months: Horizons in months the file has a predicted_value_next_<months>_month column for,
+                     None takes them from PREDICTION_HORIZONS_IN_MONTHS and PREDICTION_LENGTH_IN_MONTHS
+    Returns:
+        blob_link: The uri of the published file, None when a step failed
+    """
+    try:
+        with publish_lease or contextlib.nullcontext():
+            if blob_link.endswith('.parquet'):
+                loaded = upload_cloud_storage_parquet_file_to_bq_table(blob_link, temporary_table_id)
+            else:
+                loaded = upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id)
+            if not loaded:
+                raise IOError('Loading {} to {} failed'.format(blob_link, temporary_table_id))
+            # Add new predictions to the clv_and_churn_prediction table and update segments
+            if not update_or_add_new_predictions_to_clv_and_churn_predictions_table(sql_path, clv_thresholds,
+                                                                                   time_months):
+                raise IOError('Updating the clv_and_churn_predictions table with {} failed'.format(sql_path))
+        return blob_link
+    except Exception as error_message:
+        logger.error("Fatal in error publish_predictions function", exc_info=True)
+
+
+# Function that fills in the predicted value columns of the query that updates the clv_and_churn_predictions table
+def update_query(sql_path, time_months=None, clv_thresholds=None):
+    """Reads the update query and fills in a predicted_value_next_<months>_month column for each horizon.
+    The query names the columns with $predicted_value_columns, and with
+    $existing_predicted_value_columns where they are read from the
+    existing clv_and_churn_predictions table. The thresholds of the clv
+    segments are selected in $clv_percentiles, from the query parameters
+    when the clv was sketched and with APPROX_QUANTILES over
+    all_customers_with_clv_predictions when it was not.
+    Args:
+        sql_path: Query that merges the temporary table into clv_and_churn_predictions
+        time_months: Horizons in months, None takes them from PREDICTION_HORIZONS_IN_MONTHS and PREDICTION_LENGTH_IN_MONTHS
+        clv_thresholds: Dict of the query parameters p25, p50 and p75, None computes the thresholds in the query
+    Returns:
+        String with the query
+    """
+    if time_months is None:
+        time_months = set(PREDICTION_HORIZONS_IN_MONTHS or []) | {PREDICTION_LENGTH_IN_MONTHS}
+    columns = ['predicted_value_next_{}_month'.format(months) for months in sorted(time_months)]
+    if clv_thresholds is None:
+        clv_percentiles = 'SELECT {} FROM (SELECT APPROX_QUANTILES(clv, 100) AS percentiles FROM all_customers_with_clv_predictions)'.format(
+            ', '.join('percentiles[OFFSET({})] AS {}'.format(int(round(quantile * 100)), name)
+                      for (name, quantile) in quantile_sketch.CLV_SEGMENT_QUANTILES.items()))
+    else:
+        clv_percentiles = 'SELECT {}'.format(', '.join('@{0} AS {0}'.format(name) for name in clv_thresholds))
+    return Template(file_to_string(sql_path)).substitute(
+        predicted_value_columns=''.join('{}, '.format(column) for column in columns),
+        existing_predicted_value_columns=''.join('excisting_predictions.{}, '.format(column) for column in columns),
+        clv_percentiles=clv_percentiles)
+
 
 # Function that updates or adds new predictions to clv_and_churn_predictions table
-def update_or_add_new_predictions_to_clv_and_churn_predictions_table(sql_path):
-    """ updates or adds new predictions to clv_and_churn_predictions table"""
+def update_or_add_new_predictions_to_clv_and_churn_predictions_table(sql_path, clv_thresholds=None, time_months=None):
+    """ updates or adds new predictions to clv_and_churn_predictions table
+    Args:
+        sql_path: Query that merges the temporary table into clv_and_churn_predictions
+        clv_thresholds: Dict of the query parameters p25, p50 and p75 the clv segments are set with,
+                        None computes them in the query, see update_query
+        time_months: Horizons in months of the predicted value columns, see update_query
+    Returns:
+        True when the query completed, None when it failed
+    """
     try:
+        from google.cloud import bigquery
+
         # Update CLV segmentation and Churn probability segmentation
-        query = file_to_string(sql_path)
+        if clv_thresholds is None:
+            logging.warning('No clv sketch thresholds, the clv segments are computed with APPROX_QUANTILES')
+        query = update_query(sql_path, time_months, clv_thresholds)
         client = bigquery.Client()
-        client.query(query)
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(name, 'FLOAT64', value)
+            for (name, value) in (clv_thresholds or {}).items()])
+        # Wait for the query, so no other run publishes before the table has been replaced
+        client.query(query, job_config=job_config).result()
+        return True
     except Exception as error_message:
         logger.error("Fatal in error update_or_add_new_predictions_to_clv_and_churn_predictions_table function", exc_info=True)
 
 
+def score_customers(
+    summary,
+    fitter,
+    ggf,
+    t,
+    time_months,
+    discount_rate,
+    frequency):
+    """Compute the model scores for each customer for one or more horizons.
+    The expected number of purchases is evaluated once per month up to the
+    longest horizon and the discounted value is accumulated along the way,
+    so all horizons are read off the same pass.
+    Args:
+        summary:      RFM transaction data
+        fitter:       lifetimes fitter, previously fit to data
+        ggf:          lifetimes gamma/gamma fitter, already fit to data
+        t:            time(s) to predict purchases in periods of frequency,
+                      one for each horizon in time_months
+        time_months:  horizon(s) to predict value for in months
+    Returns:
+        Dataframe with p_alive and predicted_purchases_<months> and
+        predicted_value_<months> for each horizon and customer in summary
+    """
+    t = np.atleast_1d(t)
+    time_months = np.atleast_1d(time_months)
+    periods_per_month = t[0] / time_months[0]
+    fitter = btyd_scoring.scoring_model(fitter)
+    frequency_values = summary['frequency']
+    recency_values = summary['recency']
+    T_values = summary['T']
+
+    scores = pd.DataFrame(index=summary.index)
+    scores['p_alive'] = fitter.conditional_probability_alive(
+        frequency_values, recency_values, T_values)
+
+    # use the Gamma-Gamma estimates for the monetary_values
+    adjusted_monetary_value = ggf.conditional_expected_average_profit(
+        frequency_values, summary['monetary_value'])
+
+    previous_purchases = 0
+    predicted_value = 0
+    for month in range(1, int(time_months.max()) + 1):
+        purchases = fitter.conditional_expected_number_of_purchases_up_to_time(
+            month * periods_per_month, frequency_values, recency_values, T_values)
+        # sum up the discounted value of the purchases made in this month
+        predicted_value = predicted_value + adjusted_monetary_value \
+            * (purchases - previous_purchases) / (1 + discount_rate) ** month
+        previous_purchases = purchases
+        if month in time_months:
+            scores['predicted_purchases_{}'.format(month)] = np.asarray(purchases)
+            scores['predicted_value_{}'.format(month)] = np.asarray(predicted_value)
+
+    return scores
+
+
 def predict_value(
     summary,
     actual_df,
@@ -252,7 +810,9 @@ def predict_value(
     t,
     time_months,
     discount_rate,
-    frequency):
+    frequency,
+    cache=None,
+    clv_months=None):
     """Predict lifetime values for customers.
     Args:
         summary:      RFM transaction data
@@ -260,8 +820,13 @@ def predict_value(
                       actual customer values
         fitter:       lifetimes fitter, previously fit to data
         ggf:          lifetimes gamma/gamma fitter, already fit to data
-        time_days:    time to predict purchases in days
-        time_months:  time to predict value in months
+        t:            time(s) to predict purchases in periods of frequency
+        time_months:  time(s) to predict value in months, a
+                      predicted_value_next_<months>_month column is added for each
+        cache:        optional ScoringCache, customers are then scored on their
+                      rounded RFM values, once per unique tuple, and scores are
+                      reused across runs
+        clv_months:   the horizon used for clv, defaults to the longest horizon
     Returns:
         ltv:  dataframe with predicted values for each customer, along with actual
         values and error
@@ -270,48 +835,42 @@ def predict_value(
     try:
         # setup dataframe to hold results
         ltv = actual_df
-        predicted_num_purchases = \
-            fitter.conditional_expected_number_of_purchases_up_to_time(t,
-                summary['frequency'], summary['recency'], summary['T'])
-
-        p_alive = fitter.conditional_probability_alive(summary['frequency'
-                ], summary['recency'], summary['T'])
-
-        predicted_value = ggf.customer_lifetime_value(
-            fitter,
-            summary['frequency'],
-            summary['recency'],
-            summary['T'],
-            summary['monetary_value'],
-            time=time_months,
-            discount_rate=discount_rate,
-            freq=frequency,
-            )
+        if cache is None:
+            scores = score_customers(summary, fitter, ggf, t, time_months,
+                                     discount_rate, frequency)
+        else:
+            import scoring_cache
+            fingerprint = scoring_cache.model_fingerprint(
+                fitter, ggf, t=t, time_months=time_months,
+                discount_rate=discount_rate, frequency=frequency)
+            scores = cache.score(summary, fingerprint,
+                                 lambda rfm: score_customers(rfm, fitter, ggf, t,
+                                                             time_months,
+                                                             discount_rate,
+                                                             frequency))
+        p_alive = scores['p_alive']
+        if clv_months is None:
+            clv_months = int(np.max(time_months))
+        value_columns = ['predicted_value_next_{}_month'.format(months)
+                         for months in sorted(np.atleast_1d(time_months))]
 
         # Create ltv table with predicted values
-        predicted_value.rename('predicted_value_next_6_month', inplace=True)
         ltv.insert(0, 'userId', ltv.index)
-        ltv = pd.merge(ltv, predicted_value, left_index=True,
-                    right_index=True)
-        predicted_num_purchases.rename('predicted_transactions_next_6_month'
-                                    , inplace=True)
-        ltv = pd.merge(ltv, predicted_num_purchases, left_index=True,
-                    right_index=True)
+        for months in sorted(np.atleast_1d(time_months)):
+            ltv['predicted_value_next_{}_month'.format(months)] = \
+                scores['predicted_value_{}'.format(months)].reindex(ltv.index)
         ltv['predicted_total'] = ltv['current_total_revenue'] \
-            + ltv['predicted_value_next_6_month']
-        ltv.reset_index(drop=True, inplace=True)
-        p_alive = pd.Series(p_alive).rename('p_alive', inplace=True)
+            + ltv['predicted_value_next_{}_month'.format(clv_months)]
         churn = 1 - p_alive
-        ltv['churn_probability'] = pd.Series(churn, index=ltv.index)
+        ltv['churn_probability'] = churn.reindex(ltv.index)
+        ltv.reset_index(drop=True, inplace=True)
 
 
-        model_output = ltv[['userId', 'predicted_total', 'churn_probability'
-                        , 'predicted_value_next_6_month',
-                        'current_total_revenue']].copy()
+        model_output = ltv[['userId', 'predicted_total', 'churn_probability']
+                        + value_columns + ['current_total_revenue']].copy()
 
-        model_output.columns = ['userId', 'clv', 'churn_probability',
-                                'predicted_value_next_6_month',
-                                'current_total_revenue']
+        model_output.columns = ['userId', 'clv', 'churn_probability'] \
+            + value_columns + ['current_total_revenue']
 
         # Set number of decimals
         model_output.loc[:, model_output.columns != 'churn_probability'] = \
@@ -322,6 +881,40 @@ def predict_value(
         logger.error("Fatal in error predict_value function", exc_info=True)
 
 
+def predict_value_in_chunks(
+    summary,
+    actual_df,
+    fitter,
+    ggf,
+    t,
+    time_months,
+    discount_rate,
+    frequency,
+    cache=None,
+    clv_months=None,
+    chunk_size=100000):
+    """Predict lifetime values for customers one chunk of customers at a time.
+    Gives the same rows as predict_value, but only the chunk being
+    scored is held in memory, see predict_value for the arguments.
+    Args:
+        chunk_size:   Number of customers in each chunk
+    Yields:
+        model_output for each chunk, None when scoring the chunk failed
+    """
+    for start in range(0, len(actual_df), chunk_size):
+        chunk_actual_df = actual_df.iloc[start:start + chunk_size].copy()
+        yield predict_value(summary.loc[chunk_actual_df.index],
+                            chunk_actual_df,
+                            fitter,
+                            ggf,
+                            t,
+                            time_months,
+                            discount_rate,
+                            frequency,
+                            cache,
+                            clv_months)
+
+
 def run_btyd(
     training_data_query,
     actual_customer_value_query,
@@ -332,7 +925,31 @@ def run_btyd(
     model_type='BGNBD',
     frequency='M',
     penalizer_coef=0,
-    discount_rate=0.01):
+    discount_rate=0.01,
+    scoring_cache_file=None,
+    scoring_cache_max_entries=2000000,
+    scoring_cache_decimals=4,
+    out_of_core_memory_budget_mb=None,
+    out_of_core_spill_folder='/tmp/clv_spill/',
+    prediction_horizons_in_months=None,
+    uncertainty_samples=0,
+    uncertainty_method='HESSIAN',
+    uncertainty_percentiles=(10, 90),
+    uncertainty_memory_budget_mb=256,
+    uncertainty_workers=None,
+    uncertainty_table_id='ml_models_production.clv_and_churn_prediction_intervals',
+    stream_export_chunk_size=None,
+    drift_baseline_file=None,
+    drift_psi_threshold=0.1,
+    drift_log_likelihood_threshold=0.05,
+    drift_max_model_age_days=28,
+    drift_histogram_bins=10,
+    run_report_file=None,
+    run_report_change_threshold=0.5,
+    publish_lease=None,
+    segment_sketch_file=None,
+    segment_sketch_k=1000,
+    run_lease=None):
     """Run selected BTYD model on data loaded from BigQuery and save model to GCS and predictions to BQ
     Args:
         training_data_query:        Query that returns userId, order_date, order_value
@@ -345,31 +962,175 @@ def run_btyd(
         frequency:                  The frequency used to calculate your summary table
         penalizer_coef:             Penalizer used in fitter and ggf models
         discount_rate:              Used to discount future revenue to current day value
+        scoring_cache_file:         Name of the scoring cache file in the models bucket, None disables the cache
+        scoring_cache_max_entries:  Maximum number of entries kept in the scoring cache
+        scoring_cache_decimals:     Number of decimals RFM values are rounded to before they are scored and cached
+        out_of_core_memory_budget_mb: Memory budget for loading and transforming the transactions, the pages loaded from
+                                    BigQuery are sized from it. None keeps all transactions in memory
+        out_of_core_spill_folder:   Local folder the transaction partitions are spilled to in out of core mode
+        prediction_horizons_in_months: Additional horizons in months to predict value for in the same pass
+        uncertainty_samples:        Number of parameter samples for clv and churn intervals, 0 disables intervals
+        uncertainty_method:         HESSIAN or BOOTSTRAP, see uncertainty.draw_param_samples
+        uncertainty_percentiles:    Percentiles of clv and churn probability to write
+        uncertainty_memory_budget_mb: Memory the sample arrays of a chunk may use in a worker
+        uncertainty_workers:        Number of worker processes, None uses all CPUs
+        uncertainty_table_id:       BigQuery table the intervals are written to
+        stream_export_chunk_size:   Number of customers scored and uploaded at a time, None scores everyone before uploading
+        drift_baseline_file:        Name of the drift baseline file in the models bucket, None fits the models on every run
+        drift_psi_threshold:        Largest population stability index of a summary column before the models are fit again
+        drift_log_likelihood_threshold: Largest drop in mean log-likelihood per customer before the models are fit again
+        drift_max_model_age_days:   Models older than this are fit again, None never fits again on age alone
+        drift_histogram_bins:       Number of histogram bins per summary column in the drift baseline
+        run_report_file:            Name of the run report in the models bucket, None does not save a report
+        run_report_change_threshold: Relative change since the previous run report that gives a warning
+        publish_lease:              run_coordinator.Lease held while writing the BigQuery tables shared with other runs
+        segment_sketch_file:        Name of the clv sketch file in the models bucket the daily function updates, None does not save it
+        segment_sketch_k:           Size of the clv sketch the thresholds of the clv segments are read from, see quantile_sketch
+        run_lease:                  run_coordinator.Lease of the run, renewed after each stage so a long run keeps it
+    Returns:
+        Report of the run as a dict, see run_report.RunReport
     """
+    report = run_report.RunReport('weekly')
+    if run_lease is not None:
+        report.stage_callbacks.append(run_lease.renew)
+    report.detail('model_type', model_type)
+    report.detail('frequency', frequency)
     try:
-        (training_df, actual_customer_value_df) = load_data_from_bq(training_data_query,
-                                                                    actual_customer_value_query)
+        load_start_time = time.time()
+        if out_of_core_memory_budget_mb:
+            import out_of_core
+            loaded = load_data_from_bq_in_chunks(training_data_query,
+                                                 actual_customer_value_query,
+                                                 out_of_core.page_size(out_of_core_memory_budget_mb * 1024 ** 2))
+            if loaded is None:
+                raise IOError('Loading the transactions from BigQuery failed')
+            (training_data_chunks, total_rows, actual_customer_value_df) = loaded
+            report.count('transactions', total_rows)
+            report.count('actual_customer_values', len(actual_customer_value_df))
 
-        # load training transaction data
-        (summary, actual_df) = transform_data(training_df,
-                actual_customer_value_df, frequency)
+            # transform training transaction data one partition at a time, the transactions are loaded while they are spilled
+            transformed = out_of_core.transform_data_out_of_core(
+                training_data_chunks,
+                total_rows,
+                actual_customer_value_df,
+                frequency,
+                out_of_core_memory_budget_mb * 1024 ** 2,
+                out_of_core_spill_folder,
+                report)
+            if transformed is None:
+                raise MemoryError('Transforming the transactions within {} MB failed'.format(out_of_core_memory_budget_mb))
+            (summary, actual_df) = transformed
+            report.add_stage('load_and_transform', load_start_time, total_rows)
+        else:
+            loaded = load_data_from_bq(training_data_query, actual_customer_value_query)
+            if loaded is None:
+                raise IOError('Loading the transactions from BigQuery failed')
+            (training_df, actual_customer_value_df) = loaded
+            report.count('transactions', len(training_df))
+            report.count('actual_customer_values', len(actual_customer_value_df))
+            report.add_stage('load', load_start_time, len(training_df),
+                             training_df.memory_usage(index=False).sum())
 
-        # train fitter for selected model
-        logging.info('Fitting model...')
+            # load training transaction data
+            transform_start_time = time.time()
+            (summary, actual_df) = transform_data(training_df,
+                    actual_customer_value_df, frequency, report)
+            report.add_stage('transform', transform_start_time, len(training_df))
+        report.count('customers_scored', len(actual_df))
 
-        if model_type == 'PARETO':
-            fitter = paretonbd_model(summary, penalizer_coef)
-        elif model_type == 'BGNBD':
-            fitter = bgnbd_model(summary, penalizer_coef)
+        # Check whether the customer base drifted since the models were fit
+        refit = True
+        if drift_baseline_file:
+            baseline = load_drift_baseline(gcs_bucket_models,
+                                           drift_baseline_file,
+                                           local_storage_folder)
+            if baseline is None:
+                logging.info('No drift baseline found, fitting models')
+            else:
+                (refit, drift_report) = drift.check_drift(baseline,
+                                                          summary,
+                                                          model_type,
+                                                          frequency,
+                                                          penalizer_coef,
+                                                          drift_psi_threshold,
+                                                          drift_log_likelihood_threshold,
+                                                          drift_max_model_age_days)
+                report.detail('drift', drift_report)
+        if not refit:
+            # Rescore with the models the baseline was made for
+            (fitter, ggf) = load_models(gcs_bucket_models,
+                                        baseline['fitter_model_name'],
+                                        baseline['ggf_model_name'],
+                                        model_type,
+                                        penalizer_coef,
+                                        local_storage_folder)
+            if fitter is None or ggf is None:
+                logging.info('Could not load the previous models, fitting models')
+                refit = True
+
+        if refit:
+            fit_start_time = time.time()
+
+            # train fitter for selected model
+            logging.info('Fitting model...')
+
+            if model_type == 'PARETO':
+                fitter = paretonbd_model(summary, penalizer_coef)
+            elif model_type == 'BGNBD':
+                fitter = bgnbd_model(summary, penalizer_coef)
 
-        logging.info('Done.')
+            logging.info('Done.')
+
+            # fit gamma-gamma model
+            logging.info('Fitting GammaGamma model...')
+            ggf = gammagamma_model(summary, penalizer_coef)
+            logging.info('Done.')
+            fit_seconds = time.time() - fit_start_time
+            logging.info('Fitting models took {:.1f}s'.format(fit_seconds))
+            report.add_stage('fit', fit_start_time, len(summary))
+
+            # Save model locally
+            fitter_model_name = 'clv_model_'+model_type+'_'+datetime.today().strftime('%Y-%m-%d')+'.pkl'
+            ggf_model_name = 'clv_model_ggf_'+datetime.today().strftime('%Y-%m-%d')+'.pkl'
+            fitter.save_model(local_storage_folder+fitter_model_name)
+            ggf.save_model(local_storage_folder+ggf_model_name)
+            #Upload saved model to Google Cloud Storage
+            fitter_source_file_path = local_storage_folder+fitter_model_name
+            ggf_source_file_path = local_storage_folder+ggf_model_name
+
+            # Save model parameters for the scoring-only path of the daily function
+            fitter_params_name = fitter_model_name[:-len('.pkl')]+'.json'
+            ggf_params_name = ggf_model_name[:-len('.pkl')]+'.json'
+            save_model_params(fitter, model_type, local_storage_folder+fitter_params_name)
+            save_model_params(ggf, 'GGF', local_storage_folder+ggf_params_name)
+            files_to_upload = [(fitter_source_file_path, fitter_model_name),
+                               (ggf_source_file_path, ggf_model_name),
+                               (local_storage_folder+fitter_params_name, fitter_params_name),
+                               (local_storage_folder+ggf_params_name, ggf_params_name)]
+
+            # Save the data the models were fit on as baseline for the next drift check
+            if drift_baseline_file:
+                baseline = drift.build_baseline(summary,
+                                                fitter,
+                                                ggf,
+                                                model_type,
+                                                frequency,
+                                                penalizer_coef,
+                                                fitter_model_name,
+                                                ggf_model_name,
+                                                fit_seconds,
+                                                drift_histogram_bins)
+                drift.save_baseline(baseline, local_storage_folder+drift_baseline_file)
+                files_to_upload.append((local_storage_folder+drift_baseline_file, drift_baseline_file))
+            if upload_blobs(gcs_bucket_models, files_to_upload) is None:
+                report.error('Uploading the models failed')
 
         # Setnumber of days in the prediction period
         if frequency == 'D':
-            t = prediction_length_in_months/30
+            t = prediction_length_in_months*30
             time_months = prediction_length_in_months
-        elif frequency == 'w':
-            t = prediction_length_in_months/4
+        elif frequency == 'W':
+            t = prediction_length_in_months*4.345
             time_months = prediction_length_in_months
         elif frequency == 'M':
             t = prediction_length_in_months
@@ -379,51 +1140,165 @@ def run_btyd(
             logging.error('Please either choose D, W or M as input for freuency')
             print ('Please either choose D, W or M as input for freuency')
 
-        # fit gamma-gamma model
-        logging.info('Fitting GammaGamma model...')
-        ggf = gammagamma_model(summary, penalizer_coef)
-        logging.info('Done.')
-        
-        # Save model locally
-        fitter_model_name = 'clv_model_'+model_type+'_'+datetime.today().strftime('%Y-%m-%d')+'.pkl'
-        ggf_model_name = 'clv_model_ggf_'+datetime.today().strftime('%Y-%m-%d')+'.pkl'
-        fitter.save_model(local_storage_folder+fitter_model_name)
-        ggf.save_model(local_storage_folder+ggf_model_name)
-        #Upload saved model to Google Cloud Storage
-        fitter_source_file_path = local_storage_folder+fitter_model_name
-        ggf_source_file_path = local_storage_folder+ggf_model_name
-        upload_blob(gcs_bucket_models, fitter_source_file_path, fitter_model_name)
-        upload_blob(gcs_bucket_models, ggf_source_file_path, ggf_model_name)
+        # Predict all horizons in the same pass, clv uses prediction_length_in_months
+        clv_months = time_months
+        time_months = sorted(set(prediction_horizons_in_months or []) | {clv_months})
+        t = [t * months / clv_months for months in time_months]
         
-        # Get new predictions
-        model_output = predict_value(summary,
-                                    actual_df,
-                                    fitter,
-                                    ggf,
-                                    t,
-                                    time_months,
-                                    discount_rate,
-                                    frequency)
-
-        # Upload model predictions to temporary BigQuery table
+        # Load scoring cache from previous runs
+        cache = None
+        if scoring_cache_file:
+            import scoring_cache
+            cache = load_scoring_cache(gcs_bucket_models,
+                                       scoring_cache_file,
+                                       local_storage_folder,
+                                       scoring_cache_max_entries,
+                                       scoring_cache_decimals)
+            fingerprint = scoring_cache.model_fingerprint(
+                fitter, ggf, t=t, time_months=time_months,
+                discount_rate=discount_rate, frequency=frequency)
+            discarded = cache.discard_other_models(fingerprint)
+            logging.info('Scoring cache: discarded {} entries from other models'.format(discarded))
+
         today = datetime.today().strftime("%Y%m%d")
-        csv_file_name = 'daily_predictions_'+today+'.csv'
-        upload_new_predictions_to_bigquery(model_output,
-                                            gcs_bucket_predictions,
-                                            local_storage_folder,
-                                            csv_file_name,
-                                            'ml_models_production.new_predictions')
-
-        # Add new predictions to the clv_and_churn_prediction table and update segments
-        update_or_add_new_predictions_to_clv_and_churn_predictions_table(UPDATE_BIGQUERY_RESULT_TABLE)
+
+        # Get clv and churn intervals over samples of the model parameters
+        if uncertainty_samples:
+            import uncertainty
+            try:
+                (fitter_samples, ggf_samples) = uncertainty.draw_param_samples(
+                    summary, fitter, ggf, model_type, penalizer_coef,
+                    uncertainty_samples, uncertainty_method, uncertainty_workers)
+                intervals = uncertainty.predict_intervals(summary,
+                                                          actual_df,
+                                                          fitter_samples,
+                                                          ggf_samples,
+                                                          model_type,
+                                                          clv_months,
+                                                          t[time_months.index(clv_months)] / clv_months,
+                                                          discount_rate,
+                                                          uncertainty_percentiles,
+                                                          uncertainty_memory_budget_mb * 1024 ** 2,
+                                                          uncertainty_workers)
+                if upload_new_predictions_to_bigquery(intervals,
+                                                      gcs_bucket_predictions,
+                                                      local_storage_folder,
+                                                      'prediction_intervals_'+today+'.csv',
+                                                      uncertainty_table_id) is None:
+                    report.error('Writing the prediction intervals failed')
+            except Exception as error_message:
+                # The predictions are still written, without intervals
+                logger.error("Fatal in error run_btyd function while predicting intervals", exc_info=True)
+                report.error('Predicting the intervals failed: {!r}'.format(error_message))
+
+        report.detail('models_fit', refit)
+        # Sketch the clv of every customer while scoring, the thresholds of the clv segments are read from it
+        sketch = quantile_sketch.KLLSketch(segment_sketch_k)
+        if stream_export_chunk_size:
+            # Score, write and upload the predictions one chunk of customers at a time
+            score_start_time = time.time()
+            output_chunks = predict_value_in_chunks(summary,
+                                                    actual_df,
+                                                    fitter,
+                                                    ggf,
+                                                    t,
+                                                    time_months,
+                                                    discount_rate,
+                                                    frequency,
+                                                    cache,
+                                                    clv_months,
+                                                    stream_export_chunk_size)
+            blob_link = stream_predictions_to_gcs(report.track_outputs(sketch.track(output_chunks, 'clv')),
+                                                  gcs_bucket_predictions,
+                                                  'weekly_predictions_'+today+'.parquet')
+            report.add_stage('score_and_write', score_start_time, report.output_rows,
+                             gcs_transfer.blob_size(gcs_transfer.storage_client(GCS_LOCAL_ROOT), blob_link))
+        else:
+            # Get new predictions
+            score_start_time = time.time()
+            model_output = predict_value(summary,
+                                        actual_df,
+                                        fitter,
+                                        ggf,
+                                        t,
+                                        time_months,
+                                        discount_rate,
+                                        frequency,
+                                        cache,
+                                        clv_months)
+            report.check_outputs(model_output)
+            if model_output is not None:
+                sketch.update(model_output['clv'])
+            report.add_stage('score', score_start_time, len(actual_df))
+
+            # Upload model predictions to GCS
+            write_start_time = time.time()
+            csv_file_name = 'weekly_predictions_'+today+'.csv'
+            blob_link = upload_predictions_to_gcs(model_output,
+                                                  gcs_bucket_predictions,
+                                                  local_storage_folder,
+                                                  csv_file_name)
+            report.add_stage('write', write_start_time, report.output_rows,
+                             gcs_transfer.blob_size(gcs_transfer.storage_client(GCS_LOCAL_ROOT), blob_link))
+        if blob_link is None and report.output_rows:
+            report.error('Uploading the predictions failed')
+        clv_thresholds = quantile_sketch.clv_thresholds(sketch)
+        report.detail('clv_thresholds', clv_thresholds)
+
+        # Save the clv sketch of the whole customer base, the daily function adds the customers it scores to it
+        if segment_sketch_file and clv_thresholds is not None:
+            quantile_sketch.save_sketch(sketch, local_storage_folder+segment_sketch_file)
+            if upload_blob(gcs_bucket_models,
+                           local_storage_folder+segment_sketch_file,
+                           segment_sketch_file) is None:
+                report.error('Uploading the clv sketch failed')
+
+        # Save scoring cache for the next run
+        if cache is not None:
+            cache.log_stats()
+            report.detail('scoring_cache_hit_rate', round(cache.hit_rate(), 4))
+            cache.save(local_storage_folder+scoring_cache_file)
+            if upload_blob(gcs_bucket_models,
+                           local_storage_folder+scoring_cache_file,
+                           scoring_cache_file) is None:
+                report.error('Uploading the scoring cache failed')
+
+        # Load the predictions to a temporary BigQuery table and add them to the clv_and_churn_prediction table
+        if blob_link is not None:
+            publish_start_time = time.time()
+            if publish_predictions(blob_link,
+                                   UPDATE_BIGQUERY_RESULT_TABLE,
+                                   'ml_models_production.new_predictions',
+                                   publish_lease,
+                                   clv_thresholds,
+                                   time_months) is None:
+                report.error('Publishing the predictions to BigQuery failed')
+            report.add_stage('publish', publish_start_time, report.output_rows)
         
         logging.info('CLV and Churn Predections has been uploaded to BigQuery')
     except Exception as error_message:
         logger.error("Fatal in error run_btyd function", exc_info=True)
+        report.error(repr(error_message))
+    finally:
+        if run_report_file:
+            save_run_report(report,
+                            gcs_bucket_models,
+                            run_report_file,
+                            local_storage_folder,
+                            run_report_change_threshold)
+        else:
+            report.finish()
+    return report.report
 
 
 def main(data, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
+    Events older than RUN_MAX_EVENT_AGE_SECONDS are dropped. With a
+    RUN_COORDINATOR_PREFIX redelivered events of runs that completed, and
+    events of a RUN_WINDOW that already has a completed run, are skipped,
+    see run_coordinator. A run that failed, or an event that arrived while
+    another run was still going on, raises, so the event is delivered
+    again when the function is deployed with retries enabled.
     Args:
         data (dict): Event payload.
         context (google.cloud.functions.Context): Metadata for the event.
@@ -434,8 +1309,16 @@ def main(data, context):
         log_message = Template('Cloud Function was triggered on $time')
         logging.info(log_message.safe_substitute(time=current_time))
 
-        try:
-            run_btyd(TRAINING_DATA_QUERY,
+        published = getattr(context, 'timestamp', None)
+        published = pd.Timestamp(published).timestamp() if published else None
+        if RUN_MAX_EVENT_AGE_SECONDS and published and time.time() - published > RUN_MAX_EVENT_AGE_SECONDS:
+            # Returning acknowledges the event, the next scheduled event runs instead
+            logging.warning('Dropping event {} published {:.0f}s ago, older than RUN_MAX_EVENT_AGE_SECONDS'.format(
+                getattr(context, 'event_id', None), time.time() - published))
+            return
+
+        def run(publish_lease=None, run_lease=None):
+            return run_btyd(TRAINING_DATA_QUERY,
             ACTUAL_CUSTOMER_VALUE_QUERY,
             PREDICTION_LENGTH_IN_MONTHS, 
             GCS_BUCKET_MODELS,
@@ -443,16 +1326,52 @@ def main(data, context):
             LOCAL_STORAGE_FOLDER,MODEL_TYPE,
             FREQUENZY,
             PENALIZER_COEF,
-            DISCOUNT_RATE)
-            
+            DISCOUNT_RATE,
+            SCORING_CACHE_FILE,
+            SCORING_CACHE_MAX_ENTRIES,
+            SCORING_CACHE_DECIMALS,
+            OUT_OF_CORE_MEMORY_BUDGET_MB,
+            OUT_OF_CORE_SPILL_FOLDER,
+            PREDICTION_HORIZONS_IN_MONTHS,
+            UNCERTAINTY_SAMPLES,
+            UNCERTAINTY_METHOD,
+            UNCERTAINTY_PERCENTILES,
+            UNCERTAINTY_MEMORY_BUDGET_MB,
+            UNCERTAINTY_WORKERS,
+            UNCERTAINTY_TABLE_ID,
+            STREAM_EXPORT_CHUNK_SIZE,
+            DRIFT_BASELINE_FILE,
+            DRIFT_PSI_THRESHOLD,
+            DRIFT_LOG_LIKELIHOOD_THRESHOLD,
+            DRIFT_MAX_MODEL_AGE_DAYS,
+            DRIFT_HISTOGRAM_BINS,
+            RUN_REPORT_FILE,
+            RUN_REPORT_CHANGE_THRESHOLD,
+            publish_lease,
+            SEGMENT_SKETCH_FILE,
+            SEGMENT_SKETCH_K,
+            run_lease)
 
-        except Exception as error:
-            log_message = Template('Query failed due to '
-                                   '$message.')
-            logging.error(log_message.safe_substitute(message=error))
+        if RUN_COORDINATOR_PREFIX:
+            coordinator = run_coordinator.RunCoordinator(gcs_transfer.storage_client(GCS_LOCAL_ROOT),
+                                                         GCS_BUCKET_MODELS,
+                                                         'weekly',
+                                                         RUN_COORDINATOR_PREFIX,
+                                                         RUN_LEASE_SECONDS,
+                                                         RUN_PUBLISH_WAIT_SECONDS)
+            window = str(pd.Timestamp(published or time.time(), unit='s').to_period(RUN_WINDOW)) if RUN_WINDOW else None
+            coordinator.run(getattr(context, 'event_id', None),
+                            run,
+                            published,
+                            window)
+        else:
+            report = run()
+            if report.get('status') == 'failed':
+                raise run_coordinator.RunNotCompleted('Run failed with {}'.format(report.get('errors')))
 
     except Exception as error:
-        log_message = Template('$error').substitute(error=error)
-        logging.error(log_message)
-
-
+        log_message = Template('Query failed due to '
+                               '$message.')
+        logging.error(log_message.safe_substitute(message=error))
+        # Raised, so Pub/Sub delivers the event again
+        raise
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+from lifetimes import utils
+import logging
+import math
+import os
+import shutil
+import tempfile
+import pandas as pd
+import pyarrow
+import pyarrow.parquet as pq
+
+# Set variables
+logger = logging.getLogger(__name__)
+# Peak memory of building a summary relative to the size of the transactions,
+# summary_data_from_transaction_data holds several copies of its input.
+TRANSFORM_MEMORY_FACTOR = 6
+# Peak memory of loading and spilling a page relative to the size of its transactions
+PAGE_MEMORY_FACTOR = 4
+# Share of the memory budget a page of transactions may take while it is loaded and spilled
+PAGE_MEMORY_SHARE = 0.125
+# Memory of a transaction in a dataframe before the first page tells, userId, order_date and order_value
+TRANSACTION_BYTES = 96
+MAX_SPLIT_DEPTH = 3
+
+
+def page_size(memory_budget_bytes, bytes_per_row=TRANSACTION_BYTES):
+    """Number of transactions in a page, so loading and spilling it stays within its share of the budget.
+    Args:
+        memory_budget_bytes:    Memory the whole out of core transform may use
+        bytes_per_row:          Memory of a transaction in a dataframe
+    Returns:
+        Number of transactions
+    """
+    return max(1000, int(memory_budget_bytes * PAGE_MEMORY_SHARE / (bytes_per_row * PAGE_MEMORY_FACTOR)))
+
+
+def resident_bytes(dataframes):
+    """Memory of dataframes that are held while the partitions are transformed."""
+    return sum(int(df.memory_usage(deep=True).sum()) for df in dataframes)
+
+
+def partition_numbers(user_ids, partitions, salt=0):
+    """Assign each userId to a partition with a stable hash.
+    Args:
+        user_ids:   Series of userIds
+        partitions: Number of partitions
+        salt:       Changes the hash, used when a partition is split again
+    Returns:
+        Numpy array with the partition number of each userId
+    """
+    hash_key = '{:016d}'.format(salt)
+    hashes = pd.util.hash_pandas_object(user_ids, index=False, hash_key=hash_key)
+    return (hashes.to_numpy() % partitions).astype('int64')
+
+
+class PartitionSpiller(object):
+    """Writes transaction chunks to one Parquet file per userId partition."""
+
+    def __init__(self, spill_folder, partitions, salt=0):
+        self.spill_folder = spill_folder
+        self.partitions = partitions
+        self.salt = salt
+        self.schema = None
+        self.writers = {}
+        self.rows = [0] * partitions
+        os.makedirs(spill_folder, exist_ok=True)
+
+    def path(self, partition):
+        return os.path.join(self.spill_folder, 'partition_{:05d}.parquet'.format(partition))
+
+    def write(self, chunk):
+        """Split a chunk on userId and append each part, sorted on userId, to its partition file."""
+        numbers = partition_numbers(chunk['userId'], self.partitions, self.salt)
+        for partition, part in chunk.groupby(numbers, sort=False):
+            part = part.sort_values('userId', kind='stable')
+            table = pyarrow.Table.from_pandas(part, schema=self.schema,
+                                              preserve_index=False)
+            if self.schema is None:
+                self.schema = table.schema
+            if partition not in self.writers:
+                self.writers[partition] = pq.ParquetWriter(self.path(partition),
+                                                           self.schema)
+            self.writers[partition].write_table(table)
+            self.rows[partition] += len(part)
+
+    def close(self):
+        """Close all partition files and return the paths with rows in them."""
+        for writer in self.writers.values():
+            writer.close()
+        return [(self.path(partition), self.rows[partition])
+                for partition in sorted(self.writers)]
+
+
+def transform_data_out_of_core(training_data_chunks,
+                               total_rows,
+                               actual_customer_value_df,
+                               frequency='M',
+                               memory_budget_bytes=512 * 1024 ** 2,
+                               spill_folder='/tmp/clv_spill/',
+                               report=None):
+    """Transforms data into RFM summary DF and actual_df one userId partition at a time.
+    The transactions are spilled to userId-partitioned Parquet files, so the
+    transactions of a customer always end up in the same partition, and the
+    summary of each partition is built on its own. Everything held in memory
+    counts against memory_budget_bytes: actual_customer_value_df, the page
+    being spilled, the summary and actual_df kept so far and the copies made
+    while a partition is summarised. A partition that does not fit in what
+    is left of the budget is split again before it is read. Load the pages
+    with page_size(memory_budget_bytes) transactions.
+    Args:
+        training_data_chunks:       Iterable of dataframes with userId, order_date, order_value
+        total_rows:                 Total number of transactions in the chunks
+        actual_customer_value_df:   Information used for testing, indexed on userId
+        frequency:                  The frequency used to calculate your summary table
+        memory_budget_bytes:        Memory the whole transform may use
+        spill_folder:               Local folder the partition files are written to, in a subfolder removed afterwards
+        report:                     RunReport that counts the customers dropped, None does not count
+    Returns:
+        summary, actual_df, None when the budget is too small for the summaries
+    """
+    run_folder = None
+    try:
+        os.makedirs(spill_folder, exist_ok=True)
+        run_folder = tempfile.mkdtemp(prefix='transform_', dir=spill_folder)
+        spiller = None
+        observation_period_end = None
+        bytes_per_row = None
+        actual_bytes = resident_bytes([actual_customer_value_df])
+        for chunk in training_data_chunks:
+            if chunk.empty:
+                continue
+            if spiller is None:
+                bytes_per_row = chunk.memory_usage(deep=True, index=False).sum() / len(chunk)
+                if len(chunk) * bytes_per_row * PAGE_MEMORY_FACTOR > memory_budget_bytes * PAGE_MEMORY_SHARE:
+                    logger.warning('Pages of {} transactions exceed their share of the memory budget'.format(len(chunk)))
+                # Half of what is left after the actual values is kept for the summaries of all customers
+                partition_budget = (memory_budget_bytes - actual_bytes) / 2
+                if partition_budget <= 0:
+                    raise MemoryError('The memory budget of {:.1f} MB is smaller than the {:.1f} MB of actual values'.format(
+                        memory_budget_bytes / 1024 ** 2, actual_bytes / 1024 ** 2))
+                partitions = max(1, int(math.ceil(
+                    total_rows * bytes_per_row * TRANSFORM_MEMORY_FACTOR / partition_budget)))
+                logger.info('Spilling {} transactions to {} partitions'.format(total_rows, partitions))
+                spiller = PartitionSpiller(run_folder, partitions)
+            chunk_end = pd.to_datetime(chunk['order_date']).max()
+            if observation_period_end is None or chunk_end > observation_period_end:
+                observation_period_end = chunk_end
+            spiller.write(chunk)
+            del chunk
+
+        if spiller is None:
+            logger.warning('No transactions to transform')
+            summary = pd.DataFrame(columns=['frequency', 'recency', 'T', 'monetary_value'])
+            return (summary, pd.merge(summary, actual_customer_value_df,
+                                      left_index=True, right_index=True))
+
+        summaries = []
+        actual_dfs = []
+        output_bytes = 0
+        peak_bytes = 0
+        # Skewed partitions are read back and split in batches of a page
+        spill_batch_size = page_size(memory_budget_bytes, bytes_per_row)
+        pending = [(path, rows, 0) for path, rows in spiller.close()]
+        while pending:
+            path, rows, depth = pending.pop()
+            estimated_bytes = rows * bytes_per_row * TRANSFORM_MEMORY_FACTOR
+            # The summaries are concatenated at the end, which holds them twice
+            kept_bytes = actual_bytes + 2 * output_bytes
+            available_bytes = memory_budget_bytes - kept_bytes
+            if available_bytes <= 0:
+                raise MemoryError('The memory budget of {:.1f} MB is too small for the {:.1f} MB of summaries'.format(
+                    memory_budget_bytes / 1024 ** 2, output_bytes / 1024 ** 2))
+            if estimated_bytes > available_bytes and depth < MAX_SPLIT_DEPTH:
+                # Skewed partition, or the summaries kept so far left too little, split it on a differently salted hash
+                sub_partitions = int(math.ceil(estimated_bytes / available_bytes)) + 1
+                sub_spiller = PartitionSpiller(path[:-len('.parquet')], sub_partitions,
+                                               salt=depth + 1)
+                for batch in pq.ParquetFile(path).iter_batches(batch_size=spill_batch_size):
+                    sub_spiller.write(batch.to_pandas())
+                pending.extend((sub_path, sub_rows, depth + 1)
+                               for sub_path, sub_rows in sub_spiller.close())
+                os.remove(path)
+                continue
+            if estimated_bytes > available_bytes:
+                logger.warning('Partition {} with {} transactions exceeds the memory budget'.format(path, rows))
+
+            partition_df = pq.read_table(path).to_pandas()
+            os.remove(path)
+            peak_bytes = max(peak_bytes, kept_bytes + estimated_bytes)
+            summary = utils.summary_data_from_transaction_data(partition_df,
+                    'userId', 'order_date', monetary_value_col='order_value',
+                    observation_period_end=observation_period_end,
+                    freq=frequency)
+            del partition_df
+            if report is not None:
+                report.count_filtered_customers(summary)
+            summary = summary[(summary['monetary_value'] > 0)
+                            & (summary['frequency'] > 0)]
+            summaries.append(summary)
+            actual_dfs.append(pd.merge(summary, actual_customer_value_df,
+                                       left_index=True, right_index=True))
+            output_bytes += resident_bytes([summary, actual_dfs[-1]])
+            if report is not None:
+                report.count('customers_without_actual_value', len(summary) - len(actual_dfs[-1]))
+
+        peak_bytes = max(peak_bytes, actual_bytes + 2 * output_bytes)
+        logger.info('Out of core transform peak estimated memory {:.1f} MB of {:.1f} MB budget'.format(
+            peak_bytes / 1024 ** 2, memory_budget_bytes / 1024 ** 2))
+        return (pd.concat(summaries), pd.concat(actual_dfs))
+    except Exception as error_message:
+        logger.error("Fatal in error transform_data_out_of_core function", exc_info=True)
+    finally:
+        if run_folder is not None:
+            shutil.rmtree(run_folder, ignore_errors=True)
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+from functools import partial
+from lifetimes import ParetoNBDFitter
+from lifetimes.generate_data import pareto_nbd_model
+import logging
+import time
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.special import digamma, gammaln
+import btyd_scoring
+
+# Set variables
+logger = logging.getLogger(__name__)
+PARAM_NAMES = ['r', 'alpha', 's', 'beta']
+# Relative step of the log parameters for the finite difference Hessian
+HESSIAN_STEP = 1e-4
+
+
+def negative_log_likelihood(log_params, frequency, recency, T, weights, penalizer_coef):
+    """Negative log-likelihood of the Pareto/NBD model and its gradient.
+    The same objective as lifetimes.ParetoNBDFitter, the summed negative
+    log-likelihood plus penalizer_coef times the sum of the squared
+    parameters, but taken in the log of the parameters.
+    Args:
+        log_params:     Log of r, alpha, s and beta
+        frequency:      Frequency of each distinct history
+        recency:        Recency of each distinct history
+        T:              T of each distinct history
+        weights:        Number of customers with each history
+        penalizer_coef: Penalizer on the parameters
+    Returns:
+        (negative log-likelihood, gradient with respect to log_params)
+    """
+    (r, alpha, s, beta) = params = np.exp(log_params)
+    x = frequency
+    (log_integral, integral_derivatives) = btyd_scoring.pareto_nbd_log_integral(
+        r, alpha, s, beta, x, recency, T, gradient=True)
+
+    alive = -(r + x) * np.log(alpha + T) - s * np.log(beta + T)
+    dead = np.log(s) + log_integral
+    log_likelihood = gammaln(r + x) - gammaln(r) + r * np.log(alpha) + s * np.log(beta) \
+        + np.logaddexp(alive, dead)
+    # Share of the likelihood from customers that are still alive at T
+    alive_share = np.exp(alive - np.logaddexp(alive, dead))
+    dead_share = 1 - alive_share
+
+    derivatives = [
+        digamma(r + x) - digamma(r) + np.log(alpha)
+        - alive_share * np.log(alpha + T) + dead_share * integral_derivatives[0],
+        r / alpha - alive_share * (r + x) / (alpha + T) + dead_share * integral_derivatives[1],
+        np.log(beta) - alive_share * np.log(beta + T) + dead_share * (1 / s + integral_derivatives[2]),
+        s / beta - alive_share * s / (beta + T) + dead_share * integral_derivatives[3]]
+
+    value = -(weights * log_likelihood).sum() + penalizer_coef * (params ** 2).sum()
+    gradient = np.array([-(weights * derivative).sum() for derivative in derivatives]) * params \
+        + 2 * penalizer_coef * params ** 2
+    return (value, gradient)
+
+
+def log_params_hessian(log_params, frequency, recency, T, weights, penalizer_coef):
+    """Hessian of the mean negative log-likelihood plus the penalizer in the
+    log parameters, like the _hessian_ lifetimes keeps for the other fitters,
+    by central differences of the gradient."""
+    customers = weights.sum()
+    # the penalizer is not averaged over the customers
+    penalizer_coef = penalizer_coef * customers
+    columns = []
+    for position in range(len(log_params)):
+        step = np.zeros(len(log_params))
+        step[position] = HESSIAN_STEP
+        (_, gradient_up) = negative_log_likelihood(log_params + step, frequency, recency, T,
+                                                   weights, penalizer_coef)
+        (_, gradient_down) = negative_log_likelihood(log_params - step, frequency, recency, T,
+                                                     weights, penalizer_coef)
+        columns.append((gradient_up - gradient_down) / (2 * HESSIAN_STEP * customers))
+    hessian_ = np.array(columns)
+    return (hessian_ + hessian_.T) / 2
+
+
+def fit(frequency, recency, T, penalizer_coef=0, index=None, tol=1e-10, maxiter=1000):
+    """Fit a Pareto/NBD model on the log-space likelihood.
+    Customers with the same history are counted once with a weight, time is
+    scaled so the oldest customer has T = 1 as in lifetimes, and the
+    parameters are found with L-BFGS-B on the analytic gradient.
+    Args:
+        frequency:      the frequency vector of customers' purchases
+        recency:        the recency vector of customers' purchases
+        T:              customers' age
+        penalizer_coef: Penalizer on the parameters, as in lifetimes
+        index:          index of the fitted data, defaults to the index of frequency
+        tol:            Tolerance of the optimizer
+        maxiter:        Maximum number of optimizer iterations
+    Returns:
+        lifetimes ParetoNBDFitter with params_, data and a Hessian, that can
+        be saved and loaded like a fitter fit by lifetimes
+    """
+    start_time = time.time()
+    if index is None:
+        index = getattr(frequency, 'index', None)
+    frequency = np.asarray(frequency).astype(int)
+    recency = np.asarray(recency, dtype=float)
+    T = np.asarray(T, dtype=float)
+    if np.any(recency > T) or np.any(frequency < 0) or np.any((frequency == 0) & (recency > 0)):
+        raise ValueError('Some customers have recency > T, a negative frequency '
+                         'or recency without repeat purchases.')
+
+    scale = 1.0 / T.max()
+    histories = pd.DataFrame({'frequency': frequency, 'recency': recency * scale, 'T': T * scale}) \
+        .groupby(['frequency', 'recency', 'T']).size().reset_index(name='weights')
+    arguments = (histories['frequency'].to_numpy(dtype=float),
+                 histories['recency'].to_numpy(),
+                 histories['T'].to_numpy(),
+                 histories['weights'].to_numpy(dtype=float),
+                 penalizer_coef)
+
+    output = minimize(negative_log_likelihood, np.zeros(len(PARAM_NAMES)), args=arguments,
+                      jac=True, method='L-BFGS-B', tol=tol, options={'maxiter': maxiter})
+    if not np.isfinite(output.fun):
+        raise ValueError('Pareto/NBD fit did not converge: {}'.format(output.message))
+
+    fitter = ParetoNBDFitter(penalizer_coef=penalizer_coef)
+    fitter._scale = scale
+    fitter._negative_log_likelihood_ = output.fun
+    fitter._hessian_ = log_params_hessian(output.x, *arguments)
+    fitter.params_ = pd.Series(np.exp(output.x), index=PARAM_NAMES)
+    fitter.params_['alpha'] /= scale
+    fitter.params_['beta'] /= scale
+    fitter.data = pd.DataFrame({'frequency': frequency, 'recency': recency, 'T': T,
+                                'weights': np.ones(len(T), dtype=np.int64)}, index=index)
+    # partial of a lifetimes function, so saved fitters load without this module
+    fitter.generate_new_data = partial(pareto_nbd_model, T, *fitter._unload_params('r', 'alpha', 's', 'beta'))
+    fitter.predict = fitter.conditional_expected_number_of_purchases_up_to_time
+    logging.info('Fit Pareto/NBD model on {} customers with {} distinct histories in {} '
+                 'iterations and {:.2f}s'.format(len(T), len(histories), output.nit,
+                                                 time.time() - start_time))
+    return fitter
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import json
+import logging
+import re
+import time
+import uuid
+
+# Set variables
+logger = logging.getLogger(__name__)
+# A lease that is not released, because its run was killed, can be taken over after this long.
+# Keep it above the timeout of the Cloud Function
+LEASE_SECONDS = 900
+POLL_SECONDS = 5
+
+
+class LeaseTaken(RuntimeError):
+    """The lease is held by another run."""
+
+
+class RunNotCompleted(RuntimeError):
+    """The run of an event did not complete, raised so Pub/Sub delivers the event again."""
+
+    def __init__(self, message, record=None):
+        super(RunNotCompleted, self).__init__(message)
+        self.record = record
+
+
+def _is_precondition_failed(error):
+    return getattr(error, 'code', None) == 412
+
+
+def _is_not_found(error):
+    return isinstance(error, FileNotFoundError) or getattr(error, 'code', None) == 404
+
+
+def read_json(blob):
+    """Content and generation of a JSON blob.
+    Returns:
+        (content, generation), (None, 0) when the blob does not exist
+    """
+    while True:
+        try:
+            blob.reload()
+            content = blob.download_as_bytes(if_generation_match=blob.generation)
+            return (json.loads(content), blob.generation)
+        except Exception as error:
+            if _is_not_found(error):
+                return (None, 0)
+            if not _is_precondition_failed(error):
+                raise
+            # replaced between reload and download, read the new generation
+
+
+def write_json(blob, content, if_generation_match):
+    """Write content to a JSON blob that has generation if_generation_match, 0 when it must not exist.
+    Raises the 412 error of GCS, or gcs_transfer.PreconditionFailed, when
+    another run changed the blob first.
+    Returns:
+        The generation written
+    """
+    blob.upload_from_string(json.dumps(content), content_type='application/json',
+                            if_generation_match=if_generation_match)
+    return blob.generation
+
+
+def safe_name(name):
+    """Name as used in blob and file names, other characters than letters, digits, _, . and - become _."""
+    return re.sub('[^A-Za-z0-9_.-]', '_', str(name))
+
+
+class Lease(object):
+    """Lock held by one run at a time, kept in a JSON blob.
+    The blob is created, taken over once expired and deleted with
+    generation preconditions, so of two runs that try at the same time only
+    one succeeds, on GCS and on the local stand-in of gcs_transfer alike.
+    Use it as a context manager to acquire and release it.
+    """
+
+    def __init__(self, client, bucket_name, blob_name, holder,
+                 lease_seconds=LEASE_SECONDS, wait_seconds=0, poll_seconds=POLL_SECONDS):
+        """
+        Args:
+            client:         google.cloud.storage.Client or gcs_transfer.LocalStorageClient
+            bucket_name:    Bucket the lease is kept in
+            blob_name:      Name of the lease blob
+            holder:         Identifies the run holding the lease, like the event id
+            lease_seconds:  Seconds after which the lease can be taken over
+            wait_seconds:   Seconds acquire waits for a lease held by another run
+            poll_seconds:   Seconds between attempts while waiting
+        """
+        self.blob = client.bucket(bucket_name).blob(blob_name)
+        self.holder = holder
+        self.lease_seconds = lease_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self.generation = None
+        self.acquired = None
+        # Content of the lease of the other run when it could not be taken
+        self.current = None
+        self.waited_seconds = 0.0
+
+    def try_acquire(self):
+        """Take the lease when it is free or expired.
+        Returns:
+            True when the lease was taken, False when another run holds it
+        """
+        (current, generation) = read_json(self.blob)
+        now = time.time()
+        if current is not None and current['expires'] > now:
+            self.current = current
+            return False
+        if current is not None:
+            logging.warning('Taking over lease {} of {} that expired {:.0f}s ago'.format(
+                self.blob.name, current['holder'], now - current['expires']))
+        try:
+            self.generation = write_json(self.blob,
+                                         {'holder': self.holder,
+                                          'acquired': now,
+                                          'expires': now + self.lease_seconds},
+                                         generation)
+        except Exception as error:
+            if not _is_precondition_failed(error):
+                raise
+            # another run took it between the read and the write
+            (self.current, _) = read_json(self.blob)
+            return False
+        self.acquired = now
+        self.current = None
+        return True
+
+    def acquire(self):
+        """Take the lease, waiting up to wait_seconds for another run to release it.
+        Raises:
+            LeaseTaken when another run still holds the lease
+        """
+        start_time = time.time()
+        while not self.try_acquire():
+            if time.time() - start_time + self.poll_seconds > self.wait_seconds:
+                self.waited_seconds = time.time() - start_time
+                raise LeaseTaken('Lease {} is held by {}'.format(
+                    self.blob.name, self.current['holder'] if self.current else 'another run'))
+            time.sleep(self.poll_seconds)
+        self.waited_seconds = time.time() - start_time
+        return self
+
+    def renew(self):
+        """Push the expiry of the held lease to lease_seconds from now.
+        Call it between the stages of a run that can take longer than lease_seconds.
+        Raises:
+            LeaseTaken when the lease is not held, or another run took it over after it expired
+        """
+        if self.generation is None:
+            raise LeaseTaken('Lease {} is not held by {}'.format(self.blob.name, self.holder))
+        try:
+            self.generation = write_json(self.blob,
+                                         {'holder': self.holder,
+                                          'acquired': self.acquired,
+                                          'expires': time.time() + self.lease_seconds},
+                                         self.generation)
+        except Exception as error:
+            if not _is_precondition_failed(error):
+                raise
+            self.generation = None
+            raise LeaseTaken('Lease {} of {} was taken over by another run'.format(self.blob.name, self.holder))
+
+    def release(self):
+        """Delete the lease, unless another run took it over after it expired."""
+        if self.generation is None:
+            return
+        try:
+            self.blob.delete(if_generation_match=self.generation)
+        except Exception as error:
+            if not (_is_precondition_failed(error) or _is_not_found(error)):
+                raise
+            logging.warning('Lease {} was taken over by another run before it was released'.format(
+                self.blob.name))
+        self.generation = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.release()
+
+
+class RunCoordinator(object):
+    """Runs a function once per Pub/Sub event and one run of it at a time.
+    Blobs kept in the bucket under prefix:
+        <function>/lease.json               Lease of the run of the function
+        <function>/events/<event_id>.json   Record of each finished run
+        <function>/windows/<window>.json    Record of the finished run of each schedule window
+        publish.lease                       Lease of the step that writes the shared BigQuery tables
+    A redelivered event of a run that completed is logged and skipped, and
+    so is any event of a schedule window that already has a completed run.
+    An event that arrives while a run of the same function is going on, and
+    a run that fails, raise RunNotCompleted without recording the event, so
+    a trigger with retries enabled delivers it again later. Once the run
+    going on completes, the redelivered event finds the record of its
+    window and is skipped instead of running a second time. The weekly and
+    daily functions go on in parallel and only wait for each other to
+    publish.
+    """
+
+    def __init__(self, client, bucket_name, function_name, prefix='clv_runs/',
+                 lease_seconds=LEASE_SECONDS, publish_wait_seconds=300):
+        """
+        Args:
+            client:                 google.cloud.storage.Client or gcs_transfer.LocalStorageClient
+            bucket_name:            Bucket the leases and run records are kept in
+            function_name:          Name of the Cloud Function, weekly or daily
+            prefix:                 Prefix of the leases and run records
+            lease_seconds:          Seconds after which the lease of a killed run can be taken over
+            publish_wait_seconds:   Seconds a run waits for other runs to finish publishing
+        """
+        self.client = client
+        self.bucket_name = bucket_name
+        self.function_name = function_name
+        self.prefix = prefix
+        self.lease_seconds = lease_seconds
+        self.publish_wait_seconds = publish_wait_seconds
+
+    def publish_lease(self, holder):
+        """Lease shared by all functions for writing the BigQuery tables."""
+        return Lease(self.client, self.bucket_name, self.prefix+'publish.lease', holder,
+                     self.lease_seconds, self.publish_wait_seconds)
+
+    def run(self, event_id, function, published=None, window=None):
+        """Run function(publish_lease, run_lease) for an event, unless the event or its window already ran.
+        Args:
+            event_id:   Id of the Pub/Sub event, redeliveries have the same id.
+                        Runs without an event id are never duplicates
+            function:   Called with the publish lease to hold while writing
+                        the shared tables and the lease of the run, to renew
+                        between stages. May return a dict with a status
+            published:  Unix time the event was published, for the queue wait
+            window:     Schedule window of the event, like the day or week it
+                        was published in. None only skips redeliveries
+        Returns:
+            Record of the run with status duplicate or the status returned
+            by function, queue_wait_seconds and run_seconds
+        Raises:
+            RunNotCompleted when another run of the function is still going on or
+            function returned the status failed. Errors raised by function
+            are raised as they are. The event is not recorded in both cases
+        """
+        start_time = time.time()
+        if not event_id:
+            event_id = 'manual-'+uuid.uuid4().hex
+        folder = '{}{}/'.format(self.prefix, self.function_name)
+        record = {'event_id': event_id,
+                  'function': self.function_name,
+                  'published': published,
+                  'started': start_time,
+                  'queue_wait_seconds': round(start_time - published, 3) if published else None}
+        if window:
+            record['window'] = window = safe_name(window)
+        bucket = self.client.bucket(self.bucket_name)
+        marker = bucket.blob(folder+'events/{}.json'.format(event_id))
+        window_marker = bucket.blob(folder+'windows/{}.json'.format(window)) if window else None
+        lease = Lease(self.client, self.bucket_name, folder+'lease.json', event_id, self.lease_seconds)
+        if marker.exists():
+            return self._skip(record, 'duplicate', 'it already ran')
+        if window_marker is not None and window_marker.exists():
+            return self._skip(record, 'duplicate', 'a run of window {} already completed'.format(window))
+        try:
+            lease.acquire()
+        except LeaseTaken:
+            if lease.current and lease.current['holder'] == event_id:
+                return self._skip(record, 'duplicate', 'it is already running')
+            holder = lease.current['holder'] if lease.current else None
+            self._skip(record, 'busy', 'run {} is still going on'.format(holder))
+            raise RunNotCompleted('Run {} of {} is still going on'.format(
+                holder, self.function_name), record)
+
+        publish_lease = self.publish_lease(event_id)
+        try:
+            # the run of a redelivery or of the window may have finished while the lease was read
+            if marker.exists():
+                return self._skip(record, 'duplicate', 'it already ran')
+            if window_marker is not None and window_marker.exists():
+                return self._skip(record, 'duplicate', 'a run of window {} already completed'.format(window))
+            record['status'] = 'failed'
+            result = function(publish_lease, lease)
+            record['status'] = (result.get('status') or 'ok') if isinstance(result, dict) else 'ok'
+        finally:
+            record['run_seconds'] = round(time.time() - start_time, 3)
+            record['publish_wait_seconds'] = round(publish_lease.waited_seconds, 3)
+            record['finished'] = time.time()
+            if record.get('status') not in ('failed', 'duplicate'):
+                # failed runs are not recorded, so a redelivery runs again
+                for completed_marker in [marker, window_marker]:
+                    if completed_marker is None:
+                        continue
+                    try:
+                        write_json(completed_marker, record, 0)
+                    except Exception as error:
+                        if not _is_precondition_failed(error):
+                            raise
+            lease.release()
+            if record.get('status') != 'duplicate':
+                logging.info('Run of {} for event {}: {}, {} in the queue, ran {:.1f}s, '
+                             'waited {:.1f}s to publish'.format(
+                                 self.function_name, event_id, record['status'],
+                                 '{:.1f}s'.format(record['queue_wait_seconds'])
+                                 if record['queue_wait_seconds'] is not None else 'unknown time',
+                                 record['run_seconds'], record['publish_wait_seconds']))
+        if record['status'] == 'failed':
+            raise RunNotCompleted('Run of {} for event {} failed'.format(
+                self.function_name, event_id), record)
+        return record
+
+    def _skip(self, record, status, reason):
+        record['status'] = status
+        logging.info('Skipping event {} of {}, {}'.format(
+            record['event_id'], self.function_name, reason))
+        return record
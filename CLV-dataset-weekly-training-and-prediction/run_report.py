@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+from datetime import datetime
+import json
+import logging
+import time
+import numpy as np
+
+# Set variables
+logger = logging.getLogger(__name__)
+# Increase when the keys of the report change, reports of different versions are not compared
+REPORT_VERSION = 1
+# Throughput of stages shorter than this is too noisy to warn about
+MIN_COMPARED_STAGE_SECONDS = 1.0
+
+
+class RunReport(object):
+    """Data-quality and throughput report of one run of a function.
+    Collects counts of input rows and dropped customers, the duration,
+    rows/s and bytes of each stage and the NaN and infinite values in
+    the written outputs. The keys are the same on every run, so the
+    report of a run can be compared with the report of the run before.
+    """
+
+    def __init__(self, function_name, run_date=None):
+        self.start_time = time.time()
+        self.report = {'report_version': REPORT_VERSION,
+                       'function': function_name,
+                       'run_date': run_date or datetime.today().strftime('%Y-%m-%d'),
+                       'status': None,
+                       'seconds': None,
+                       'details': {},
+                       'counts': {},
+                       'stages': {},
+                       'outputs': {'rows': 0, 'nan': {}, 'inf': {}},
+                       'errors': [],
+                       'warnings': [],
+                       'changes': {}}
+        # Called without arguments after each stage, like Lease.renew of run_coordinator
+        self.stage_callbacks = []
+
+    @property
+    def output_rows(self):
+        """Number of output rows checked so far."""
+        return self.report['outputs']['rows']
+
+    def detail(self, name, value):
+        """Record a setting or decision of the run, details are not compared between runs."""
+        self.report['details'][name] = value
+
+    def count(self, name, value):
+        """Add value to a count, counts of the same name from several calls are summed."""
+        self.report['counts'][name] = self.report['counts'].get(name, 0) + int(value)
+
+    def count_filtered_customers(self, summary):
+        """Count the customers of an RFM summary and those transform_data drops.
+        Customers without repeat purchases and repeat customers without a
+        positive monetary value are not scored.
+        """
+        repeat = summary['frequency'] > 0
+        self.count('customers', len(summary))
+        self.count('customers_without_repeat_purchases', (~repeat).sum())
+        self.count('customers_without_positive_monetary_value',
+                   (repeat & (summary['monetary_value'] <= 0)).sum())
+
+    def add_stage(self, name, start_time, rows, size_bytes=None):
+        """Record the duration and throughput of a stage that started at start_time.
+        Args:
+            name:       Name of the stage, like load, transform, fit, score or write
+            start_time: time.time() when the stage started
+            rows:       Number of rows the stage handled
+            size_bytes: Number of bytes the stage read or wrote, None when unknown
+        """
+        seconds = time.time() - start_time
+        self.report['stages'][name] = {
+            'seconds': round(seconds, 3),
+            'rows': int(rows),
+            'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None,
+            'bytes': None if size_bytes is None else int(size_bytes),
+            'mb_per_second': round(size_bytes / 1024 ** 2 / seconds, 2)
+            if size_bytes is not None and seconds > 0 else None}
+        for callback in self.stage_callbacks:
+            callback()
+
+    def check_outputs(self, model_output):
+        """Count the rows and the NaN and infinite values of each numeric column of outputs.
+        Call it once per chunk when outputs are written in chunks.
+        """
+        if model_output is None:
+            self.error('Scoring returned no predictions')
+            return
+        outputs = self.report['outputs']
+        outputs['rows'] += len(model_output)
+        numeric = model_output.select_dtypes('number')
+        values = numeric.to_numpy(dtype=float)
+        for (column, nan, inf) in zip(numeric.columns,
+                                      np.isnan(values).sum(axis=0),
+                                      np.isinf(values).sum(axis=0)):
+            outputs['nan'][column] = outputs['nan'].get(column, 0) + int(nan)
+            outputs['inf'][column] = outputs['inf'].get(column, 0) + int(inf)
+
+    def track_outputs(self, output_chunks):
+        """Pass chunks of outputs on to the writer, counting them with check_outputs."""
+        for chunk in output_chunks:
+            self.check_outputs(chunk)
+            yield chunk
+
+    def error(self, message):
+        """Record an error, the run is reported as failed."""
+        self.report['errors'].append(str(message))
+
+    def finish(self, previous=None, change_threshold=0.5):
+        """Complete the report and compare it with the report of the previous run.
+        The status is failed when errors were recorded, empty when no outputs
+        were written and ok otherwise. A warning is added for NaN or infinite
+        outputs, and for counts and output rows that changed, or stage
+        throughput that dropped, by more than change_threshold. Throughput
+        is only compared for stages that took MIN_COMPARED_STAGE_SECONDS.
+        Args:
+            previous:           Report of the previous run, None for the first run
+            change_threshold:   Relative change that gives a warning
+        Returns:
+            The report as a dict
+        """
+        report = self.report
+        report['seconds'] = round(time.time() - self.start_time, 3)
+        if report['errors']:
+            report['status'] = 'failed'
+        elif report['outputs']['rows'] == 0:
+            report['status'] = 'empty'
+        else:
+            report['status'] = 'ok'
+
+        for kind in ['nan', 'inf']:
+            bad_values = sum(report['outputs'][kind].values())
+            if bad_values:
+                report['warnings'].append('{} {} values in the outputs'.format(bad_values, kind))
+
+        if previous is not None and previous.get('report_version') == REPORT_VERSION:
+            report['changes'] = compare_reports(previous, report)
+            for (name, change) in report['changes']['counts'].items():
+                if change is not None and abs(change) > change_threshold:
+                    report['warnings'].append('{} changed by {:+.0%} since {}'.format(
+                        name, change, previous['run_date']))
+            for (name, change) in report['changes']['rows_per_second'].items():
+                if change is not None and change < -change_threshold \
+                        and previous['stages'][name]['seconds'] >= MIN_COMPARED_STAGE_SECONDS:
+                    report['warnings'].append('{} throughput changed by {:+.0%} since {}'.format(
+                        name, change, previous['run_date']))
+
+        logging.info('Run report: status {}, {} rows written in {:.1f}s, stages {}'.format(
+            report['status'], report['outputs']['rows'], report['seconds'],
+            {name: '{}s, {} rows/s'.format(stage['seconds'], stage['rows_per_second'])
+             for name, stage in report['stages'].items()}))
+        for warning in report['warnings']:
+            logging.warning('Run report: {}'.format(warning))
+        return report
+
+
+def _relative_change(previous, current):
+    """(current - previous) / previous, None when there is nothing to compare."""
+    if previous is None or current is None or previous == 0:
+        return None
+    return round((current - previous) / previous, 4)
+
+
+def compare_reports(previous, current):
+    """Relative change of the counts, the output rows and the stage throughput between two reports.
+    Args:
+        previous:   Report of the previous run
+        current:    Report of this run
+    Returns:
+        Dict with the previous run_date and the changes of counts (with
+        output_rows) and of rows_per_second and seconds of each stage
+    """
+    previous_counts = dict(previous['counts'], output_rows=previous['outputs']['rows'])
+    current_counts = dict(current['counts'], output_rows=current['outputs']['rows'])
+    changes = {'previous_run_date': previous['run_date'],
+               'counts': {name: _relative_change(previous_counts.get(name), value)
+                          for name, value in current_counts.items()},
+               'rows_per_second': {},
+               'seconds': {}}
+    for (name, stage) in current['stages'].items():
+        previous_stage = previous['stages'].get(name, {})
+        changes['rows_per_second'][name] = _relative_change(previous_stage.get('rows_per_second'),
+                                                            stage['rows_per_second'])
+        changes['seconds'][name] = _relative_change(previous_stage.get('seconds'), stage['seconds'])
+    return changes
+
+
+def suffixed_name(file_name, suffix):
+    """Name of the copy of a report for a run date, clv_run_report.json becomes clv_run_report_<suffix>.json."""
+    (stem, dot, extension) = file_name.rpartition('.')
+    return '{}_{}.{}'.format(stem, suffix, extension) if dot else '{}_{}'.format(file_name, suffix)
+
+
+def save_report(report, file_path):
+    """Save a report made by RunReport.finish to a local JSON file."""
+    with open(file_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+def load_report(file_path):
+    """Load a report saved with save_report."""
+    with open(file_path, 'r') as report_file:
+        return json.load(report_file)
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import hashlib
+import logging
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+# Set variables
+logger = logging.getLogger(__name__)
+RFM_COLUMNS = ['frequency', 'recency', 'T', 'monetary_value']
+# Increase when the format of a saved cache changes, caches of other versions are not loaded
+CACHE_VERSION = 3
+# Relative difference of cached scores from scores of the exact RFM values at the default 4 decimals
+SCORE_TOLERANCE = 1e-4
+
+
+def model_fingerprint(fitter, ggf, **settings):
+    """Create a fingerprint that identifies a pair of fitted models.
+    Two runs get the same fingerprint only when the fitted parameters and
+    the prediction settings are identical, which is when cached scores
+    can be reused.
+    Args:
+        fitter:     lifetimes fitter, previously fit to data
+        ggf:        lifetimes gamma/gamma fitter, already fit to data
+        settings:   prediction settings such as t, time_months, discount_rate and frequency
+    Returns:
+        Hex string identifying the models and settings
+    """
+    fingerprint = hashlib.sha256()
+    for model in (fitter, ggf):
+        fingerprint.update(type(model).__name__.encode('utf-8'))
+        for name, value in sorted(model.params_.items()):
+            fingerprint.update('{}={!r};'.format(name, float(value)).encode('utf-8'))
+    for name, value in sorted(settings.items()):
+        fingerprint.update('{}={!r};'.format(name, value).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+class ScoringCache(object):
+    """Bounded least recently used cache of customer scores.
+    Entries are keyed on a model fingerprint plus a 64 bit hash of the
+    rounded (frequency, recency, T, monetary_value) tuple of a customer.
+    Customers are scored on the rounded values they are keyed on, so a
+    hit returns the scores of exactly the inputs it was looked up with.
+    Rounding moves the values by at most half a unit of the last decimal,
+    at the default 4 decimals the scores stay within SCORE_TOLERANCE of
+    scoring the exact values.
+    Customers with identical rounded inputs are scored once and later
+    runs that use the same models reuse the scores.
+    The entries of each fingerprint are kept in a dataframe indexed by
+    key, so lookups and updates are vectorized.
+    """
+
+    def __init__(self, max_entries=2000000, decimals=4):
+        """
+        Args:
+            max_entries:    Maximum number of entries kept before the least recently used are evicted
+            decimals:       Number of decimals the RFM values are rounded to before they are scored and hashed into keys
+        """
+        self.max_entries = max_entries
+        self.decimals = decimals
+        self.entries = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.customers = 0
+
+    def __len__(self):
+        """Number of entries in the cache."""
+        return sum(len(table) for table in self.entries.values())
+
+    def score(self, summary, fingerprint, score_function):
+        """Score customers on their rounded RFM values, computing every unique tuple at most once.
+        Args:
+            summary:        RFM transaction data
+            fingerprint:    Fingerprint of the models used, see model_fingerprint
+            score_function: Function that takes a RFM dataframe and returns a
+                            dataframe with the scores for each row
+        Returns:
+            Dataframe with the scores for each customer in summary
+        """
+        rfm = summary[RFM_COLUMNS].round(self.decimals)
+        self.customers += len(rfm)
+        self.clock += 1
+        # Customers with identical rounded values share a key, factorize numbers the keys in order of appearance
+        (codes, unique_keys) = pd.factorize(pd.util.hash_pandas_object(rfm, index=False))
+        (_, first_positions) = np.unique(codes, return_index=True)
+        unique_rfm = rfm.iloc[first_positions]
+        keys = np.asarray(unique_keys)
+
+        table = self.entries.get(fingerprint)
+        if table is None:
+            positions = np.full(len(keys), -1)
+        else:
+            positions = table.index.get_indexer(keys)
+        found = positions >= 0
+        missing = np.flatnonzero(~found)
+        self.hits += int(found.sum())
+        self.misses += len(missing)
+
+        if table is not None and len(missing) == 0:
+            columns = [column for column in table.columns if column != 'last_used']
+            values = np.empty((len(keys), len(columns)))
+        else:
+            computed = score_function(unique_rfm.iloc[missing])
+            columns = list(computed.columns)
+            values = np.empty((len(keys), len(columns)))
+            values[missing] = computed.to_numpy(dtype=float)
+        if found.any():
+            values[found] = table[columns].to_numpy()[positions[found]]
+            table.iloc[positions[found], table.columns.get_loc('last_used')] = self.clock
+        if len(missing):
+            self._store(fingerprint, keys[missing], values[missing], columns)
+
+        return pd.DataFrame(values[codes], index=summary.index, columns=columns)
+
+    def _store(self, fingerprint, keys, values, columns):
+        """Add entries and evict the least recently used entries above max_entries."""
+        new_entries = pd.DataFrame(values, index=pd.Index(keys), columns=columns)
+        new_entries['last_used'] = self.clock
+        table = self.entries.get(fingerprint)
+        if table is not None:
+            new_entries = pd.concat([table, new_entries[~new_entries.index.isin(table.index)]])
+        self.entries[fingerprint] = new_entries
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries of all models above max_entries."""
+        excess = len(self) - self.max_entries
+        if excess <= 0:
+            return
+        fingerprints = list(self.entries)
+        sizes = [len(self.entries[fingerprint]) for fingerprint in fingerprints]
+        last_used = np.concatenate([self.entries[fingerprint]['last_used'].to_numpy()
+                                    for fingerprint in fingerprints])
+        evicted = np.zeros(len(last_used), dtype=bool)
+        evicted[np.argsort(last_used, kind='stable')[:excess]] = True
+        offsets = np.cumsum([0] + sizes)
+        for (position, fingerprint) in enumerate(fingerprints):
+            keep = ~evicted[offsets[position]:offsets[position + 1]]
+            if keep.any():
+                self.entries[fingerprint] = self.entries[fingerprint][keep].copy()
+            else:
+                del self.entries[fingerprint]
+        self.evictions += excess
+
+    def discard_other_models(self, fingerprint):
+        """Remove entries computed with other models than the given fingerprint.
+        Args:
+            fingerprint:    Fingerprint of the models that are in use
+        Returns:
+            Number of entries removed
+        """
+        stale_fingerprints = [key for key in self.entries if key != fingerprint]
+        removed = sum(len(self.entries[key]) for key in stale_fingerprints)
+        for key in stale_fingerprints:
+            del self.entries[key]
+        return removed
+
+    def hit_rate(self):
+        """Share of unique RFM tuples that were found in the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def log_stats(self):
+        """Write hit rate and size metrics to the run log."""
+        logging.info('Scoring cache: {} customers, {} unique keys, {} hits, {} misses, '
+                     'hit rate {:.2%}, {} evictions, {} entries'.format(
+                         self.customers,
+                         self.hits + self.misses,
+                         self.hits,
+                         self.misses,
+                         self.hit_rate(),
+                         self.evictions,
+                         len(self)))
+
+    def save(self, file_path):
+        """Save the cache entries to a local file.
+        Args:
+            file_path: path+filename of local file
+        """
+        with open(file_path, 'wb') as cache_file:
+            pickle.dump({'cache_version': CACHE_VERSION,
+                         'decimals': self.decimals,
+                         'clock': self.clock,
+                         'entries': self.entries},
+                        cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file_path, max_entries=2000000, decimals=4):
+        """Load a cache saved with save, or create an empty cache.
+        Entries are dropped when the file was saved with a different
+        rounding or cache version, as the keys would not match.
+        Args:
+            file_path:      path+filename of local file
+            max_entries:    Maximum number of entries kept
+            decimals:       Number of decimals the RFM values are rounded to
+        Returns:
+            ScoringCache
+        """
+        cache = cls(max_entries=max_entries, decimals=decimals)
+        if not os.path.exists(file_path):
+            return cache
+        with open(file_path, 'rb') as cache_file:
+            state = pickle.load(cache_file)
+        if state.get('cache_version') == CACHE_VERSION and state['decimals'] == decimals:
+            cache.clock = state['clock']
+            cache.entries = state['entries']
+            cache._evict()
+        cache.evictions = 0
+        return cache
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import numpy as np
+import pandas as pd
+
+
+def generate_transactions(customers=10000,
+                          seed=0,
+                          start_date='2019-01-01',
+                          end_date='2021-12-31',
+                          r=0.25,
+                          alpha=10.0,
+                          a=0.8,
+                          b=2.5,
+                          p=6.0,
+                          q=4.0,
+                          v=15.0):
+    """Generate seeded synthetic transactions shaped like the BigQuery training data.
+    Purchases follow the BG/NBD story with rates per day and order values
+    follow the Gamma-Gamma story, so the fitted models have something to find.
+    Args:
+        customers:  Number of customers to generate
+        seed:       Seed for the random generator, equal seeds give equal data
+        start_date: First day a customer can make their first purchase
+        end_date:   Last day of the observation period
+        r, alpha:   Gamma distribution of the purchase rate per day
+        a, b:       Beta distribution of the dropout probability after a purchase
+        p, q, v:    Gamma-Gamma parameters of the order values
+    Returns:
+        training_df, actual_customer_value_df
+    """
+    rng = np.random.default_rng(seed)
+    start_date = pd.Timestamp(start_date)
+    observation_days = (pd.Timestamp(end_date) - start_date).days + 1
+
+    first_day = rng.integers(0, observation_days, customers)
+    age = observation_days - first_day
+    purchase_rate = rng.gamma(r, 1 / alpha, customers)
+    dropout = rng.beta(a, b, customers)
+    spend_rate = rng.gamma(q, 1 / v, customers)
+
+    # Repeat purchases before dropping out, capped by what fits in the observation period
+    repeat_purchases = rng.geometric(dropout) - 1
+    cap = np.ceil(purchase_rate * age * 3 + 10).astype('int64')
+    repeat_purchases = np.minimum(repeat_purchases, cap)
+
+    customer = np.repeat(np.arange(customers), repeat_purchases)
+    gaps = rng.exponential(1 / np.repeat(purchase_rate, repeat_purchases))
+    # A gap longer than the customer's age ends up outside the period anyway, capping
+    # it keeps the cumulative sum small enough to subtract without losing days
+    gaps = np.minimum(gaps, np.repeat(age, repeat_purchases))
+    elapsed = np.cumsum(gaps)
+    offsets = np.repeat(np.cumsum(repeat_purchases) - repeat_purchases, repeat_purchases)
+    elapsed -= np.concatenate([[0], elapsed])[offsets]
+    within_period = elapsed < np.repeat(age, repeat_purchases)
+
+    customer = np.concatenate([np.arange(customers), customer[within_period]])
+    day = np.concatenate([first_day,
+                          first_day[customer[customers:]] + np.floor(elapsed[within_period]).astype('int64')])
+    order_value = rng.gamma(p, 1 / spend_rate[customer]).round(2)
+
+    training_df = pd.DataFrame({
+        'userId': pd.Series(customer).map('u{:09d}'.format),
+        'order_date': start_date + pd.to_timedelta(day, unit='D'),
+        'order_value': order_value})
+    training_df = training_df.sort_values(['userId', 'order_date'], ignore_index=True)
+    actual_customer_value_df = training_df.groupby('userId')['order_value'].sum() \
+        .rename('current_total_revenue').to_frame()
+    return (training_df, actual_customer_value_df)
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import pandas as pd
+import benchmark_baseline
+
+FUNCTION_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules of the function are imported by name, as Cloud Functions does
+sys.path.insert(0, FUNCTION_FOLDER)
+
+import btyd_scoring
+import gcs_transfer
+import main
+import quantile_sketch
+import synthetic_data
+# Imported by the transfers where they are used, even to the local stand-in for GCS. Imported before the
+# cases fork, so the transfer cases measure their own work whichever case runs first, import_main times imports
+import google.cloud.storage.retry  # noqa: F401
+
+# Set variables
+logger = logging.getLogger(__name__)
+SEED = 0
+# Customers of the cases, and new interpreters of the import case. The baseline covers these sizes.
+# 10M customers is opt-in, with run --sizes 10000000 on a machine with more than the 6 GB of memory
+# the baseline was made on
+CUSTOMER_SIZES = [10000, 1000000]
+IMPORT_SIZES = [1]
+# Baseline committed with the suite, compare uses it when no baseline is given
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_suite_baseline.json')
+# Parameters of the models predict_value and the export are timed with, so they do not depend on a fit
+FITTER_PARAMS = {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}
+GGF_PARAMS = {'p': 6.0, 'q': 4.0, 'v': 15.0}
+PARETO_PARAMS = {'r': 0.55, 'alpha': 10.6, 's': 0.6, 'beta': 12.0}
+# Memory the out of core transform may use for pages and partitions, smaller than the transactions
+# from 100K customers on. The actual values and the summaries kept in memory count against its budget
+# too, about three times the actual values
+OUT_OF_CORE_WORKING_MEMORY_MB = 128
+OUT_OF_CORE_KEPT_FACTOR = 3
+_inputs = {}
+
+
+class LocalBigQuery(object):
+    """In-process stand-in for the google.cloud.bigquery module used by main.
+    Load jobs read the file from the local stand-in for GCS into a table
+    kept in memory, queries do nothing.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        local_bigquery = self
+
+        class Client(object):
+
+            def load_table_from_uri(self, blob_link, table_id, job_config=None):
+                (bucket_name, blob_name) = blob_link[len('gs://'):].split('/', 1)
+                file_path = os.path.join(main.GCS_LOCAL_ROOT, bucket_name, blob_name)
+                if blob_link.endswith('.parquet'):
+                    local_bigquery.tables[table_id] = pd.read_parquet(file_path)
+                else:
+                    local_bigquery.tables[table_id] = pd.read_csv(file_path)
+                return LocalBigQuery.Job()
+
+            def get_table(self, table_id):
+                return LocalBigQuery.Job(num_rows=len(local_bigquery.tables[table_id]))
+
+            def query(self, query, job_config=None):
+                return LocalBigQuery.Job()
+
+        self.Client = Client
+
+    class Job(object):
+
+        def __init__(self, num_rows=None):
+            self.num_rows = num_rows
+
+        def result(self):
+            return self
+
+    class LoadJobConfig(object):
+
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+    class QueryJobConfig(LoadJobConfig):
+        pass
+
+    class WriteDisposition(object):
+        WRITE_TRUNCATE = 'WRITE_TRUNCATE'
+
+    class SourceFormat(object):
+        CSV = 'CSV'
+        PARQUET = 'PARQUET'
+
+    @staticmethod
+    def ScalarQueryParameter(name, kind, value):
+        return (name, kind, value)
+
+    @classmethod
+    def install(cls):
+        """Replace google.cloud.bigquery, which main imports where it is used, with a new stand-in."""
+        import google.cloud
+        local_bigquery = cls()
+        sys.modules['google.cloud.bigquery'] = local_bigquery
+        google.cloud.bigquery = local_bigquery
+        return local_bigquery
+
+
+def inputs(size):
+    """Synthetic transactions and RFM summary of size customers.
+    Made once per size before the cases fork, so every case shares them.
+    """
+    if _inputs.get('size') != size:
+        _inputs.clear()
+        (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(size, SEED)
+        (summary, actual_df) = main.transform_data(training_df, actual_customer_value_df, 'M')
+        _inputs.update(size=size,
+                       training_df=training_df,
+                       actual_customer_value_df=actual_customer_value_df,
+                       summary=summary,
+                       actual_df=actual_df)
+    return _inputs
+
+
+def _checked(result, name):
+    """Result of a function of main, which logs its errors and returns None."""
+    if result is None:
+        raise RuntimeError('{} failed, see the log'.format(name))
+    return result
+
+
+def _periods():
+    """Prediction periods of run_btyd for monthly summaries."""
+    clv_months = main.PREDICTION_LENGTH_IN_MONTHS
+    time_months = sorted(set(main.PREDICTION_HORIZONS_IN_MONTHS or []) | {clv_months})
+    return (time_months, time_months, clv_months)
+
+
+def transform_data_case(size):
+    data = inputs(size)
+
+    def case():
+        (summary, _) = _checked(main.transform_data(data['training_df'], data['actual_customer_value_df'], 'M'),
+                                'transform_data')
+        return {'transactions': len(data['training_df']), 'customers': len(summary)}
+    return case
+
+
+def transform_data_out_of_core_case(size):
+    """Case that transforms the transactions, read in pages like from BigQuery, within a budget of
+    the data kept in memory and OUT_OF_CORE_WORKING_MEMORY_MB.
+    """
+    import out_of_core
+    data = inputs(size)
+    memory_budget_bytes = OUT_OF_CORE_KEPT_FACTOR * out_of_core.resident_bytes([data['actual_customer_value_df']]) \
+        + OUT_OF_CORE_WORKING_MEMORY_MB * 1024 ** 2
+    page_size = out_of_core.page_size(memory_budget_bytes)
+
+    def case():
+        training_df = data['training_df']
+        pages = (training_df.iloc[start:start + page_size] for start in range(0, len(training_df), page_size))
+        spill_folder = tempfile.mkdtemp(dir=os.path.dirname(main.GCS_LOCAL_ROOT)) + '/'
+        (summary, _) = _checked(out_of_core.transform_data_out_of_core(pages, len(training_df),
+                                                                       data['actual_customer_value_df'], 'M',
+                                                                       memory_budget_bytes, spill_folder),
+                                'transform_data_out_of_core')
+        return {'transactions': len(training_df), 'customers': len(summary),
+                'memory_budget_mb': round(memory_budget_bytes / 1024 ** 2, 1)}
+    return case
+
+
+def fit_case(function_name):
+    """Case that fits the model of a function of main on the summary."""
+    def make_case(size):
+        summary = inputs(size)['summary']
+
+        def case():
+            _checked(getattr(main, function_name)(summary, main.PENALIZER_COEF), function_name)
+            return {'customers': len(summary)}
+        return case
+    return make_case
+
+
+def predict_value_case(fitter_class, fitter_params):
+    """Case that scores every customer with a model of the parameters."""
+    def make_case(size):
+        data = inputs(size)
+        (t, time_months, clv_months) = _periods()
+
+        def case():
+            model_output = _checked(main.predict_value(data['summary'], data['actual_df'].copy(),
+                                                       fitter_class(fitter_params),
+                                                       btyd_scoring.GammaGammaModel(GGF_PARAMS),
+                                                       t, time_months, main.DISCOUNT_RATE, 'M', None, clv_months),
+                                    'predict_value')
+            return {'rows': len(model_output)}
+        return case
+    return make_case
+
+
+def predict_value_per_horizon_case(size):
+    """Case that runs predict_value once per horizon, what the single pass of predict_value replaced."""
+    data = inputs(size)
+    (_, time_months, _) = _periods()
+
+    def case():
+        fitter = btyd_scoring.BetaGeoModel(FITTER_PARAMS)
+        ggf = btyd_scoring.GammaGammaModel(GGF_PARAMS)
+        for months in time_months:
+            # Monthly summaries, so a horizon in months is also its t
+            _checked(main.predict_value(data['summary'], data['actual_df'].copy(), fitter, ggf, months, months,
+                                        main.DISCOUNT_RATE, 'M', None, months),
+                     'predict_value')
+        return {'horizons': len(time_months)}
+    return case
+
+
+def predictions_csv(size):
+    """Local CSV file of the predictions of size customers, written once per size."""
+    data = inputs(size)
+    if 'predictions_csv' not in data:
+        (t, time_months, clv_months) = _periods()
+        model_output = _checked(main.predict_value(data['summary'], data['actual_df'].copy(),
+                                                   btyd_scoring.BetaGeoModel(FITTER_PARAMS),
+                                                   btyd_scoring.GammaGammaModel(GGF_PARAMS),
+                                                   t, time_months, main.DISCOUNT_RATE, 'M', None, clv_months),
+                                'predict_value')
+        data['predictions_csv'] = os.path.join(os.path.dirname(main.GCS_LOCAL_ROOT),
+                                               'predictions_{}.csv'.format(size))
+        model_output.to_csv(data['predictions_csv'], encoding='utf-8', index=False)
+    return data['predictions_csv']
+
+
+def upload_blob_case(size):
+    """Case that uploads the predictions CSV in chunks, compressed with TRANSFER_COMPRESSION."""
+    csv_file_path = predictions_csv(size)
+    blob_name = gcs_transfer.compressed_name('upload_{}.csv'.format(size), main.TRANSFER_COMPRESSION)
+
+    def case():
+        _checked(main.upload_blob('transfers', csv_file_path, blob_name, main.TRANSFER_COMPRESSION), 'upload_blob')
+        return {'file_bytes': os.path.getsize(csv_file_path),
+                'bytes': gcs_transfer.blob_size(gcs_transfer.storage_client(main.GCS_LOCAL_ROOT),
+                                                'gs://transfers/' + blob_name)}
+    return case
+
+
+def download_blob_case(size):
+    """Case that downloads and decompresses the predictions CSV uploaded before the fork."""
+    csv_file_path = predictions_csv(size)
+    blob_name = gcs_transfer.compressed_name('download_{}.csv'.format(size), main.TRANSFER_COMPRESSION)
+    _checked(main.upload_blob('transfers', csv_file_path, blob_name, main.TRANSFER_COMPRESSION), 'upload_blob')
+
+    def case():
+        local_storage_folder = tempfile.mkdtemp(dir=os.path.dirname(main.GCS_LOCAL_ROOT)) + '/'
+        main.download_blob('transfers', blob_name, 'predictions.csv', local_storage_folder,
+                           main.TRANSFER_COMPRESSION)
+        # download_blob logs its errors and returns nothing
+        if os.path.getsize(local_storage_folder + 'predictions.csv') != os.path.getsize(csv_file_path):
+            raise IOError('The downloaded predictions differ from the uploaded file')
+        return {'file_bytes': os.path.getsize(csv_file_path)}
+    return case
+
+
+def export_case(stream):
+    """Case that scores, writes, uploads and publishes the predictions like run_btyd.
+    GCS is the local stand-in of gcs_transfer and BigQuery is LocalBigQuery.
+    """
+    def make_case(size):
+        data = inputs(size)
+        (t, time_months, clv_months) = _periods()
+
+        def case():
+            local_storage_folder = tempfile.mkdtemp(dir=os.path.dirname(main.GCS_LOCAL_ROOT)) + '/'
+            local_bigquery = LocalBigQuery.install()
+            fitter = btyd_scoring.BetaGeoModel(FITTER_PARAMS)
+            ggf = btyd_scoring.GammaGammaModel(GGF_PARAMS)
+            sketch = quantile_sketch.KLLSketch()
+            if stream:
+                output_chunks = main.predict_value_in_chunks(data['summary'], data['actual_df'], fitter, ggf,
+                                                             t, time_months, main.DISCOUNT_RATE, 'M', None,
+                                                             clv_months, main.STREAM_EXPORT_CHUNK_SIZE)
+                blob_link = main.stream_predictions_to_gcs(sketch.track(output_chunks, 'clv'),
+                                                           'predictions', 'predictions.parquet')
+            else:
+                model_output = _checked(main.predict_value(data['summary'], data['actual_df'].copy(), fitter, ggf,
+                                                           t, time_months, main.DISCOUNT_RATE, 'M', None,
+                                                           clv_months),
+                                        'predict_value')
+                sketch.update(model_output['clv'])
+                blob_link = main.upload_predictions_to_gcs(model_output, 'predictions',
+                                                           local_storage_folder, 'predictions.csv')
+            _checked(main.publish_predictions(_checked(blob_link, 'upload'),
+                                              main.UPDATE_BIGQUERY_RESULT_TABLE,
+                                              'ml_models_production.new_predictions',
+                                              None,
+                                              quantile_sketch.clv_thresholds(sketch)),
+                     'publish_predictions')
+            return {'rows': len(local_bigquery.tables['ml_models_production.new_predictions']),
+                    'bytes': gcs_transfer.blob_size(gcs_transfer.storage_client(main.GCS_LOCAL_ROOT), blob_link)}
+        return case
+    return make_case
+
+
+def import_main_case(size):
+    """Case that imports main in size new interpreters, the import of a cold start."""
+    def case():
+        for _ in range(size):
+            subprocess.run([sys.executable, '-c', 'import main'], cwd=FUNCTION_FOLDER, check=True)
+        return {'imports': size}
+    return case
+
+
+CASES = {'transform_data': transform_data_case,
+         'transform_data_out_of_core': transform_data_out_of_core_case,
+         'bgnbd_model': fit_case('bgnbd_model'),
+         'paretonbd_model': fit_case('paretonbd_model'),
+         'gammagamma_model': fit_case('gammagamma_model'),
+         'predict_value': predict_value_case(btyd_scoring.BetaGeoModel, FITTER_PARAMS),
+         'predict_value_pareto': predict_value_case(btyd_scoring.ParetoNBDModel, PARETO_PARAMS),
+         'predict_value_per_horizon': predict_value_per_horizon_case,
+         'upload_blob': upload_blob_case,
+         'download_blob': download_blob_case,
+         'export_batch': export_case(False),
+         'export_stream': export_case(True),
+         'import_main': import_main_case}
+DEFAULT_SIZES = dict({name: CUSTOMER_SIZES for name in CASES}, import_main=IMPORT_SIZES)
+
+
+if __name__ == '__main__':
+    # The config names the SQL files relative to the function folder
+    os.chdir(FUNCTION_FOLDER)
+    root = tempfile.mkdtemp(prefix='benchmark_suite_')
+    try:
+        main.GCS_LOCAL_ROOT = os.path.join(root, 'buckets')
+        exit_code = benchmark_baseline.command_line(
+            'weekly', CASES, DEFAULT_SIZES,
+            'Time the functions of the weekly pipeline on seeded synthetic customers and compare them with a baseline.',
+            BASELINE_FILE)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    sys.exit(exit_code)
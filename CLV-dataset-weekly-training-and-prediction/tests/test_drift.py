@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+import copy
+import numpy as np
+import pytest
+import btyd_scoring
+import drift
+import main
+import synthetic_data
+
+FITTER_PARAMS = {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}
+GGF_PARAMS = {'p': 6.0, 'q': 4.0, 'v': 15.0}
+SETTINGS = ('BGNBD', 'M', 0.0)
+
+
+def summary_of(seed):
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(5000, seed)
+    return main.transform_data(training_df, actual_customer_value_df, 'M')[0]
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    return drift.build_baseline(summary_of(0), btyd_scoring.BetaGeoModel(FITTER_PARAMS),
+                                btyd_scoring.GammaGammaModel(GGF_PARAMS), *SETTINGS,
+                                'fitter.pkl', 'ggf.pkl', 1.0)
+
+
+@pytest.fixture(scope='module')
+def new_summary():
+    # Customers drawn from the same distribution as the baseline
+    return summary_of(1)
+
+
+def created(baseline):
+    return datetime.strptime(baseline['created'], '%Y-%m-%d')
+
+
+def test_population_stability_index():
+    assert drift.population_stability_index([0.5, 0.5], [0.5, 0.5]) == 0
+    assert drift.population_stability_index([0.5, 0.5], [0.25, 0.75]) == pytest.approx(0.25 * np.log(3))
+    # Empty bins are floored, so the index stays finite
+    assert np.isfinite(drift.population_stability_index([1.0, 0.0], [0.0, 1.0]))
+
+
+def test_log_likelihood_drop_and_its_standard_error():
+    (drop, standard_error) = drift.log_likelihood_drop({'mean': -2.0, 'std': 3.0, 'customers': 100},
+                                                       {'mean': -2.5, 'std': 4.0, 'customers': 100})
+
+    assert drop == pytest.approx(0.5)
+    assert standard_error == pytest.approx(0.5)
+
+
+def test_same_customer_base_is_not_refit(baseline, new_summary):
+    (refit, report) = drift.check_drift(baseline, new_summary, *SETTINGS, today=created(baseline))
+
+    assert not refit
+    assert report['reasons'] == []
+    assert max(report['psi'].values()) <= 0.1
+    assert set(report['log_likelihood_drop']) == {'fitter', 'ggf'}
+
+
+@pytest.mark.parametrize('settings,changed', [(('PARETO', 'M', 0.0), 'model_type'),
+                                              (('BGNBD', 'W', 0.0), 'frequency'),
+                                              (('BGNBD', 'M', 0.01), 'penalizer_coef')])
+def test_changed_settings_refit(baseline, new_summary, settings, changed):
+    (refit, report) = drift.check_drift(baseline, new_summary, *settings, today=created(baseline))
+
+    assert refit
+    assert report['reasons'] == ['settings changed: {}'.format(changed)]
+    # The saved models do not describe the new settings, so their log-likelihood is not compared
+    assert 'log_likelihood_drop' not in report
+
+
+def test_old_models_refit(baseline, new_summary):
+    today = created(baseline) + timedelta(days=29)
+
+    (refit, report) = drift.check_drift(baseline, new_summary, *SETTINGS, max_model_age_days=28, today=today)
+    assert refit
+    assert report['reasons'] == ['model is 29 days old']
+    assert not drift.check_drift(baseline, new_summary, *SETTINGS, max_model_age_days=None, today=today)[0]
+
+
+def test_histogram_drift_over_the_threshold_refits(baseline, new_summary):
+    summary = new_summary.copy()
+    summary['T'] = summary['T'] * 2
+
+    (refit, report) = drift.check_drift(baseline, summary, *SETTINGS, today=created(baseline))
+
+    assert refit
+    assert report['psi']['T'] > 0.1
+    assert 'histogram drift in T' in report['reasons']
+
+
+def test_log_likelihood_drop_beyond_its_standard_errors_refits(baseline, new_summary):
+    worse_baseline = copy.deepcopy(baseline)
+    worse_baseline['log_likelihood']['ggf']['mean'] += 1.0
+
+    (refit, report) = drift.check_drift(worse_baseline, new_summary, *SETTINGS, today=created(baseline))
+
+    assert refit
+    assert report['reasons'] == ['log-likelihood dropped for ggf']
+    assert report['log_likelihood_drop']['ggf']['drop'] > \
+        drift.LOG_LIKELIHOOD_STANDARD_ERRORS * report['log_likelihood_drop']['ggf']['standard_error']
+
+
+def test_log_likelihood_drop_within_its_standard_errors_is_not_refit(baseline, new_summary):
+    noisy_baseline = copy.deepcopy(baseline)
+    noisy_baseline['log_likelihood']['ggf']['mean'] += 1.0
+    # So few customers in the baseline that a drop of 1 is sampling noise
+    noisy_baseline['log_likelihood']['ggf']['customers'] = 10
+
+    (refit, report) = drift.check_drift(noisy_baseline, new_summary, *SETTINGS, today=created(baseline))
+
+    assert not refit
+    assert report['log_likelihood_drop']['ggf']['drop'] > 0.05
@@ -0,0 +1,33 @@
+import os
+import pandas as pd
+import btyd_scoring
+import gcs_transfer
+import main
+import synthetic_data
+
+FITTER_PARAMS = {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}
+GGF_PARAMS = {'p': 6.0, 'q': 4.0, 'v': 15.0}
+
+
+def test_streamed_predictions_match_the_batch_export(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'GCS_LOCAL_ROOT', str(tmp_path / 'buckets'))
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(5000, 0)
+    (summary, actual_df) = main.transform_data(training_df, actual_customer_value_df, 'M')
+    fitter = btyd_scoring.BetaGeoModel(FITTER_PARAMS)
+    ggf = btyd_scoring.GammaGammaModel(GGF_PARAMS)
+    time_months = [6, 12]
+
+    model_output = main.predict_value(summary, actual_df.copy(), fitter, ggf, time_months, time_months,
+                                      main.DISCOUNT_RATE, 'M', None, 12)
+    assert main.upload_predictions_to_gcs(model_output, 'predictions', str(tmp_path) + '/', 'predictions.csv')
+    # Chunks smaller than the customers, so the file has several row groups
+    output_chunks = main.predict_value_in_chunks(summary, actual_df, fitter, ggf, time_months, time_months,
+                                                 main.DISCOUNT_RATE, 'M', None, 12, 1000)
+    assert main.stream_predictions_to_gcs(output_chunks, 'predictions', 'predictions.parquet')
+
+    bucket_folder = os.path.join(main.GCS_LOCAL_ROOT, 'predictions')
+    batch_output = pd.read_csv(os.path.join(bucket_folder, gcs_transfer.compressed_name('predictions.csv',
+                                                                                        main.TRANSFER_COMPRESSION)))
+    stream_output = pd.read_parquet(os.path.join(bucket_folder, 'predictions.parquet'))
+    assert len(stream_output) == len(summary) > 1000
+    pd.testing.assert_frame_equal(batch_output, stream_output, check_dtype=False)
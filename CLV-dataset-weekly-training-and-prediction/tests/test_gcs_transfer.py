@@ -0,0 +1,87 @@
+import hashlib
+import os
+import random
+import pytest
+import gcs_transfer
+
+KB = 1024
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as source_file:
+        for block in iter(lambda: source_file.read(gcs_transfer.READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write(path, size, seed=0):
+    """Write a predictions-like CSV file of about size bytes and return its digest."""
+    rng = random.Random(seed)
+    with open(path, 'w') as sample_file:
+        sample_file.write('userId,clv,churn_probability,current_total_revenue\n')
+        written = 0
+        while written < size:
+            line = 'u{:09d},{:.2f},{:.4f},{:.2f}\n'.format(
+                rng.randrange(10 ** 9), rng.uniform(0, 5000), rng.random(), rng.uniform(0, 5000))
+            sample_file.write(line)
+            written += len(line)
+    return file_digest(path)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+@pytest.mark.parametrize('size', [100 * KB, gcs_transfer.SINGLE_REQUEST_SIZE + 100 * KB])
+def test_upload_and_download_round_trip(tmp_path, compression, size):
+    client = gcs_transfer.LocalStorageClient(str(tmp_path / 'buckets'))
+    digest = _write(str(tmp_path / 'predictions.csv'), size)
+    blob_name = gcs_transfer.compressed_name('predictions.csv', compression)
+
+    result = gcs_transfer.upload_file(client, 'bucket', str(tmp_path / 'predictions.csv'), blob_name,
+                                      1024 * KB, compression)
+    if size <= gcs_transfer.SINGLE_REQUEST_SIZE:
+        assert client.requests == 1
+    else:
+        assert client.requests == -(-result['bytes'] // (1024 * KB))
+    assert gcs_transfer.blob_size(client, result['blob']) == result['bytes']
+
+    gcs_transfer.download_file(client, 'bucket', blob_name, str(tmp_path / 'downloaded.csv'),
+                               1024 * KB, compression)
+    assert file_digest(str(tmp_path / 'downloaded.csv')) == digest
+    assert not os.path.exists(str(tmp_path / 'downloaded.csv.part'))
+    # Nothing is left next to the source file to resume from
+    assert sorted(os.listdir(str(tmp_path))) == ['buckets', 'downloaded.csv', 'predictions.csv']
+
+
+def test_transient_failures_are_retried(tmp_path):
+    client = gcs_transfer.LocalStorageClient(str(tmp_path / 'buckets'), failure_rate=0.2, seed=3)
+    digest = _write(str(tmp_path / 'predictions.csv'), 2048 * KB)
+
+    gcs_transfer.upload_file(client, 'bucket', str(tmp_path / 'predictions.csv'), 'predictions.csv',
+                             256 * KB, None, retry_seconds=30)
+    gcs_transfer.download_file(client, 'bucket', 'predictions.csv', str(tmp_path / 'downloaded.csv'),
+                               256 * KB, None, retry_seconds=30)
+    assert file_digest(str(tmp_path / 'downloaded.csv')) == digest
+    # The upload fits in a single request, the download takes a reload and 9 chunks, the rest failed
+    assert client.requests > 1 + 1 + 9
+
+
+def test_upload_stream_only_creates_the_blob_when_complete(tmp_path):
+    client = gcs_transfer.LocalStorageClient(str(tmp_path / 'buckets'))
+    blob = client.bucket('bucket').blob('predictions.parquet')
+
+    with pytest.raises(KeyError):
+        with gcs_transfer.open_upload_stream(client, 'bucket', 'predictions.parquet', 256 * KB) as stream:
+            stream.write(b'x' * 600 * KB)
+            raise KeyError('scoring failed')
+    assert not blob.exists()
+
+    with gcs_transfer.open_upload_stream(client, 'bucket', 'predictions.parquet', 256 * KB) as stream:
+        stream.write(b'x' * 600 * KB)
+        stream.terminate()
+    assert not blob.exists()
+
+    client.requests = 0
+    with gcs_transfer.open_upload_stream(client, 'bucket', 'predictions.parquet', 256 * KB) as stream:
+        stream.write(b'x' * 600 * KB)
+    assert client.requests == 3
+    assert blob.download_as_bytes() == b'x' * 600 * KB
@@ -0,0 +1,80 @@
+import re
+import numpy as np
+import pandas as pd
+import pytest
+from lifetimes import BetaGeoFitter, GammaGammaFitter
+import btyd_scoring
+import main
+import synthetic_data
+
+FITTER_PARAMS = {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}
+GGF_PARAMS = {'p': 6.0, 'q': 4.0, 'v': 15.0}
+
+
+@pytest.fixture(scope='module')
+def customers():
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(5000, 0)
+    return main.transform_data(training_df, actual_customer_value_df, 'M')
+
+
+def test_multi_horizon_pass_matches_a_pass_per_horizon(customers):
+    (summary, actual_df) = customers
+    horizons = [1, 3, 6, 12]
+    fitter = btyd_scoring.BetaGeoModel(FITTER_PARAMS)
+    ggf = btyd_scoring.GammaGammaModel(GGF_PARAMS)
+
+    # Monthly summaries, so a horizon in months is also its t
+    multi_output = main.predict_value(summary, actual_df.copy(), fitter, ggf, horizons, horizons,
+                                      main.DISCOUNT_RATE, 'M', None, 6)
+
+    for months in horizons:
+        single_output = main.predict_value(summary, actual_df.copy(), fitter, ggf, months, months,
+                                           main.DISCOUNT_RATE, 'M', None, months)
+        column = 'predicted_value_next_{}_month'.format(months)
+        np.testing.assert_allclose(multi_output[column], single_output[column], rtol=1e-9)
+        if months == 6:
+            np.testing.assert_allclose(multi_output['clv'], single_output['clv'], rtol=1e-9)
+    np.testing.assert_allclose(multi_output['churn_probability'], single_output['churn_probability'])
+
+
+@pytest.mark.parametrize('frequency,periods_per_month', [('D', 30), ('W', 4.345), ('M', 1)])
+def test_predicted_values_match_the_lifetimes_clv(frequency, periods_per_month):
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(2000, 0)
+    (summary, _) = main.transform_data(training_df, actual_customer_value_df, frequency)
+    # The lifetimes fitters with the parameters of the models, so both score with the same fitter
+    fitter = BetaGeoFitter()
+    fitter.params_ = pd.Series(FITTER_PARAMS)
+    # fit sets the predict alias the lifetimes clv uses
+    fitter.predict = fitter.conditional_expected_number_of_purchases_up_to_time
+    ggf = GammaGammaFitter()
+    ggf.params_ = pd.Series(GGF_PARAMS)
+    time_months = main.PREDICTION_HORIZONS_IN_MONTHS
+    t = [months * periods_per_month for months in time_months]
+
+    scores = main.score_customers(summary, fitter, ggf, t, time_months, main.DISCOUNT_RATE, frequency)
+
+    for months in time_months:
+        lifetimes_clv = ggf.customer_lifetime_value(fitter, summary['frequency'], summary['recency'], summary['T'],
+                                                    summary['monetary_value'], time=months,
+                                                    discount_rate=main.DISCOUNT_RATE, freq=frequency)
+        np.testing.assert_allclose(scores['predicted_value_{}'.format(months)], lifetimes_clv, rtol=1e-9)
+
+
+@pytest.mark.parametrize('time_months', [None, [6], [1, 6, 24]])
+def test_update_query_has_a_column_for_each_horizon(time_months):
+    query = main.update_query(main.UPDATE_BIGQUERY_RESULT_TABLE, time_months)
+
+    if time_months is None:
+        time_months = set(main.PREDICTION_HORIZONS_IN_MONTHS) | {main.PREDICTION_LENGTH_IN_MONTHS}
+    assert set(int(months) for months in re.findall(r'predicted_value_next_(\d+)_month', query)) == set(time_months)
+    assert '$' not in query
+
+
+@pytest.mark.parametrize('clv_thresholds', [None, {'p25': 1.0, 'p50': 2.0, 'p75': 3.0}])
+def test_update_query_sets_the_clv_thresholds(clv_thresholds):
+    query = main.update_query(main.UPDATE_BIGQUERY_RESULT_TABLE, None, clv_thresholds)
+
+    # Without a sketch the thresholds are computed in the query
+    assert ('APPROX_QUANTILES(clv, 100)' in query) == (clv_thresholds is None)
+    assert ('SELECT @p25 AS p25, @p50 AS p50, @p75 AS p75' in query) == (clv_thresholds is not None)
+    assert '$' not in query
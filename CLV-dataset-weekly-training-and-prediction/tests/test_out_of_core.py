@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import pandas as pd
+import pyarrow
+import pyarrow.parquet as pq
+import pytest
+import out_of_core
+import synthetic_data
+
+# Customers generated at a time, the transactions of a batch are the most the test holds
+BATCH_CUSTOMERS = 20000
+# Customers who buy often, so the transactions outweigh the summaries
+FREQUENT_BUYERS = {'alpha': 2.0, 'a': 0.2, 'b': 5.0}
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'),
+                                reason='Peak memory is read from /proc')
+
+
+def _status_mb(field):
+    """Field of /proc/self/status in MB."""
+    with open('/proc/self/status', 'r') as status_file:
+        for line in status_file:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+
+
+def write_transactions(customers, folder, buyers):
+    """Write seeded synthetic transactions and actual values to Parquet files a batch at a time.
+    Returns:
+        transactions_path, actual_path, total_rows, memory of the transactions in a dataframe in MB
+    """
+    transactions_path = os.path.join(folder, 'transactions.parquet')
+    actual_path = os.path.join(folder, 'actual.parquet')
+    total_rows = 0
+    transactions_bytes = 0
+    actual_customer_value_dfs = []
+    writer = None
+    for (batch, first_customer) in enumerate(range(0, customers, BATCH_CUSTOMERS)):
+        (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(
+            min(BATCH_CUSTOMERS, customers - first_customer), batch, **buyers)
+        prefix = 'b{:05d}'.format(batch)
+        training_df['userId'] = prefix + training_df['userId']
+        actual_customer_value_df.index = prefix + actual_customer_value_df.index
+        table = pyarrow.Table.from_pandas(training_df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(transactions_path, table.schema)
+        writer.write_table(table)
+        total_rows += len(training_df)
+        transactions_bytes += training_df.memory_usage(deep=True, index=False).sum()
+        actual_customer_value_dfs.append(actual_customer_value_df)
+    writer.close()
+    pd.concat(actual_customer_value_dfs).to_parquet(actual_path)
+    return (transactions_path, actual_path, total_rows, transactions_bytes / 1024 ** 2)
+
+
+def warm_up(folder):
+    """Load what the first Parquet read and summary load lazily, these are not part of the budget."""
+    path = os.path.join(folder, 'warm_up.parquet')
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(10)
+    actual_customer_value_df.to_parquet(path)
+    pd.read_parquet(path)
+    out_of_core.utils.summary_data_from_transaction_data(
+        training_df, 'userId', 'order_date', monetary_value_col='order_value', freq='M')
+
+
+def transform(transactions_path, actual_path, total_rows, memory_budget_mb, spill_folder, results):
+    """Load and transform the transactions out of core in a new interpreter and report its memory.
+    Everything the transform holds counts: the actual values, the pages,
+    the partitions and the summaries it returns. The actual values are
+    loaded before the transform, as load_data_from_bq_in_chunks does, so
+    they count with the memory of the dataframe and not with what reading
+    the file left behind.
+    """
+    warm_up(os.path.dirname(spill_folder))
+    memory_budget_bytes = memory_budget_mb * 1024 ** 2
+    actual_customer_value_df = pd.read_parquet(actual_path)
+    actual_mb = actual_customer_value_df.memory_usage(deep=True).sum() / 1024 ** 2
+    with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+        clear_refs_file.write('5')
+    start_mb = _status_mb('VmRSS') - actual_mb
+    pages = (batch.to_pandas() for batch in pq.ParquetFile(transactions_path).iter_batches(
+        batch_size=out_of_core.page_size(memory_budget_bytes)))
+    (summary, actual_df) = out_of_core.transform_data_out_of_core(
+        pages, total_rows, actual_customer_value_df, 'M', memory_budget_bytes, spill_folder)
+    results.put({'rss_growth_mb': _status_mb('VmHWM') - start_mb,
+                 'summary_customers': len(summary),
+                 'actual_customers': len(actual_df)})
+
+
+@pytest.mark.parametrize('customers,memory_budget_mb,buyers', [(20000, 32, FREQUENT_BUYERS),
+                                                               (100000, 32, {}),
+                                                               (50000, 64, FREQUENT_BUYERS),
+                                                               (100000, 128, FREQUENT_BUYERS)])
+def test_transform_stays_within_memory_budget(tmp_path, customers, memory_budget_mb, buyers):
+    (transactions_path, actual_path, total_rows, transactions_mb) = write_transactions(customers, str(tmp_path), buyers)
+    assert transactions_mb > memory_budget_mb
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=transform,
+                              args=(transactions_path, actual_path, total_rows, memory_budget_mb,
+                                    str(tmp_path / 'spill'), results))
+    process.start()
+    run = results.get(timeout=600)
+    process.join()
+
+    assert run['summary_customers'] > 0
+    assert run['actual_customers'] == run['summary_customers']
+    assert run['rss_growth_mb'] < memory_budget_mb, run
+
+
+def test_transform_matches_in_memory_transform(tmp_path):
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(5000, 0)
+    expected = out_of_core.utils.summary_data_from_transaction_data(
+        training_df, 'userId', 'order_date', monetary_value_col='order_value', freq='M')
+    expected = expected[(expected['monetary_value'] > 0) & (expected['frequency'] > 0)]
+    pages = (training_df.iloc[start:start + 1000] for start in range(0, len(training_df), 1000))
+    # Files of others in the spill folder are left alone
+    (tmp_path / 'spill').mkdir()
+    (tmp_path / 'spill' / 'other.parquet').write_bytes(b'')
+
+    (summary, actual_df) = out_of_core.transform_data_out_of_core(
+        pages, len(training_df), actual_customer_value_df, 'M', 2 * 1024 ** 2, str(tmp_path / 'spill'))
+
+    pd.testing.assert_frame_equal(summary.sort_index(), expected.sort_index(), check_names=False)
+    assert len(actual_df) == len(expected)
+    assert os.listdir(str(tmp_path / 'spill')) == ['other.parquet']
+
+
+def test_transform_fails_when_the_summaries_exceed_the_budget(tmp_path):
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(5000, 0)
+    pages = (training_df.iloc[start:start + 1000] for start in range(0, len(training_df), 1000))
+
+    assert out_of_core.transform_data_out_of_core(
+        pages, len(training_df), actual_customer_value_df, 'M', 1024 ** 2, str(tmp_path / 'spill')) is None
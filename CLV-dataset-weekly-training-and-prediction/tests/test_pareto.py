@@ -0,0 +1,101 @@
+import itertools
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from lifetimes import ParetoNBDFitter
+import btyd_scoring
+import main
+import pareto_nbd
+import synthetic_data
+
+# Largest relative differences allowed with lifetimes on ordinary customers
+PARAMS_TOLERANCE = 1e-3
+SCORES_TOLERANCE = 1e-6
+MONTHS = 12
+
+
+def extreme_customers():
+    """Customers and parameters on which the hypergeometric function of lifetimes breaks down.
+    Returns:
+        List of (params, frequency, recency, T) with up to a million purchases,
+        recency from 0 to T and alpha and beta far apart
+    """
+    cases = []
+    for (r, alpha, s, beta) in itertools.product([0.05, 1.0, 5.0], [1e-3, 10.0, 1e5],
+                                                 [0.05, 1.0, 5.0], [1e-3, 10.0, 1e5]):
+        (frequency, T, share) = np.meshgrid([0.0, 1.0, 10.0, 1e3, 1e4, 1e6], [1e-3, 1.0, 100.0, 1e4],
+                                            [0.0, 0.5, 0.99, 0.9999, 1.0])
+        recency = T * share
+        frequency = np.where(recency > 0, frequency, 0)
+        cases.append(({'r': r, 'alpha': alpha, 's': s, 'beta': beta},
+                      frequency.ravel(), recency.ravel(), T.ravel()))
+    return cases
+
+
+def scores(fitter, summary, months):
+    """p_alive and the expected purchases for every month up to months."""
+    frequency = summary['frequency'].to_numpy()
+    recency = summary['recency'].to_numpy()
+    T = summary['T'].to_numpy()
+    return [np.asarray(fitter.conditional_probability_alive(frequency, recency, T))] \
+        + [np.asarray(fitter.conditional_expected_number_of_purchases_up_to_time(month, frequency, recency, T))
+           for month in range(1, months + 1)]
+
+
+@pytest.fixture(scope='module')
+def summary():
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(5000, 0)
+    return main.transform_data(training_df, actual_customer_value_df, 'M')[0]
+
+
+@pytest.fixture(scope='module')
+def lifetimes_fitter(summary):
+    fitter = ParetoNBDFitter(penalizer_coef=main.PENALIZER_COEF)
+    fitter.fit(summary['frequency'], summary['recency'], summary['T'])
+    return fitter
+
+
+def test_fit_matches_lifetimes(summary, lifetimes_fitter):
+    fitter = pareto_nbd.fit(summary['frequency'], summary['recency'], summary['T'], main.PENALIZER_COEF)
+
+    assert np.max(np.abs(fitter.params_ / lifetimes_fitter.params_ - 1)) < PARAMS_TOLERANCE
+    np.testing.assert_allclose(fitter._negative_log_likelihood_, lifetimes_fitter._negative_log_likelihood_,
+                               rtol=PARAMS_TOLERANCE)
+
+
+def test_scores_match_lifetimes(summary, lifetimes_fitter):
+    # Score with the same parameters, so only the scoring differs
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = scores(lifetimes_fitter, summary, MONTHS)
+    actual = scores(btyd_scoring.scoring_model(lifetimes_fitter), summary, MONTHS)
+
+    for (actual_scores, expected_scores) in zip(actual, expected):
+        assert np.isfinite(actual_scores).all()
+        known = np.isfinite(expected_scores)
+        assert np.max(np.abs(actual_scores[known] - expected_scores[known])
+                      / np.maximum(expected_scores[known], 1)) < SCORES_TOLERANCE
+
+
+@pytest.mark.parametrize('params,frequency,recency,T', extreme_customers(),
+                         ids=lambda value: str(value) if isinstance(value, dict) else '')
+def test_extreme_customers_have_finite_scores(params, frequency, recency, T):
+    model = btyd_scoring.ParetoNBDModel(params)
+
+    p_alive = model.conditional_probability_alive(frequency, recency, T)
+    assert np.all((p_alive >= 0) & (p_alive <= 1))
+    assert np.isfinite(model.conditional_expected_number_of_purchases_up_to_time(MONTHS, frequency, recency, T)).all()
+    assert np.isfinite(model.log_likelihood(frequency, recency, T)).all()
+
+
+def test_lifetimes_breaks_down_on_extreme_customers():
+    # What the engine replaces, if lifetimes ever stops giving NaN this test can go
+    nan = 0
+    for (params, frequency, recency, T) in extreme_customers():
+        lifetimes_model = ParetoNBDFitter()
+        lifetimes_model.params_ = pd.Series(params)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            nan += int(np.isnan(lifetimes_model.conditional_probability_alive(frequency, recency, T)).sum())
+    assert nan > 0
@@ -0,0 +1,97 @@
+import json
+import numpy as np
+import pytest
+import quantile_sketch
+
+QUANTILES = np.linspace(0.01, 0.99, 99)
+# Rank errors of the quantiles of a sketch of DEFAULT_K, on average and at worst, see DEFAULT_K
+MEAN_RANK_ERROR = 2.0 / quantile_sketch.DEFAULT_K
+RANK_ERROR = 3.0 / quantile_sketch.DEFAULT_K
+
+
+@pytest.fixture(scope='module')
+def values():
+    # Skewed like clv, with ties like values rounded to cents
+    return np.random.default_rng(0).lognormal(3.0, 1.5, 1000000).round(2)
+
+
+def rank_errors(values, estimates, quantiles):
+    """Distance of the ranks of the estimates from the quantiles, as a share of the values."""
+    sorted_values = np.sort(values)
+    lower = np.searchsorted(sorted_values, estimates, side='left') / len(values)
+    upper = np.searchsorted(sorted_values, estimates, side='right') / len(values)
+    # Within a run of ties any rank of the run is right
+    return np.maximum(0, np.maximum(lower - quantiles, quantiles - upper))
+
+
+def test_small_sketches_are_exact():
+    values = np.random.default_rng(1).normal(size=500)
+
+    sketch = quantile_sketch.KLLSketch().update(values)
+
+    assert len(sketch) == 500
+    np.testing.assert_array_equal(sketch.quantiles([0, 0.5, 1]),
+                                  [values.min(), np.sort(values)[249], values.max()])
+
+
+def test_merged_sketches_of_split_data_stay_within_the_rank_error(values):
+    chunk_sketches = [quantile_sketch.KLLSketch(seed=chunk).update(chunk_values)
+                      for (chunk, chunk_values) in enumerate(np.array_split(values, 10))]
+    # Shards merged in a tree, like chunks of a run and runs of other days
+    merged = quantile_sketch.KLLSketch().merge(chunk_sketches[0])
+    for shard in [chunk_sketches[1:5], chunk_sketches[5:]]:
+        shard_sketch = quantile_sketch.KLLSketch(seed=len(shard))
+        for chunk_sketch in shard:
+            shard_sketch.merge(chunk_sketch)
+        merged.merge(shard_sketch)
+
+    assert len(merged) == len(values)
+    assert sum(len(level) for level in merged.levels) < 10 * quantile_sketch.DEFAULT_K
+    errors = rank_errors(values, merged.quantiles(QUANTILES), QUANTILES)
+    assert errors.mean() <= MEAN_RANK_ERROR
+    assert errors.max() <= RANK_ERROR
+    assert merged.quantiles([0, 1]).tolist() == [values.min(), values.max()]
+
+
+def test_sketches_with_another_k_are_not_merged():
+    with pytest.raises(ValueError):
+        quantile_sketch.KLLSketch(100).merge(quantile_sketch.KLLSketch(200).update([1.0]))
+
+
+def test_nan_and_inf_values_are_skipped():
+    sketch = quantile_sketch.KLLSketch().update([1.0, np.nan, np.inf, -np.inf, 3.0])
+
+    assert len(sketch) == 2
+    assert sketch.quantiles([0.5]).tolist() == [1.0]
+    assert np.isnan(quantile_sketch.KLLSketch().quantiles([0.5])).all()
+
+
+def test_sketch_round_trips_through_a_dict(values, tmp_path):
+    sketch = quantile_sketch.KLLSketch().update(values[:100000])
+
+    content = json.loads(json.dumps(sketch.to_dict()))
+    loaded = quantile_sketch.KLLSketch.from_dict(content)
+
+    assert (loaded.k, loaded.count, loaded.min, loaded.max) == (sketch.k, sketch.count, sketch.min, sketch.max)
+    assert [level.tolist() for level in loaded.levels] == [level.tolist() for level in sketch.levels]
+    np.testing.assert_array_equal(loaded.quantiles(QUANTILES), sketch.quantiles(QUANTILES))
+    quantile_sketch.save_sketch(sketch, str(tmp_path / 'sketch.json'))
+    assert quantile_sketch.load_sketch(str(tmp_path / 'sketch.json')).to_dict() == sketch.to_dict()
+    with pytest.raises(ValueError):
+        quantile_sketch.KLLSketch.from_dict(dict(content, sketch_version=quantile_sketch.SKETCH_VERSION + 1))
+
+
+def test_clv_thresholds_are_close_to_the_exact_percentiles(values):
+    sketch = quantile_sketch.KLLSketch()
+    for chunk_values in np.array_split(values, 20):
+        sketch.update(chunk_values)
+
+    thresholds = quantile_sketch.clv_thresholds(sketch)
+
+    assert list(thresholds) == ['p25', 'p50', 'p75']
+    for (name, quantile) in quantile_sketch.CLV_SEGMENT_QUANTILES.items():
+        # Bracketed by the exact percentiles one rank error either side
+        (lower, upper) = np.percentile(values, [100 * (quantile - RANK_ERROR), 100 * (quantile + RANK_ERROR)])
+        assert lower <= thresholds[name] <= upper
+        assert thresholds[name] == pytest.approx(np.percentile(values, 100 * quantile), rel=0.01)
+    assert quantile_sketch.clv_thresholds(quantile_sketch.KLLSketch()) is None
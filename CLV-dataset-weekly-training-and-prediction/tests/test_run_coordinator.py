@@ -0,0 +1,109 @@
+import threading
+import time
+from types import SimpleNamespace
+import pandas as pd
+import pytest
+import gcs_transfer
+import main
+import run_coordinator
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+    client = gcs_transfer.storage_client(str(tmp_path))
+    return run_coordinator.RunCoordinator(client, 'models', 'weekly', 'clv_runs/', lease_seconds=60,
+                                          publish_wait_seconds=5)
+
+
+def test_redelivered_event_runs_once(coordinator):
+    runs = []
+    function = lambda publish_lease, run_lease: runs.append(1) or {'status': 'ok'}
+
+    assert coordinator.run('e1', function)['status'] == 'ok'
+    assert coordinator.run('e1', function)['status'] == 'duplicate'
+    assert len(runs) == 1
+
+
+def test_busy_event_of_the_same_window_is_skipped_once_the_window_completed(coordinator):
+    runs = []
+    started = threading.Event()
+
+    def slow(publish_lease, run_lease):
+        started.set()
+        time.sleep(1)
+        runs.append('slow')
+        return {'status': 'ok'}
+
+    thread = threading.Thread(target=coordinator.run, args=('e1', slow, None, '2026-10-19'))
+    thread.start()
+    started.wait()
+    with pytest.raises(run_coordinator.RunNotCompleted) as busy:
+        coordinator.run('e2', lambda publish_lease, run_lease: runs.append('e2'), None, '2026-10-19')
+    assert busy.value.record['status'] == 'busy'
+    thread.join()
+
+    # The redelivery of the busy event finds the completed run of its window
+    record = coordinator.run('e2', lambda publish_lease, run_lease: runs.append('e2'), None, '2026-10-19')
+    assert record['status'] == 'duplicate'
+    assert runs == ['slow']
+    # The next window runs
+    coordinator.run('e3', lambda publish_lease, run_lease: runs.append('e3'), None, '2026-10-20')
+    assert runs == ['slow', 'e3']
+
+
+def test_failed_run_of_a_window_runs_again(coordinator):
+    with pytest.raises(run_coordinator.RunNotCompleted):
+        coordinator.run('e1', lambda publish_lease, run_lease: {'status': 'failed'}, None, '2026-10-19')
+    assert coordinator.run('e2', lambda publish_lease, run_lease: {'status': 'ok'},
+                           None, '2026-10-19')['status'] == 'ok'
+
+
+def test_renewed_lease_is_not_taken_over(tmp_path):
+    client = gcs_transfer.storage_client(str(tmp_path))
+    lease = run_coordinator.Lease(client, 'models', 'lease.json', 'e1', lease_seconds=1).acquire()
+    other = run_coordinator.Lease(client, 'models', 'lease.json', 'e2', lease_seconds=1)
+    for _ in range(3):
+        time.sleep(0.5)
+        lease.renew()
+        assert not other.try_acquire()
+
+    # Once it expires another run takes it over, and the first run can no longer renew it
+    time.sleep(1.1)
+    assert other.try_acquire()
+    with pytest.raises(run_coordinator.LeaseTaken):
+        lease.renew()
+
+
+def test_main_renews_the_run_lease_after_each_stage(tmp_path, monkeypatch):
+    renewals = []
+
+    def run_btyd(*args):
+        run_lease = args[-1]
+        monkeypatch.setattr(run_lease, 'renew', lambda: renewals.append(run_lease.holder))
+        report = main.run_report.RunReport('weekly')
+        report.stage_callbacks.append(run_lease.renew)
+        for stage in ['load', 'transform', 'fit']:
+            report.add_stage(stage, time.time(), 1)
+        return {'status': 'ok'}
+
+    monkeypatch.setattr(main, 'run_btyd', run_btyd)
+    monkeypatch.setattr(main, 'GCS_LOCAL_ROOT', str(tmp_path))
+    now = pd.Timestamp.utcnow().isoformat()
+
+    main.main({}, SimpleNamespace(event_id='e1', timestamp=now))
+    assert renewals == ['e1', 'e1', 'e1']
+    # Another event of the same week is skipped
+    main.main({}, SimpleNamespace(event_id='e2', timestamp=now))
+    assert renewals == ['e1', 'e1', 'e1']
+
+
+def test_main_drops_old_events(monkeypatch):
+    runs = []
+    monkeypatch.setattr(main, 'run_btyd', lambda *args: runs.append(args) or {'status': 'ok'})
+    monkeypatch.setattr(main, 'RUN_COORDINATOR_PREFIX', None)
+    old = pd.Timestamp.utcnow() - pd.Timedelta(seconds=main.RUN_MAX_EVENT_AGE_SECONDS + 60)
+
+    main.main({}, SimpleNamespace(event_id='e1', timestamp=old.isoformat()))
+    assert runs == []
+    main.main({}, SimpleNamespace(event_id='e2', timestamp=pd.Timestamp.utcnow().isoformat()))
+    assert len(runs) == 1
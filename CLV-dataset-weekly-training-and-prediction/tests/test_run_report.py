@@ -0,0 +1,97 @@
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import run_report
+
+
+def finished_report(rows=2, counts=None, stage_seconds=None, previous=None, run_date='2021-01-08'):
+    """Report of a run that wrote rows outputs, with a transform stage of 1000 rows taking stage_seconds."""
+    report = run_report.RunReport('weekly', run_date)
+    for (name, value) in (counts or {}).items():
+        report.count(name, value)
+    if stage_seconds is not None:
+        report.add_stage('transform', time.time() - stage_seconds, 1000)
+    if rows:
+        report.check_outputs(pd.DataFrame({'userId': ['u{}'.format(row) for row in range(rows)],
+                                           'clv': np.ones(rows)}))
+    return report.finish(previous)
+
+
+def test_status_is_failed_with_errors_empty_without_outputs_and_ok_otherwise():
+    failed = run_report.RunReport('weekly')
+    failed.check_outputs(None)
+
+    assert failed.finish()['status'] == 'failed'
+    assert failed.report['errors'] == ['Scoring returned no predictions']
+    assert finished_report(rows=0)['status'] == 'empty'
+    assert finished_report(rows=2)['status'] == 'ok'
+
+
+def test_nan_and_inf_outputs_are_counted_per_column_and_warned_about():
+    report = run_report.RunReport('weekly')
+    outputs = pd.DataFrame({'userId': ['u1', 'u2', 'u3'],
+                            'clv': [1.0, np.nan, np.inf],
+                            'churn_probability': [np.nan, 0.5, 0.5]})
+    # Outputs written in chunks are checked chunk by chunk
+    list(report.track_outputs([outputs.iloc[:2], outputs.iloc[2:]]))
+
+    result = report.finish()
+    assert result['outputs'] == {'rows': 3,
+                                 'nan': {'clv': 1, 'churn_probability': 1},
+                                 'inf': {'clv': 1, 'churn_probability': 0}}
+    assert result['warnings'] == ['2 nan values in the outputs', '1 inf values in the outputs']
+
+
+def test_changes_beyond_the_threshold_since_the_previous_report_are_warned_about():
+    previous = finished_report(rows=100, counts={'customers': 100, 'input_rows': 1000},
+                               stage_seconds=1.0, run_date='2021-01-01')
+
+    report = finished_report(rows=100, counts={'customers': 40, 'input_rows': 1100},
+                             stage_seconds=3.0, previous=previous)
+
+    assert report['changes']['counts']['customers'] == pytest.approx(-0.6)
+    assert report['changes']['counts']['input_rows'] == pytest.approx(0.1)
+    assert report['changes']['counts']['output_rows'] == 0
+    assert report['changes']['rows_per_second']['transform'] == pytest.approx(-2 / 3, abs=0.01)
+    assert report['warnings'] == ['customers changed by -60% since 2021-01-01',
+                                  'transform throughput changed by -67% since 2021-01-01']
+
+
+def test_short_stages_and_reports_of_other_versions_are_not_warned_about():
+    previous = finished_report(counts={'customers': 100}, stage_seconds=0.1, run_date='2021-01-01')
+
+    assert finished_report(counts={'customers': 100}, stage_seconds=1.0, previous=previous)['warnings'] == []
+    previous['report_version'] = run_report.REPORT_VERSION + 1
+    report = finished_report(counts={'customers': 10}, previous=previous)
+    assert report['changes'] == {}
+    assert report['warnings'] == []
+
+
+def test_compare_reports_skips_what_the_previous_report_does_not_have():
+    previous = finished_report(counts={'customers': 0}, run_date='2021-01-01')
+    current = finished_report(counts={'customers': 10, 'new_count': 5}, stage_seconds=1.0)
+
+    changes = run_report.compare_reports(previous, current)
+
+    assert changes['previous_run_date'] == '2021-01-01'
+    assert changes['counts']['customers'] is None
+    assert changes['counts']['new_count'] is None
+    assert changes['rows_per_second'] == {'transform': None}
+    assert changes['seconds'] == {'transform': None}
+
+
+@pytest.mark.parametrize('file_name,suffix,expected', [
+    ('clv_run_report.json', '2021-01-08', 'clv_run_report_2021-01-08.json'),
+    ('reports/run.v1.json', 'eu', 'reports/run.v1_eu.json'),
+    ('clv_run_report', 'eu', 'clv_run_report_eu')])
+def test_suffixed_name(file_name, suffix, expected):
+    assert run_report.suffixed_name(file_name, suffix) == expected
+
+
+def test_saved_report_loads_unchanged(tmp_path):
+    report = finished_report(counts={'customers': 3}, stage_seconds=0.5)
+
+    run_report.save_report(report, str(tmp_path / 'report.json'))
+
+    assert run_report.load_report(str(tmp_path / 'report.json')) == report
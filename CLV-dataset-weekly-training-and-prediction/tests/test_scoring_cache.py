@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+import btyd_scoring
+import main
+import scoring_cache
+import synthetic_data
+
+FITTER_PARAMS = {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}
+GGF_PARAMS = {'p': 6.0, 'q': 4.0, 'v': 15.0}
+
+
+def rfm(values):
+    """Summary with the given (frequency, recency, T, monetary_value) tuples, one customer each."""
+    return pd.DataFrame(values, columns=scoring_cache.RFM_COLUMNS,
+                        index=['u{}'.format(position) for position in range(len(values))])
+
+
+def score_function(calls):
+    """Score function that records the customers it is called with and scores them on their frequency."""
+    def score(summary):
+        calls.append(len(summary))
+        return pd.DataFrame({'score': summary['frequency'] * 2.0}, index=summary.index)
+    return score
+
+
+def test_identical_customers_are_scored_once_and_hit_on_the_next_run():
+    cache = scoring_cache.ScoringCache()
+    calls = []
+    summary = rfm([(1, 2, 3, 4.0), (1, 2, 3, 4.0), (2, 2, 3, 4.0)])
+
+    first = cache.score(summary, 'model', score_function(calls))
+    second = cache.score(summary, 'model', score_function(calls))
+
+    assert calls == [2]
+    assert (cache.hits, cache.misses, cache.customers) == (2, 2, 6)
+    assert cache.hit_rate() == 0.5
+    pd.testing.assert_frame_equal(first, second)
+    assert list(first['score']) == [2.0, 2.0, 4.0]
+
+
+def test_least_recently_used_entries_are_evicted_above_max_entries():
+    cache = scoring_cache.ScoringCache(max_entries=2)
+    calls = []
+    cache.score(rfm([(1, 2, 3, 4.0)]), 'model', score_function(calls))
+    cache.score(rfm([(2, 2, 3, 4.0)]), 'model', score_function(calls))
+    # Using the first entry again makes the second the least recently used
+    cache.score(rfm([(1, 2, 3, 4.0)]), 'model', score_function(calls))
+    cache.score(rfm([(3, 2, 3, 4.0)]), 'model', score_function(calls))
+
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    cache.score(rfm([(1, 2, 3, 4.0), (3, 2, 3, 4.0)]), 'model', score_function(calls))
+    assert calls == [1, 1, 1]
+    cache.score(rfm([(2, 2, 3, 4.0)]), 'model', score_function(calls))
+    assert calls == [1, 1, 1, 1]
+
+
+def test_other_models_miss_and_are_discarded():
+    fitter = btyd_scoring.BetaGeoModel(FITTER_PARAMS)
+    ggf = btyd_scoring.GammaGammaModel(GGF_PARAMS)
+    refit = btyd_scoring.BetaGeoModel(dict(FITTER_PARAMS, r=0.3))
+    fingerprint = scoring_cache.model_fingerprint(fitter, ggf, t=6, frequency='M')
+    assert fingerprint == scoring_cache.model_fingerprint(fitter, ggf, t=6, frequency='M')
+    new_fingerprint = scoring_cache.model_fingerprint(refit, ggf, t=6, frequency='M')
+    assert new_fingerprint != fingerprint
+    assert scoring_cache.model_fingerprint(fitter, ggf, t=12, frequency='M') != fingerprint
+    cache = scoring_cache.ScoringCache()
+    calls = []
+    summary = rfm([(1, 2, 3, 4.0)])
+
+    cache.score(summary, fingerprint, score_function(calls))
+    cache.score(summary, new_fingerprint, score_function(calls))
+
+    assert calls == [1, 1]
+    assert cache.discard_other_models(new_fingerprint) == 1
+    assert list(cache.entries) == [new_fingerprint]
+
+
+def test_saved_cache_is_loaded_only_with_the_same_version_and_rounding(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / 'cache.pkl')
+    cache = scoring_cache.ScoringCache()
+    cache.score(rfm([(1, 2, 3, 4.0), (2, 2, 3, 4.0)]), 'model', score_function([]))
+    cache.save(cache_file)
+
+    assert len(scoring_cache.ScoringCache.load(cache_file, max_entries=1)) == 1
+    assert len(scoring_cache.ScoringCache.load(cache_file)) == 2
+    assert len(scoring_cache.ScoringCache.load(cache_file, decimals=2)) == 0
+    assert len(scoring_cache.ScoringCache.load(str(tmp_path / 'missing.pkl'))) == 0
+    monkeypatch.setattr(scoring_cache, 'CACHE_VERSION', scoring_cache.CACHE_VERSION + 1)
+    assert len(scoring_cache.ScoringCache.load(cache_file)) == 0
+
+
+@pytest.mark.parametrize('frequency,periods_per_month', [('D', 30), ('W', 4.345), ('M', 1)])
+def test_cached_scores_are_within_the_tolerance_of_the_exact_scores(frequency, periods_per_month):
+    (training_df, actual_customer_value_df) = synthetic_data.generate_transactions(5000, 0)
+    (summary, _) = main.transform_data(training_df, actual_customer_value_df, frequency)
+    fitter = btyd_scoring.BetaGeoModel(FITTER_PARAMS)
+    ggf = btyd_scoring.GammaGammaModel(GGF_PARAMS)
+    time_months = [6, 12]
+    t = [months * periods_per_month for months in time_months]
+
+    def score(customers):
+        return main.score_customers(customers, fitter, ggf, t, time_months, main.DISCOUNT_RATE, frequency)
+    exact_scores = score(summary)
+    # predict_value rounds the values to cents, the scores show the difference of the rounded RFM values
+    cached_scores = scoring_cache.ScoringCache().score(summary, 'model', score)
+
+    assert cached_scores.columns.equals(exact_scores.columns)
+    np.testing.assert_allclose(cached_scores.to_numpy(), exact_scores.to_numpy(),
+                               rtol=scoring_cache.SCORE_TOLERANCE, atol=1e-12)
@@ -0,0 +1,60 @@
+import pandas as pd
+import main
+import synthetic_data
+import tune
+
+MODEL_TYPES = ['BGNBD', 'PARETO']
+FREQUENCIES = ['W', 'M']
+PENALIZER_COEFS = [0.0, 0.01]
+
+
+def test_every_frequency_is_evaluated_on_the_same_customers():
+    (training_df, _) = synthetic_data.generate_transactions(2000, 0)
+
+    summaries = tune.calibration_and_holdout_summaries(training_df, ['D'] + FREQUENCIES, 6)
+
+    customers = summaries['D'].index
+    assert len(customers) > 0
+    for summary in summaries.values():
+        assert summary.index.equals(customers)
+
+
+def test_synthetic_sweep_ranks_the_best_combination_first():
+    (training_df, _) = synthetic_data.generate_transactions(2000, 0)
+
+    results = tune.run_sweep(training_df, MODEL_TYPES, FREQUENCIES, PENALIZER_COEFS, 6, workers=1)
+
+    assert len(results) == len(MODEL_TYPES) * len(FREQUENCIES) * len(PENALIZER_COEFS)
+    evaluated = results[results['error'].isna()]
+    assert not evaluated.empty
+    assert evaluated['revenue_rmse'].is_monotonic_increasing
+    assert evaluated.index[0] == 0
+    best = results.iloc[0]
+    assert tune.recommend_config(results) == {'MODEL_TYPE': best['MODEL_TYPE'],
+                                              'FREQUENZY': best['FREQUENZY'],
+                                              'PENALIZER_COEF': best['PENALIZER_COEF']}
+
+
+def test_sweep_without_a_converged_combination_recommends_nothing(monkeypatch):
+    (training_df, _) = synthetic_data.generate_transactions(2000, 0)
+    # The worker processes are forked and see the patched fits
+    monkeypatch.setattr(main, 'bgnbd_model', lambda *args: None)
+    monkeypatch.setattr(main, 'paretonbd_model', lambda *args: None)
+
+    results = tune.run_sweep(training_df, MODEL_TYPES, FREQUENCIES, PENALIZER_COEFS, 6, workers=1)
+
+    assert (results['error'] == 'Model did not converge').all()
+    assert results['revenue_rmse'].isna().all()
+    assert tune.recommend_config(results) is None
+
+
+def test_sweep_without_repeat_customers_recommends_nothing():
+    # One purchase per customer leaves nobody with repeat purchases to calibrate on
+    training_df = pd.DataFrame({'userId': ['u1', 'u2', 'u3'],
+                                'order_date': pd.to_datetime(['2020-01-01', '2020-06-01', '2021-01-01']),
+                                'order_value': [10.0, 20.0, 30.0]})
+
+    results = tune.run_sweep(training_df, MODEL_TYPES, FREQUENCIES, PENALIZER_COEFS, 6, workers=1)
+
+    assert (results['error'] == 'No customers to evaluate').all()
+    assert tune.recommend_config(results) is None
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+import btyd_scoring
+import uncertainty
+
+FITTER_PARAMS = {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}
+GGF_PARAMS = {'p': 6.0, 'q': 4.0, 'v': 15.0}
+
+
+def test_bootstrap_fails_when_no_fit_converges():
+    # Negative monetary values make every gamma-gamma fit fail
+    summary = pd.DataFrame({'frequency': [1.0, 2.0, 3.0], 'recency': [1.0, 2.0, 3.0],
+                            'T': [4.0, 4.0, 4.0], 'monetary_value': [-1.0, -2.0, -3.0]})
+
+    with pytest.raises(RuntimeError, match='None of the 2 bootstrap fits converged'):
+        uncertainty.draw_param_samples(summary, btyd_scoring.BetaGeoModel(FITTER_PARAMS),
+                                       btyd_scoring.GammaGammaModel(GGF_PARAMS), 'BGNBD', 0.0, 2,
+                                       method='BOOTSTRAP', workers=1)
+
+
+def test_predict_intervals_raises_instead_of_returning_none():
+    summary = pd.DataFrame({'frequency': [1.0], 'recency': [1.0], 'T': [4.0], 'monetary_value': [10.0]},
+                           index=['u1'])
+    fitter_samples = {name: np.full(3, value) for (name, value) in FITTER_PARAMS.items()}
+
+    with pytest.raises(KeyError):
+        uncertainty.predict_intervals(summary, pd.DataFrame({'current_total_revenue': [10.0]}, index=['u1']),
+                                      fitter_samples, {}, 'BGNBD', 6, 1, 0.01, workers=1)
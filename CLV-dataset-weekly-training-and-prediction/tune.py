@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+from concurrent.futures import ProcessPoolExecutor
+from lifetimes import utils
+import argparse
+import itertools
+import json
+import logging
+import time
+import numpy as np
+import pandas as pd
+import config
+import btyd_scoring
+import main
+import synthetic_data
+
+# Set variables
+logger = logging.getLogger(__name__)
+TUNING_MODEL_TYPES = config.config_vars['TUNING_MODEL_TYPES']
+TUNING_FREQUENCIES = config.config_vars['TUNING_FREQUENCIES']
+TUNING_PENALIZER_COEFS = config.config_vars['TUNING_PENALIZER_COEFS']
+TUNING_HOLDOUT_MONTHS = config.config_vars['TUNING_HOLDOUT_MONTHS']
+
+# Holdout metrics of an evaluated combination, missing from the combinations that failed
+METRIC_COLUMNS = ['customers', 'purchases_rmse', 'revenue_rmse', 'revenue_error']
+
+# Calibration/holdout summaries per frequency, shared with the worker processes
+_summaries = {}
+
+
+def calibration_and_holdout_summaries(training_df, frequencies, holdout_months):
+    """Split the transactions into a calibration and holdout period once per frequency.
+    Only the customers with repeat purchases in the calibration period at
+    every frequency are kept, so every combination is evaluated on the
+    same customers and the holdout errors can be compared.
+    Args:
+        training_df:    Transactions with userId, order_date, order_value
+        frequencies:    The frequencies to build summaries for (D, W, M)
+        holdout_months: Length of the holdout period at the end of the data
+    Returns:
+        Dict with a calibration/holdout summary for each frequency
+    """
+    try:
+        observation_period_end = pd.to_datetime(training_df['order_date']).max()
+        calibration_period_end = observation_period_end - pd.DateOffset(months=holdout_months)
+        summaries = {}
+        for frequency in frequencies:
+            summary = utils.calibration_and_holdout_data(training_df,
+                    'userId', 'order_date', calibration_period_end,
+                    observation_period_end, freq=frequency,
+                    monetary_value_col='order_value')
+            summaries[frequency] = summary[(summary['monetary_value_cal'] > 0)
+                                           & (summary['frequency_cal'] > 0)]
+            logging.info('Built {} calibration summary with {} customers'.format(
+                frequency, len(summaries[frequency])))
+        customers = None
+        for summary in summaries.values():
+            customers = summary.index if customers is None else customers.intersection(summary.index)
+        logging.info('Evaluating all frequencies on the {} customers they have in common'.format(
+            0 if customers is None else len(customers)))
+        return {frequency: summary.loc[customers] for (frequency, summary) in summaries.items()}
+    except Exception as error_message:
+        logger.error("Fatal in error calibration_and_holdout_summaries function", exc_info=True)
+
+
+def _set_summaries(summaries):
+    """Initializer that hands the summaries to a worker process once."""
+    global _summaries
+    _summaries = summaries
+
+
+def evaluate_combination(model_type, frequency, penalizer_coef):
+    """Fit one model combination on the calibration period and score it on the holdout period.
+    Args:
+        model_type:     model type (PARETO, BGNBD)
+        frequency:      The frequency of the calibration summary to use
+        penalizer_coef: Penalizer used in fitter and ggf models
+    Returns:
+        Dict with the combination, holdout errors and fit time
+    """
+    result = {'MODEL_TYPE': model_type,
+              'FREQUENZY': frequency,
+              'PENALIZER_COEF': penalizer_coef}
+    summary = _summaries[frequency]
+    calibration = summary[['frequency_cal', 'recency_cal', 'T_cal', 'monetary_value_cal']]
+    calibration.columns = ['frequency', 'recency', 'T', 'monetary_value']
+
+    start_time = time.time()
+    if model_type == 'PARETO':
+        fitter = main.paretonbd_model(calibration, penalizer_coef)
+    else:
+        fitter = main.bgnbd_model(calibration, penalizer_coef)
+    ggf = main.gammagamma_model(calibration, penalizer_coef)
+    result['fit_seconds'] = time.time() - start_time
+    if fitter is None or ggf is None:
+        result['error'] = 'Model did not converge'
+        return result
+
+    fitter = btyd_scoring.scoring_model(fitter)
+    predicted_purchases = fitter.conditional_expected_number_of_purchases_up_to_time(
+        summary['duration_holdout'], calibration['frequency'],
+        calibration['recency'], calibration['T'])
+    predicted_revenue = predicted_purchases * ggf.conditional_expected_average_profit(
+        calibration['frequency'], calibration['monetary_value'])
+    actual_revenue = summary['frequency_holdout'] * summary['monetary_value_holdout']
+
+    result['customers'] = len(summary)
+    result['purchases_rmse'] = float(np.sqrt(np.mean(
+        (predicted_purchases - summary['frequency_holdout']) ** 2)))
+    result['revenue_rmse'] = float(np.sqrt(np.mean(
+        (predicted_revenue - actual_revenue) ** 2)))
+    # No revenue in the holdout period leaves the relative error undefined
+    result['revenue_error'] = float((predicted_revenue.sum() - actual_revenue.sum())
+                                    / actual_revenue.sum()) if actual_revenue.sum() > 0 else np.nan
+    return result
+
+
+def run_sweep(training_df,
+              model_types,
+              frequencies,
+              penalizer_coefs,
+              holdout_months=6,
+              workers=None):
+    """Evaluate every combination of model type, frequency and penalizer in parallel.
+    Args:
+        training_df:        Transactions with userId, order_date, order_value
+        model_types:        model types to try (PARETO, BGNBD)
+        frequencies:        frequencies to try (D, W, M)
+        penalizer_coefs:    penalizers to try
+        holdout_months:     Length of the holdout period at the end of the data
+        workers:            Number of worker processes, defaults to the number of CPUs
+    Returns:
+        Dataframe with one row per combination, best holdout revenue error first,
+        every combination with an error when there are no customers to evaluate
+    """
+    summaries = calibration_and_holdout_summaries(training_df, frequencies,
+                                                  holdout_months)
+    grid = list(itertools.product(model_types, frequencies, penalizer_coefs))
+    if summaries is None or any(summary.empty for summary in summaries.values()):
+        logging.error('No customers with repeat purchases to evaluate the combinations on')
+        results = pd.DataFrame([{'MODEL_TYPE': model_type,
+                                 'FREQUENZY': frequency,
+                                 'PENALIZER_COEF': penalizer_coef,
+                                 'fit_seconds': np.nan,
+                                 'error': 'No customers to evaluate'}
+                                for (model_type, frequency, penalizer_coef) in grid])
+    else:
+        logging.info('Evaluating {} combinations'.format(len(grid)))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_set_summaries,
+                                 initargs=(summaries,)) as executor:
+            results = pd.DataFrame(list(executor.map(evaluate_combination, *zip(*grid))))
+    if 'error' not in results:
+        results['error'] = None
+    for column in METRIC_COLUMNS:
+        if column not in results:
+            results[column] = np.nan
+    return results.sort_values(['revenue_rmse', 'fit_seconds'],
+                               na_position='last', ignore_index=True)
+
+
+def recommend_config(results):
+    """Pick the combination with the lowest holdout revenue error.
+    Args:
+        results: Dataframe returned by run_sweep
+    Returns:
+        Dict with MODEL_TYPE, FREQUENZY and PENALIZER_COEF for config.py,
+        None when no combination could be evaluated
+    """
+    evaluated = results[results['error'].isna()]
+    if evaluated.empty:
+        logging.error('No combination could be evaluated, errors: {}'.format(
+            sorted(set(results['error'].dropna()))))
+        return None
+    best = evaluated.iloc[0]
+    return {'MODEL_TYPE': best['MODEL_TYPE'],
+            'FREQUENZY': best['FREQUENZY'],
+            'PENALIZER_COEF': float(best['PENALIZER_COEF'])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Sweep MODEL_TYPE, FREQUENZY and PENALIZER_COEF and score each on a holdout period.')
+    parser.add_argument('--synthetic', type=int, metavar='CUSTOMERS',
+                        help='Use seeded synthetic transactions instead of BigQuery')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', help='Write results and recommended config to this JSON file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.synthetic:
+        (training_df, actual_customer_value_df) = \
+            synthetic_data.generate_transactions(args.synthetic, args.seed)
+    else:
+        (training_df, actual_customer_value_df) = \
+            main.load_data_from_bq(main.TRAINING_DATA_QUERY,
+                                   main.ACTUAL_CUSTOMER_VALUE_QUERY)
+
+    results = run_sweep(training_df,
+                        TUNING_MODEL_TYPES,
+                        TUNING_FREQUENCIES,
+                        TUNING_PENALIZER_COEFS,
+                        TUNING_HOLDOUT_MONTHS,
+                        args.workers)
+    recommended = recommend_config(results)
+    print(results.to_string())
+    if recommended is None:
+        print('No recommended config, every combination failed')
+    else:
+        print('Recommended config: {}'.format(recommended))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'results': results.to_dict(orient='records'),
+                       'recommended_config': recommended},
+                      output_file, indent=2)
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+from concurrent.futures import ProcessPoolExecutor
+from lifetimes import BetaGeoFitter, GammaGammaFitter
+import logging
+import os
+import resource
+import time
+import numpy as np
+import pandas as pd
+import btyd_scoring
+import pareto_nbd
+
+# Set variables
+logger = logging.getLogger(__name__)
+# Number of (samples x customers) float64 arrays alive at the same time while a chunk is scored
+SCORING_ARRAYS_IN_MEMORY = 8
+
+# Summary, parameter samples and settings shared with the worker processes
+_settings = {}
+
+
+def _set_settings(settings):
+    """Initializer that hands the shared settings to a worker process once."""
+    global _settings
+    _settings = settings
+
+
+def hessian_param_samples(model, samples, rng):
+    """Draw parameter samples from the normal approximation around a fitted model.
+    lifetimes fits the log of the parameters and keeps the Hessian of the mean
+    negative log likelihood, so the covariance of the log parameters is its
+    inverse divided by the number of customers.
+    Args:
+        model:      lifetimes fitter, already fit to data
+        samples:    Number of parameter samples to draw
+        rng:        numpy random Generator
+    Returns:
+        Dict with an array of samples for each parameter, None when the model has no usable Hessian
+    """
+    hessian_ = getattr(model, '_hessian_', None)
+    if hessian_ is None:
+        return None
+    try:
+        covariance = np.linalg.inv(hessian_) / model.data['weights'].sum()
+        np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        return None
+    draws = np.exp(rng.multivariate_normal(np.log(model.params_.values), covariance, samples))
+    return {name: draws[:, position] for position, name in enumerate(model.params_.index)}
+
+
+def _fit_bootstrap_sample(seed):
+    """Refit the fitter and gamma-gamma model on one resample of the customers.
+    Args:
+        seed:   Seed of the resample
+    Returns:
+        Tuple of fitter and gamma-gamma parameter dicts, None when a fit did not converge
+    """
+    summary = _settings['summary']
+    rows = np.random.default_rng(seed).integers(0, len(summary), len(summary))
+    resample = summary.iloc[rows]
+    try:
+        if _settings['model_type'] == 'PARETO':
+            fitter = pareto_nbd.fit(resample['frequency'], resample['recency'], resample['T'],
+                                    _settings['penalizer_coef'])
+        else:
+            fitter = BetaGeoFitter(penalizer_coef=_settings['penalizer_coef'])
+            fitter.fit(resample['frequency'], resample['recency'], resample['T'])
+        ggf = GammaGammaFitter(penalizer_coef=_settings['penalizer_coef'])
+        ggf.fit(resample['frequency'], resample['monetary_value'])
+    except Exception as error_message:
+        logging.warning('Bootstrap sample {} did not converge: {}'.format(seed, error_message))
+        return None
+    return (dict(fitter.params_), dict(ggf.params_))
+
+
+def bootstrap_param_samples(summary, model_type, penalizer_coef, samples,
+                            workers=None, seed=0):
+    """Draw parameter samples by refitting the models on resampled customers in parallel.
+    Args:
+        summary:        RFM transaction data
+        model_type:     model type (PARETO, BGNBD)
+        penalizer_coef: Penalizer used in fitter and ggf models
+        samples:        Number of bootstrap fits
+        workers:        Number of worker processes, defaults to the number of CPUs
+        seed:           Seed of the first resample
+    Returns:
+        fitter_samples, ggf_samples as dicts with an array of samples for each parameter
+    Raises:
+        RuntimeError when none of the fits converged
+    """
+    settings = {'summary': summary[['frequency', 'recency', 'T', 'monetary_value']],
+                'model_type': model_type,
+                'penalizer_coef': penalizer_coef}
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_set_settings,
+                             initargs=(settings,)) as executor:
+        fits = [fit for fit in executor.map(_fit_bootstrap_sample,
+                                            range(seed, seed + samples))
+                if fit is not None]
+    if not fits:
+        raise RuntimeError('None of the {} bootstrap fits converged'.format(samples))
+    if len(fits) < samples:
+        logging.warning('{} of the {} bootstrap fits converged'.format(len(fits), samples))
+    fitter_samples = pd.DataFrame([fitter_params for fitter_params, _ in fits])
+    ggf_samples = pd.DataFrame([ggf_params for _, ggf_params in fits])
+    return ({name: fitter_samples[name].to_numpy() for name in fitter_samples},
+            {name: ggf_samples[name].to_numpy() for name in ggf_samples})
+
+
+def draw_param_samples(summary,
+                       fitter,
+                       ggf,
+                       model_type,
+                       penalizer_coef,
+                       samples,
+                       method='HESSIAN',
+                       workers=None,
+                       seed=0):
+    """Draw parameter samples of the fitter and gamma-gamma model.
+    The Hessian method is used when both models have a usable Hessian,
+    Pareto/NBD fitters fit by lifetimes itself have none, otherwise the
+    models are refit on bootstrap resamples of the customers.
+    Args:
+        summary:        RFM transaction data
+        fitter:         lifetimes fitter, previously fit to data
+        ggf:            lifetimes gamma/gamma fitter, already fit to data
+        model_type:     model type (PARETO, BGNBD)
+        penalizer_coef: Penalizer used in fitter and ggf models
+        samples:        Number of parameter samples
+        method:         HESSIAN or BOOTSTRAP
+        workers:        Number of worker processes used for bootstrap fits
+        seed:           Seed for the random generator
+    Returns:
+        fitter_samples, ggf_samples as dicts with an array of samples for each parameter
+    Raises:
+        RuntimeError when none of the bootstrap fits converged
+    """
+    start_time = time.time()
+    fitter_samples = None
+    ggf_samples = None
+    if method == 'HESSIAN':
+        rng = np.random.default_rng(seed)
+        fitter_samples = hessian_param_samples(fitter, samples, rng)
+        ggf_samples = hessian_param_samples(ggf, samples, rng)
+        if fitter_samples is None or ggf_samples is None:
+            logging.info('No usable Hessian for the {} model, falling back to bootstrap'.format(model_type))
+            method = 'BOOTSTRAP'
+    if method == 'BOOTSTRAP':
+        (fitter_samples, ggf_samples) = bootstrap_param_samples(summary, model_type,
+                                                                penalizer_coef, samples,
+                                                                workers, seed)
+    logging.info('Drew {} parameter samples with the {} method in {:.1f}s'.format(
+        len(ggf_samples['q']), method, time.time() - start_time))
+    return (fitter_samples, ggf_samples)
+
+
+def _score_chunk(start, stop):
+    """Evaluate all parameter samples for the customers in rows start to stop.
+    Returns:
+        Array with the clv percentiles followed by the churn percentiles for each customer
+    """
+    settings = _settings
+    frequency = settings['frequency'][start:stop]
+    recency = settings['recency'][start:stop]
+    T = settings['T'][start:stop]
+    fitter = settings['fitter']
+    ggf = settings['ggf']
+
+    churn = 1 - fitter.conditional_probability_alive(frequency, recency, T)
+    adjusted_monetary_value = ggf.conditional_expected_average_profit(
+        frequency, settings['monetary_value'][start:stop])
+    previous_purchases = 0
+    predicted_value = 0
+    for month in range(1, settings['clv_months'] + 1):
+        purchases = fitter.conditional_expected_number_of_purchases_up_to_time(
+            month * settings['periods_per_month'], frequency, recency, T)
+        predicted_value = predicted_value + adjusted_monetary_value \
+            * (purchases - previous_purchases) / (1 + settings['discount_rate']) ** month
+        previous_purchases = purchases
+    clv = settings['current_total_revenue'][start:stop] + predicted_value
+    return np.concatenate([np.percentile(clv, settings['percentiles'], axis=0),
+                           np.percentile(churn, settings['percentiles'], axis=0)]).T
+
+
+def predict_intervals(summary,
+                      actual_df,
+                      fitter_samples,
+                      ggf_samples,
+                      model_type,
+                      clv_months,
+                      periods_per_month,
+                      discount_rate,
+                      percentiles=(10, 90),
+                      memory_budget_bytes=256 * 1024 ** 2,
+                      workers=None):
+    """Predict clv and churn percentiles over the parameter samples for each customer.
+    All samples are evaluated at once as (samples x customers) arrays. The
+    customers are split into chunks so the arrays of a chunk stay within
+    memory_budget_bytes, and the chunks are scored in a process pool.
+    Args:
+        summary:            RFM transaction data
+        actual_df:          dataframe with current_total_revenue, indexed on userId
+        fitter_samples:     dict with an array of samples for each fitter parameter
+        ggf_samples:        dict with an array of samples for each gamma-gamma parameter
+        model_type:         model type (PARETO, BGNBD)
+        clv_months:         horizon used for clv in months
+        periods_per_month:  number of periods of the summary frequency in a month
+        discount_rate:      Used to discount future revenue to current day value
+        percentiles:        percentiles to report, clv_p<n> and churn_probability_p<n> columns
+        memory_budget_bytes:Memory the arrays of a chunk may use in a worker
+        workers:            Number of worker processes, defaults to the number of CPUs
+    Returns:
+        Dataframe with userId and the clv and churn_probability percentiles
+    Raises:
+        The error that stopped the prediction, after logging it
+    """
+    try:
+        start_time = time.time()
+        samples = len(ggf_samples['q'])
+        customers = len(summary)
+        # each sample is a row, so the samples broadcast against the customers
+        settings = {
+            'fitter': btyd_scoring.MODELS[model_type](
+                {name: values[:, None] for name, values in fitter_samples.items()}),
+            'ggf': btyd_scoring.GammaGammaModel(
+                {name: values[:, None] for name, values in ggf_samples.items()}),
+            'current_total_revenue': actual_df['current_total_revenue'].reindex(summary.index).to_numpy(dtype=float),
+            'clv_months': int(clv_months),
+            'periods_per_month': periods_per_month,
+            'discount_rate': discount_rate,
+            'percentiles': list(percentiles)}
+        for column in ['frequency', 'recency', 'T', 'monetary_value']:
+            settings[column] = summary[column].to_numpy(dtype=float)
+
+        chunk_size = max(1, int(memory_budget_bytes // (samples * 8 * SCORING_ARRAYS_IN_MEMORY)))
+        starts = list(range(0, customers, chunk_size))
+        stops = [min(start + chunk_size, customers) for start in starts]
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_set_settings,
+                                 initargs=(settings,)) as executor:
+            results = list(executor.map(_score_chunk, starts, stops))
+
+        columns = ['clv_p{}'.format(percentile) for percentile in percentiles] \
+            + ['churn_probability_p{}'.format(percentile) for percentile in percentiles]
+        intervals = pd.DataFrame(np.concatenate(results) if results else np.empty((0, len(columns))),
+                                 columns=columns)
+        intervals.insert(0, 'userId', summary.index)
+        intervals[columns[:len(percentiles)]] = intervals[columns[:len(percentiles)]].round(2)
+        intervals[columns[len(percentiles):]] = intervals[columns[len(percentiles):]].round(4)
+
+        seconds = time.time() - start_time
+        logging.info('Uncertainty: {} samples x {} customers in {} chunks of {} customers on {} workers '
+                     'in {:.1f}s, {:.0f} sample-customers/s'.format(
+                         samples, customers, len(starts), chunk_size, workers, seconds,
+                         samples * customers / seconds if seconds else float('nan')))
+        logging.info('Uncertainty memory: {:.1f} MB per chunk array, {:.1f} MB chunk budget, '
+                     'peak RSS {:.1f} MB main and {:.1f} MB largest worker'.format(
+                         samples * min(chunk_size, customers) * 8 / 1024 ** 2,
+                         memory_budget_bytes / 1024 ** 2,
+                         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                         resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+        return intervals
+    except Exception as error_message:
+        logger.error("Fatal in error predict_intervals function", exc_info=True)
+        raise
@@ -2,9 +2,11 @@
   -- Steps in query:
   -- Step 1: Get excisting customers that has not been made new predictions for.
   -- Step 2: Union all new predictions with the excisting predictions.
-  -- Step 3: Calculate quantiles on the CLV of all customers with predictions
-  -- Step 4: Canculate 25%, 50% and 75% percentiles
-  -- Step 5: Set new customer Segments
+  -- Step 3: Set new customer Segments
+  -- The 25%, 50% and 75% percentiles of the CLV are kept up to date in a sketch while the predictions are made and
+  -- passed as the query parameters @p25, @p50 and @p75, so the table is written in a single pass
+  -- When no customers were sketched update_query computes clv_percentiles with APPROX_QUANTILES over the table instead
+  -- update_query in main.py fills in a predicted_value_next_<n>_month column for each prediction horizon
 
   --Save to table with clv and churn predictions
 CREATE OR REPLACE TABLE `your-project.customer_predictions.clv_and_churn_predictions`
@@ -18,7 +20,7 @@ WITH
     excisting_predictions.userId,
     excisting_predictions.clv,
     excisting_predictions.churn_probability,
-    excisting_predictions.predicted_value_next_6_month,
+    $existing_predicted_value_columns
     excisting_predictions.current_total_revenue
   FROM
     `your-project.customer_predictions.clv_and_churn_predictions` AS excisting_predictions
@@ -34,7 +36,7 @@ WITH
     userId,
     clv,
     churn_probability,
-    predicted_value_next_6_month,
+    $predicted_value_columns
     current_total_revenue
   FROM
     `your-project.ml_models_production.new_predictions`
@@ -43,36 +45,18 @@ WITH
     userId,
     clv,
     churn_probability,
-    predicted_value_next_6_month,
+    $predicted_value_columns
     current_total_revenue
   FROM
     excisting_customer_predictions_that_has_not_been_updated ),
-  -- Step 3: Calculate quantiles on the CLV of all customers with predictions
-  approx_quantiles_data AS (
-  SELECT
-    APPROX_QUANTILES(clv, 100) percentiles
-  FROM
-    all_customers_with_clv_predictions ),
-  -- Step 4: Canculate 25%, 50% and 75% percentiles
   clv_percentiles AS (
-  SELECT
-    percentiles[
-  OFFSET
-    (25)] AS p25,
-    percentiles[
-  OFFSET
-    (50)] AS p50,
-    percentiles[
-  OFFSET
-    (75)] AS p75
-  FROM
-    approx_quantiles_data )
-  -- Step 5: Set new customer Segments
+  $clv_percentiles)
+  -- Step 3: Set new customer Segments
 SELECT
   userId,
   clv,
   churn_probability,
-  predicted_value_next_6_month,
+  $predicted_value_columns
   current_total_revenue,
   (CASE
       WHEN clv < p25 THEN "Lowest 25% Customers"
@@ -96,4 +80,4 @@ SELECT
 FROM
   all_customers_with_clv_predictions
 CROSS JOIN
-  clv_percentiles clv_percentiles
+  clv_percentiles
@@ -3,6 +3,9 @@ config_vars = {
     'PENALIZER_COEF': 0.03,
     'DISCOUNT_RATE': 0.01,
     'PREDICTION_LENGTH_IN_MONTHS': 6,
+    # A predicted_value_next_<n>_month column is written for each horizon and filled in in the update SQL. The weekly
+    # function recreates the table with the columns of its horizons, change them there first
+    'PREDICTION_HORIZONS_IN_MONTHS': [1, 3, 6, 12],
     'PREFIX':'clv_model',
     'FREQUENZY':'M',
     'GCS_BUCKET_MODELS': 'your_company_trained_ml_models_production',
@@ -10,6 +13,46 @@ config_vars = {
     'LOCAL_STORAGE_FOLDER': '/tmp/',
     'TRAINING_DATA_QUERY': 'CLV-dataset-daily-predictions.sql',
     'ACTUAL_CUSTOMER_VALUE_QUERY': 'CLV-dataset-daily-predictions-customer-summary.sql',
-    'UPDATE_BIGQUERY_RESULT_TABLE': 'CLV-daily-update-result-bigquery-table.sql'
+    'UPDATE_BIGQUERY_RESULT_TABLE': 'CLV-daily-update-result-bigquery-table.sql',
+    # Score with the model parameters saved by the weekly function instead of loading lifetimes
+    'SCORING_ONLY': True,
+    # Transfers to GCS, several files at a time. Files up to 8 MB go in one request, larger ones in resumable chunks
+    # of this size. Transient errors are retried for up to TRANSFER_RETRY_SECONDS
+    'TRANSFER_CHUNK_SIZE_MB': 8,
+    'TRANSFER_WORKERS': 4,
+    'TRANSFER_RETRY_SECONDS': 120,
+    # Compression of the predictions CSV while it is uploaded, BigQuery only loads gzip, not zstd
+    'TRANSFER_COMPRESSION': 'gzip',
+    # Folder used as a local stand-in for the buckets, None uses Google Cloud Storage
+    'GCS_LOCAL_ROOT': None,
+    # Score and upload the predictions as Parquet this many customers at a time, None writes one CSV after scoring everyone
+    'STREAM_EXPORT_CHUNK_SIZE': 100000,
+    # Age the whole customer base every day from an RFM state in the models bucket and write only the rows that changed.
+    # The seed query builds the state on the first run, after the weekly function trained new models and every reseed days.
+    # Off by default, set file to a name like 'clv_rfm_state.parquet' to enable. None only scores the customers who
+    # bought since yesterday
+    'AGING_STATE_FILE': None,
+    'AGING_SEED_QUERY': 'CLV-dataset-daily-aging-seed.sql',
+    'AGING_RESEED_DAYS': 7,
+    # Data-quality and throughput report of each run, saved next to the models and compared with the previous run.
+    # Set file to None to disable
+    'RUN_REPORT_FILE': 'clv_run_report_daily.json',
+    'RUN_REPORT_CHANGE_THRESHOLD': 0.5,
+    # Run once per Pub/Sub event and one run at a time, with leases and run records under this prefix in the models
+    # bucket. The weekly function runs in parallel and waits to publish. Set prefix to None to run on every event
+    'RUN_COORDINATOR_PREFIX': 'clv_runs/',
+    # Seconds after which the lease of a run that was killed can be taken over, keep it above the function timeout
+    'RUN_LEASE_SECONDS': 900,
+    'RUN_PUBLISH_WAIT_SECONDS': 300,
+    # Schedule window of the function as a pandas period, UTC. Once a run of a window completed, other events of the same
+    # window are skipped. None only skips redelivered events
+    'RUN_WINDOW': 'D',
+    # Events published longer ago than this are dropped, Pub/Sub retries a failing event for up to 7 days. None runs
+    # every event
+    'RUN_MAX_EVENT_AGE_SECONDS': 43200,
+    # Sketch of the clv of the customer base in the models bucket, the thresholds of the clv segments are read from it.
+    # The weekly function builds it, the daily aging path replaces it with the aged customer base. A larger k is more accurate
+    'SEGMENT_SKETCH_FILE': 'clv_segment_sketch.json',
+    'SEGMENT_SKETCH_K': 1000
 
     }
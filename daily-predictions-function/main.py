@@ -2,22 +2,22 @@
 # -*- coding: utf-8 -*-
 
 # Load Libaries
-from google.cloud import bigquery
-from google.cloud import bigquery_storage
-from google.cloud import storage
+# google.cloud and lifetimes are imported in the functions that use them,
+# so a cold start only pays for the clients and fitters it actually needs.
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from lifetimes import BetaGeoFitter, ParetoNBDFitter, GammaGammaFitter, utils
-import math
+import contextlib
 import numpy as np
-import os
 import pandas as pd
 import logging
 import re
 import config
-import sys
-from string import Template, capwords
-import pyarrow
+import time
+from string import Template
+import btyd_scoring
+import gcs_transfer
+import run_report
+import run_coordinator
+import quantile_sketch
 
 
 # Set variables
@@ -25,6 +25,7 @@ logger = logging.getLogger(__name__)
 PENALIZER_COEF = config.config_vars['PENALIZER_COEF']
 DISCOUNT_RATE = config.config_vars['DISCOUNT_RATE']
 PREDICTION_LENGTH_IN_MONTHS = config.config_vars['PREDICTION_LENGTH_IN_MONTHS']
+PREDICTION_HORIZONS_IN_MONTHS = config.config_vars['PREDICTION_HORIZONS_IN_MONTHS']
 PREFIX=config.config_vars['PREFIX']
 FREQUENZY= config.config_vars['FREQUENZY']
 GCS_BUCKET_MODELS = config.config_vars['GCS_BUCKET_MODELS']
@@ -33,6 +34,25 @@ LOCAL_STORAGE_FOLDER = config.config_vars['LOCAL_STORAGE_FOLDER']
 TRAINING_DATA_QUERY = config.config_vars['TRAINING_DATA_QUERY']
 ACTUAL_CUSTOMER_VALUE_QUERY = config.config_vars['ACTUAL_CUSTOMER_VALUE_QUERY']
 UPDATE_BIGQUERY_RESULT_TABLE = config.config_vars['UPDATE_BIGQUERY_RESULT_TABLE']
+SCORING_ONLY = config.config_vars['SCORING_ONLY']
+TRANSFER_CHUNK_SIZE_MB = config.config_vars['TRANSFER_CHUNK_SIZE_MB']
+TRANSFER_WORKERS = config.config_vars['TRANSFER_WORKERS']
+TRANSFER_RETRY_SECONDS = config.config_vars['TRANSFER_RETRY_SECONDS']
+TRANSFER_COMPRESSION = config.config_vars['TRANSFER_COMPRESSION']
+GCS_LOCAL_ROOT = config.config_vars['GCS_LOCAL_ROOT']
+STREAM_EXPORT_CHUNK_SIZE = config.config_vars['STREAM_EXPORT_CHUNK_SIZE']
+AGING_STATE_FILE = config.config_vars['AGING_STATE_FILE']
+AGING_SEED_QUERY = config.config_vars['AGING_SEED_QUERY']
+AGING_RESEED_DAYS = config.config_vars['AGING_RESEED_DAYS']
+RUN_REPORT_FILE = config.config_vars['RUN_REPORT_FILE']
+RUN_REPORT_CHANGE_THRESHOLD = config.config_vars['RUN_REPORT_CHANGE_THRESHOLD']
+RUN_COORDINATOR_PREFIX = config.config_vars['RUN_COORDINATOR_PREFIX']
+RUN_LEASE_SECONDS = config.config_vars['RUN_LEASE_SECONDS']
+RUN_PUBLISH_WAIT_SECONDS = config.config_vars['RUN_PUBLISH_WAIT_SECONDS']
+RUN_WINDOW = config.config_vars['RUN_WINDOW']
+RUN_MAX_EVENT_AGE_SECONDS = config.config_vars['RUN_MAX_EVENT_AGE_SECONDS']
+SEGMENT_SKETCH_FILE = config.config_vars['SEGMENT_SKETCH_FILE']
+SEGMENT_SKETCH_K = config.config_vars['SEGMENT_SKETCH_K']
 
 
 
@@ -62,6 +82,8 @@ def load_data_from_bq(training_data_query, actual_customer_value_query):
         training_df, actual_customer_value_df
     """
     try:
+        from google.cloud import bigquery
+
         #Load training data
         query = file_to_string(training_data_query)
         client = bigquery.Client()
@@ -80,14 +102,16 @@ def load_data_from_bq(training_data_query, actual_customer_value_query):
 
 
 # Function that transforms data into RFM summary DF and actual_df
-def transform_data(training_df, actual_customer_value_df, frequency='M'
-                   ):
+def transform_data(training_df, actual_customer_value_df, frequency='M',
+                   scoring_only=False, report=None):
     """ transforms data into RFM summary DF and actual_df.
     Takes the two dataframes you have generated with load_data_from_bq
     as input
     Args:
         training_df: The dataset that will be transformed to summary table
         actual_customer_value_df: Information used for testing
+        scoring_only: Build the summary without importing lifetimes
+        report: RunReport that counts the customers dropped, None does not count
     Returns: 
         
         summary, actual_df
@@ -95,13 +119,22 @@ def transform_data(training_df, actual_customer_value_df, frequency='M'
     try:
         logging.info('Loading data...')
 
-        summary = utils.summary_data_from_transaction_data(training_df,
-                'userId', 'order_date', monetary_value_col='order_value',
-                freq=frequency)
+        if scoring_only:
+            summary = btyd_scoring.summary_data_from_transaction_data(training_df,
+                    frequency)
+        else:
+            from lifetimes import utils
+            summary = utils.summary_data_from_transaction_data(training_df,
+                    'userId', 'order_date', monetary_value_col='order_value',
+                    freq=frequency)
+        if report is not None:
+            report.count_filtered_customers(summary)
         summary = summary[(summary['monetary_value'] > 0)
                         & (summary['frequency'] > 0)]
         actual_df = pd.merge(summary, actual_customer_value_df,
                             left_index=True, right_index=True)
+        if report is not None:
+            report.count('customers_without_actual_value', len(summary) - len(actual_df))
 
         logging.info('Data loaded.')
         return (summary, actual_df)
@@ -130,7 +163,7 @@ def list_blobs_with_prefix(bucket_name, prefix, delimiter=None):
         a/b/
     """
     try:
-        storage_client = storage.Client()
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
 
         # Note: Client.list_blobs requires at least package version 1.17.0.
         blobs = storage_client.list_blobs(
@@ -189,22 +222,28 @@ def find_newest_models(df_with_file_names):
 def download_blob(bucket_name, 
                   source_blob_name, 
                   destination_file_name, 
-                  destination_file_location):
-    """Downloads a blob from a GCS bucket.
+                  destination_file_location,
+                  compression=None):
+    """Downloads a blob from a GCS bucket in chunks.
     Args:
         bucket_name = "your-bucket-name"
         source_blob_name = "storage-object-name"
         destination_file_name = "local/path/to/file"
+        compression = None, gzip or zstd, how the blob is compressed
     Returns:
         Downloads file to local storage
     """
     try:
         destination_file_path = destination_file_location+destination_file_name
-        storage_client = storage.Client()
-
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(source_blob_name)
-        blob.download_to_filename(destination_file_path)
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+
+        gcs_transfer.download_file(storage_client,
+                                   bucket_name,
+                                   source_blob_name,
+                                   destination_file_path,
+                                   TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                   compression,
+                                   TRANSFER_RETRY_SECONDS)
         print(
             "Blob {} downloaded to {}.".format(
                 source_blob_name, destination_file_path
@@ -213,23 +252,54 @@ def download_blob(bucket_name,
     except Exception as error_message:
         logger.error("Fatal in error download_blob function", exc_info=True)
 
+
+def download_blobs(bucket_name, 
+                   source_blob_names, 
+                   destination_file_location):
+    """Downloads blobs from a GCS bucket concurrently in chunks.
+    Args:
+        bucket_name = "your-bucket-name"
+        source_blob_names = names of the blobs, each is saved under its own name
+        destination_file_location = "local/path/"
+    Returns:
+        Downloads files to local storage
+    """
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        transfers = [{'direction': 'download',
+                      'bucket': bucket_name,
+                      'blob': source_blob_name,
+                      'file': destination_file_location+source_blob_name}
+                     for source_blob_name in source_blob_names]
+        gcs_transfer.transfer_files(storage_client,
+                                    transfers,
+                                    TRANSFER_WORKERS,
+                                    TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                    TRANSFER_RETRY_SECONDS)
+    except Exception as error_message:
+        logger.error("Fatal in error download_blobs function", exc_info=True)
+
 # Function that uploads local file to GCS
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    """Uploads a file to the bucket.
+def upload_blob(bucket_name, source_file_name, destination_blob_name, compression=None):
+    """Uploads a file to the bucket in chunks.
     Args:
         bucket_name: Your Google Cloud Storage bucket name
         source_file_name: path+filename of local file
         destination_blob_name: Name of file in Google Cloud Storage
+        compression: None, gzip or zstd, the file is compressed while it is uploaded
     Returns: 
         blob_link: The uri of the file that has been uploaded
     """
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(destination_blob_name)
-
-        blob.upload_from_filename(source_file_name)
-        blob_link = 'gs://{}/{}'.format(bucket_name, destination_blob_name)
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        result = gcs_transfer.upload_file(storage_client,
+                                          bucket_name,
+                                          source_file_name,
+                                          destination_blob_name,
+                                          TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                          compression,
+                                          TRANSFER_RETRY_SECONDS)
+        blob_link = result['blob']
         return blob_link
     except Exception as error_message:
         logger.error("Fatal in error upload_blob function", exc_info=True)
@@ -241,8 +311,12 @@ def upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id):
         blob_link: The uri of the file that will be written to BigQuery
         temporary_table_id: The table is being overwritten with data from the CSV file.
         Make sure the provided table id does not contain any data that should not be overwriten.
+    Returns:
+        True when the table was loaded, None when loading it failed
     """
     try: 
+        from google.cloud import bigquery
+
         # Construct a BigQuery client object.
         client = bigquery.Client()
 
@@ -258,53 +332,268 @@ def upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id):
         load_job.result()  # Waits for the job to complete.
         destination_table = client.get_table(temporary_table_id)
         print("Loaded {} rows to {}.".format(destination_table.num_rows, temporary_table_id))
+        return True
     except Exception as error_message:
         logger.error("Fatal in error upload_cloud_storage_csv_file_to_bq_table function", exc_info=True)
 
+# Function that uploads GCS Parquet file to BQ
+def upload_cloud_storage_parquet_file_to_bq_table(blob_link, temporary_table_id):
+    """Truncates BigQuery table with Parquet file stored in Google Cloud Storage.
+    Args:
+        blob_link: The uri of the file that will be written to BigQuery
+        temporary_table_id: The table is being overwritten with data from the Parquet file.
+        Make sure the provided table id does not contain any data that should not be overwriten.
+    Returns:
+        True when the table was loaded, None when loading it failed
+    """
+    try: 
+        from google.cloud import bigquery
+
+        # Construct a BigQuery client object.
+        client = bigquery.Client()
+
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            source_format=bigquery.SourceFormat.PARQUET
+        )
+        load_job = client.load_table_from_uri(
+            blob_link, temporary_table_id, job_config=job_config
+        )  # Make an API request.
+        load_job.result()  # Waits for the job to complete.
+        destination_table = client.get_table(temporary_table_id)
+        print("Loaded {} rows to {}.".format(destination_table.num_rows, temporary_table_id))
+        return True
+    except Exception as error_message:
+        logger.error("Fatal in error upload_cloud_storage_parquet_file_to_bq_table function", exc_info=True)
+
 # Function that append dataframe to a BigQuery Table
-def upload_new_predictions_to_bigquery(df,
-                            gcs_bucket_predictions,
-                            localFolderPath,
-                            csv_file_name,
-                            temporary_table_id = 'ml_models_production.new_predictions'):
-    """Overwrites BigQuery table with data from dataframe
+def upload_predictions_to_gcs(df,
+                              gcs_bucket_predictions,
+                              localFolderPath,
+                              csv_file_name):
+    """Saves a local CSV file and uploads it to GCS
     Args:
         df: A dataframe with the same schema as destination table
         gcs_bucket_predictions: Google Cloud Storage bucket name that the CSV file with new predictions will be uploaded to.
         csv_file_name: The name of the csv file that will be created for GCS
-        temporary_table_id: The table Id for a temporary table that will be overwritten. Is used for deduplication
-    returns:
-        The function first saves a local csv file, uploads it to GCS, writes 
-        csv file to a temporary table in BigQuery.
+    Returns:
+        blob_link: The uri of the uploaded CSV file
     """
     try:
         # Save local file
         csv_file_path = localFolderPath+csv_file_name
         df.to_csv(csv_file_path, encoding="utf-8", index=False)
-        #Upload local CSV file to GCS
-        blob_link = upload_blob(bucket_name=gcs_bucket_predictions,
-                                source_file_name = csv_file_path,
-                                destination_blob_name = csv_file_name)
-        # Upload CSV file from GCS to temporary BQ table
-        upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id)
+        #Upload local CSV file to GCS, BigQuery loads gzip compressed CSV files as is
+        return upload_blob(bucket_name=gcs_bucket_predictions,
+                           source_file_name = csv_file_path,
+                           destination_blob_name = gcs_transfer.compressed_name(csv_file_name, TRANSFER_COMPRESSION),
+                           compression = TRANSFER_COMPRESSION)
     except Exception as error_message:
-        logger.error("Fatal in error upload_new_predictions_to_bigquery function", exc_info=True)
+        logger.error("Fatal in error upload_predictions_to_gcs function", exc_info=True)
 
 
+# Function that streams prediction chunks to a Parquet file in GCS
+def stream_predictions_to_gcs(output_chunks,
+                              gcs_bucket_predictions,
+                              parquet_file_name):
+    """Writes prediction chunks to a Parquet file that is uploaded while it is written.
+    Each chunk becomes a row group and is encoded and handed to the upload
+    as soon as it has been scored, so only a chunk of predictions and a few
+    upload chunks are held in memory.
+    Args:
+        output_chunks: Iterable of dataframes with the same schema as destination table
+        gcs_bucket_predictions: Google Cloud Storage bucket name that the Parquet file with new predictions will be uploaded to.
+        parquet_file_name: The name of the Parquet file in GCS
+    Returns:
+        blob_link: The uri of the file that has been uploaded, None when there are no predictions
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet as pq
+
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        writer = None
+        rows = 0
+        blob_link = 'gs://{}/{}'.format(gcs_bucket_predictions, parquet_file_name)
+        with gcs_transfer.open_upload_stream(storage_client,
+                                             gcs_bucket_predictions,
+                                             parquet_file_name,
+                                             TRANSFER_CHUNK_SIZE_MB * 1024 ** 2,
+                                             TRANSFER_RETRY_SECONDS) as upload_stream:
+            for chunk in output_chunks:
+                if chunk is None:
+                    raise ValueError('Scoring a chunk of customers failed')
+                table = pyarrow.Table.from_pandas(chunk, preserve_index=False,
+                                                  schema=writer.schema if writer else None)
+                if writer is None:
+                    writer = pq.ParquetWriter(upload_stream, table.schema)
+                writer.write_table(table)
+                rows += len(chunk)
+            if writer is None:
+                logging.warning('No predictions to upload')
+                upload_stream.terminate()
+                return None
+            writer.close()
+        logging.info('Streamed {} predictions to {}'.format(rows, blob_link))
+        return blob_link
+    except Exception as error_message:
+        logger.error("Fatal in error stream_predictions_to_gcs function", exc_info=True)
+
+
+# Function that writes a predictions file in GCS to the clv_and_churn_predictions table
+def publish_predictions(blob_link,
+                        sql_path,
+                        temporary_table_id = 'ml_models_production.new_predictions',
+                        publish_lease=None,
+                        clv_thresholds=None,
+                        time_months=None):
+    """Overwrites the temporary table with a predictions file and merges it into clv_and_churn_predictions.
+    Runs of the weekly function write the same tables, so both steps are
+    done while holding publish_lease.
+    Args:
+        blob_link: The uri of the CSV or Parquet file with new predictions
+        sql_path: Query that merges the temporary table into clv_and_churn_predictions
+        temporary_table_id: The table Id for a temporary table that will be overwritten. Is used for deduplication
+        publish_lease: run_coordinator.Lease shared by the runs that publish, None publishes without it
+        clv_thresholds: Thresholds of the clv segments, see quantile_sketch.clv_thresholds
+        time_months: Horizons in months the file has a predicted_value_next_<months>_month column for,
+                     None takes them from PREDICTION_HORIZONS_IN_MONTHS and PREDICTION_LENGTH_IN_MONTHS
+    Returns:
+        blob_link: The uri of the published file, None when a step failed
+    """
+    try:
+        with publish_lease or contextlib.nullcontext():
+            if blob_link.endswith('.parquet'):
+                loaded = upload_cloud_storage_parquet_file_to_bq_table(blob_link, temporary_table_id)
+            else:
+                loaded = upload_cloud_storage_csv_file_to_bq_table(blob_link, temporary_table_id)
+            if not loaded:
+                raise IOError('Loading {} to {} failed'.format(blob_link, temporary_table_id))
+            # Add new predictions to the clv_and_churn_prediction table and update segments
+            if not update_or_add_new_predictions_to_clv_and_churn_predictions_table(sql_path, clv_thresholds,
+                                                                                   time_months):
+                raise IOError('Updating the clv_and_churn_predictions table with {} failed'.format(sql_path))
+        return blob_link
+    except Exception as error_message:
+        logger.error("Fatal in error publish_predictions function", exc_info=True)
+
+
+# Function that fills in the predicted value columns of the query that updates the clv_and_churn_predictions table
+def update_query(sql_path, time_months=None, clv_thresholds=None):
+    """Reads the update query and fills in a predicted_value_next_<months>_month column for each horizon.
+    The query names the columns with $predicted_value_columns, and with
+    $existing_predicted_value_columns where they are read from the
+    existing clv_and_churn_predictions table. The thresholds of the clv
+    segments are selected in $clv_percentiles, from the query parameters
+    when the clv was sketched and with APPROX_QUANTILES over
+    all_customers_with_clv_predictions when it was not.
+    Args:
+        sql_path: Query that merges the temporary table into clv_and_churn_predictions
+        time_months: Horizons in months, None takes them from PREDICTION_HORIZONS_IN_MONTHS and PREDICTION_LENGTH_IN_MONTHS
+        clv_thresholds: Dict of the query parameters p25, p50 and p75, None computes the thresholds in the query
+    Returns:
+        String with the query
+    """
+    if time_months is None:
+        time_months = set(PREDICTION_HORIZONS_IN_MONTHS or []) | {PREDICTION_LENGTH_IN_MONTHS}
+    columns = ['predicted_value_next_{}_month'.format(months) for months in sorted(time_months)]
+    if clv_thresholds is None:
+        clv_percentiles = 'SELECT {} FROM (SELECT APPROX_QUANTILES(clv, 100) AS percentiles FROM all_customers_with_clv_predictions)'.format(
+            ', '.join('percentiles[OFFSET({})] AS {}'.format(int(round(quantile * 100)), name)
+                      for (name, quantile) in quantile_sketch.CLV_SEGMENT_QUANTILES.items()))
+    else:
+        clv_percentiles = 'SELECT {}'.format(', '.join('@{0} AS {0}'.format(name) for name in clv_thresholds))
+    return Template(file_to_string(sql_path)).substitute(
+        predicted_value_columns=''.join('{}, '.format(column) for column in columns),
+        existing_predicted_value_columns=''.join('excisting_predictions.{}, '.format(column) for column in columns),
+        clv_percentiles=clv_percentiles)
+
 
 # Function that updates or adds new predictions to clv_and_churn_predictions table
-def update_or_add_new_predictions_to_clv_and_churn_predictions_table(sql_path):
-    """ updates or adds new predictions to clv_and_churn_predictions table"""
+def update_or_add_new_predictions_to_clv_and_churn_predictions_table(sql_path, clv_thresholds=None, time_months=None):
+    """ updates or adds new predictions to clv_and_churn_predictions table
+    Args:
+        sql_path: Query that merges the temporary table into clv_and_churn_predictions
+        clv_thresholds: Dict of the query parameters p25, p50 and p75 the clv segments are set with,
+                        None computes them in the query, see update_query
+        time_months: Horizons in months of the predicted value columns, see update_query
+    Returns:
+        True when the query completed, None when it failed
+    """
     try:
+        from google.cloud import bigquery
+
 
         # Update CLV segmentation and Churn probability segmentation
-        query = file_to_string(sql_path)
+        if clv_thresholds is None:
+            logging.warning('No clv sketch thresholds, the clv segments are computed with APPROX_QUANTILES')
+        query = update_query(sql_path, time_months, clv_thresholds)
         client = bigquery.Client()
-        client.query(query)
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(name, 'FLOAT64', value)
+            for (name, value) in (clv_thresholds or {}).items()])
+        # Wait for the query, so no other run publishes before the table has been replaced
+        client.query(query, job_config=job_config).result()
+        return True
     except Exception as error_message:
         logger.error("Fatal in error update_or_add_new_predictions_to_clv_and_churn_predictions_table function", exc_info=True)
 
 
+def score_customers(
+    summary,
+    fitter,
+    ggf,
+    t,
+    time_months,
+    discount_rate,
+    frequency):
+    """Compute the model scores for each customer for one or more horizons.
+    The expected number of purchases is evaluated once per month up to the
+    longest horizon and the discounted value is accumulated along the way,
+    so all horizons are read off the same pass.
+    Args:
+        summary:      RFM transaction data
+        fitter:       lifetimes fitter, previously fit to data
+        ggf:          lifetimes gamma/gamma fitter, already fit to data
+        t:            time(s) to predict purchases in periods of frequency,
+                      one for each horizon in time_months
+        time_months:  horizon(s) to predict value for in months
+    Returns:
+        Dataframe with p_alive and predicted_purchases_<months> and
+        predicted_value_<months> for each horizon and customer in summary
+    """
+    t = np.atleast_1d(t)
+    time_months = np.atleast_1d(time_months)
+    periods_per_month = t[0] / time_months[0]
+    fitter = btyd_scoring.scoring_model(fitter)
+    frequency_values = summary['frequency']
+    recency_values = summary['recency']
+    T_values = summary['T']
+
+    scores = pd.DataFrame(index=summary.index)
+    scores['p_alive'] = fitter.conditional_probability_alive(
+        frequency_values, recency_values, T_values)
+
+    # use the Gamma-Gamma estimates for the monetary_values
+    adjusted_monetary_value = ggf.conditional_expected_average_profit(
+        frequency_values, summary['monetary_value'])
+
+    previous_purchases = 0
+    predicted_value = 0
+    for month in range(1, int(time_months.max()) + 1):
+        purchases = fitter.conditional_expected_number_of_purchases_up_to_time(
+            month * periods_per_month, frequency_values, recency_values, T_values)
+        # sum up the discounted value of the purchases made in this month
+        predicted_value = predicted_value + adjusted_monetary_value \
+            * (purchases - previous_purchases) / (1 + discount_rate) ** month
+        previous_purchases = purchases
+        if month in time_months:
+            scores['predicted_purchases_{}'.format(month)] = np.asarray(purchases)
+            scores['predicted_value_{}'.format(month)] = np.asarray(predicted_value)
+
+    return scores
+
+
 def predict_value(
     summary,
     actual_df,
@@ -313,7 +602,8 @@ def predict_value(
     t,
     time_months,
     discount_rate,
-    frequency
+    frequency,
+    clv_months=None
     ):
     """Predict lifetime values for customers.
     Args:
@@ -322,8 +612,10 @@ def predict_value(
                       actual customer values
         fitter:       lifetimes fitter, previously fit to data
         ggf:          lifetimes gamma/gamma fitter, already fit to data
-        time_days:    time to predict purchases in days
-        time_months:  time to predict value in months
+        t:            time(s) to predict purchases in periods of frequency
+        time_months:  time(s) to predict value in months, a
+                      predicted_value_next_<months>_month column is added for each
+        clv_months:   the horizon used for clv, defaults to the longest horizon
     Returns:
         ltv:  dataframe with predicted values for each customer, along with actual
         values and error
@@ -333,49 +625,32 @@ def predict_value(
         # setup dataframe to hold results
         ltv = actual_df
 
-        predicted_num_purchases = \
-            fitter.conditional_expected_number_of_purchases_up_to_time(t,
-                summary['frequency'], summary['recency'], summary['T'])
-
-        p_alive = fitter.conditional_probability_alive(summary['frequency'
-                ], summary['recency'], summary['T'])
-
-        predicted_value = ggf.customer_lifetime_value(
-            fitter,
-            summary['frequency'],
-            summary['recency'],
-            summary['T'],
-            summary['monetary_value'],
-            time=time_months,
-            discount_rate=discount_rate,
-            freq=frequency,
-            )
+        scores = score_customers(summary, fitter, ggf, t, time_months,
+                                 discount_rate, frequency)
+        p_alive = scores['p_alive']
+        if clv_months is None:
+            clv_months = int(np.max(time_months))
+        value_columns = ['predicted_value_next_{}_month'.format(months)
+                         for months in sorted(np.atleast_1d(time_months))]
 
         # Create ltv table with predicted values
 
-        predicted_value.rename('predicted_value_next_6_month', inplace=True)
         ltv.insert(0, 'userId', ltv.index)
-        ltv = pd.merge(ltv, predicted_value, left_index=True,
-                    right_index=True)
-        predicted_num_purchases.rename('predicted_transactions_next_6_month'
-                                    , inplace=True)
-        ltv = pd.merge(ltv, predicted_num_purchases, left_index=True,
-                    right_index=True)
+        for months in sorted(np.atleast_1d(time_months)):
+            ltv['predicted_value_next_{}_month'.format(months)] = \
+                scores['predicted_value_{}'.format(months)].reindex(ltv.index)
         ltv['predicted_total'] = ltv['current_total_revenue'] \
-            + ltv['predicted_value_next_6_month']
-        ltv.reset_index(drop=True, inplace=True)
-        p_alive = pd.Series(p_alive).rename('p_alive', inplace=True)
+            + ltv['predicted_value_next_{}_month'.format(clv_months)]
         churn = 1 - p_alive
-        ltv['churn_probability'] = pd.Series(churn, index=ltv.index)
+        ltv['churn_probability'] = churn.reindex(ltv.index)
+        ltv.reset_index(drop=True, inplace=True)
 
 
-        model_output = ltv[['userId', 'predicted_total', 'churn_probability'
-                        , 'predicted_value_next_6_month',
-                        'current_total_revenue']].copy()
+        model_output = ltv[['userId', 'predicted_total', 'churn_probability']
+                        + value_columns + ['current_total_revenue']].copy()
 
-        model_output.columns = ['userId', 'clv', 'churn_probability',
-                                'predicted_value_next_6_month',
-                                'current_total_revenue']
+        model_output.columns = ['userId', 'clv', 'churn_probability'] \
+            + value_columns + ['current_total_revenue']
         # Set number of decimals
         model_output.loc[:, model_output.columns != 'churn_probability'] = \
         model_output.loc[:, model_output.columns != 'churn_probability'].round(2)
@@ -385,6 +660,429 @@ def predict_value(
         logger.error("Fatal in error predict_value function", exc_info=True)
 
 
+def predict_value_in_chunks(
+    summary,
+    actual_df,
+    fitter,
+    ggf,
+    t,
+    time_months,
+    discount_rate,
+    frequency,
+    clv_months=None,
+    chunk_size=100000):
+    """Predict lifetime values for customers one chunk of customers at a time.
+    Gives the same rows as predict_value, but only the chunk being
+    scored is held in memory, see predict_value for the arguments.
+    Args:
+        chunk_size:   Number of customers in each chunk
+    Yields:
+        model_output for each chunk, None when scoring the chunk failed
+    """
+    for start in range(0, len(actual_df), chunk_size):
+        chunk_actual_df = actual_df.iloc[start:start + chunk_size].copy()
+        yield predict_value(summary.loc[chunk_actual_df.index],
+                            chunk_actual_df,
+                            fitter,
+                            ggf,
+                            t,
+                            time_months,
+                            discount_rate,
+                            frequency,
+                            clv_months)
+
+
+# Function that finds and loads the newest models in GCS
+def load_newest_models(gcs_bucket_models,
+                       prefix,
+                       local_storage_folder,
+                       penalizer_coef=0,
+                       scoring_only=True):
+    """Downloads and loads the newest fitter and ggf model trained by the weekly function.
+    Args:
+        gcs_bucket_models:      The name of the bucket your models are stored in
+        prefix:                 Prefix to model names that should be loaded
+        local_storage_folder:   The local folder the models are downloaded to
+        penalizer_coef:         Penalizer used in fitter and ggf models
+        scoring_only:           Load the saved model parameters without importing lifetimes
+    Returns:
+        fitter, ggf
+    """
+    try:
+        clv_models = list_blobs_with_prefix(gcs_bucket_models, prefix)
+        files_to_download = find_newest_models(clv_models)
+        # Model parameters are saved as .json for scoring and as .pkl fitters
+        if scoring_only and not files_to_download.str.endswith('.json').any():
+            logging.info('No model parameters found, loading lifetimes fitters instead')
+            scoring_only = False
+        model_extension = '.json' if scoring_only else '.pkl'
+        files_to_download = files_to_download[files_to_download.str.endswith(model_extension)]
+        download_blobs(gcs_bucket_models, 
+                       files_to_download, 
+                       local_storage_folder)
+    # Load fitter and ggf model for last trained model
+        logging.info('Loading model...')
+
+        if scoring_only:
+            for file in files_to_download:
+                if 'ggf' in file:
+                    ggf = btyd_scoring.load_model_params(local_storage_folder+file)
+                else:
+                    fitter = btyd_scoring.load_model_params(local_storage_folder+file)
+        else:
+            from lifetimes import BetaGeoFitter, ParetoNBDFitter, GammaGammaFitter
+            for file in files_to_download:
+                if 'BGNBD' in file:
+                    fitter = BetaGeoFitter(penalizer_coef=penalizer_coef)
+                    fitter.load_model(local_storage_folder+file)
+                if 'PARETO' in file:
+                    fitter = ParetoNBDFitter(penalizer_coef=penalizer_coef)
+                    fitter.load_model(local_storage_folder+file)
+                if 'ggf' in file:
+                    ggf = GammaGammaFitter(penalizer_coef=penalizer_coef)
+                    ggf.load_model(local_storage_folder+file)
+
+        logging.info('Done.')
+        return (fitter, ggf)
+    except Exception as error_message:
+        logger.error("Fatal in error load_newest_models function", exc_info=True)
+
+
+def prediction_periods(prediction_length_in_months, frequency='M',
+                       prediction_horizons_in_months=None):
+    """Convert the prediction horizons in months to periods of frequency.
+    Args:
+        prediction_length_in_months:    The number of month you want to predict, used for clv
+        frequency:                      The frequency used to calculate your summary table
+        prediction_horizons_in_months:  Additional horizons in months to predict value for in the same pass
+    Returns:
+        t, time_months, clv_months
+    """
+    # compute the number of days in the prediction period
+
+    if frequency == 'D':
+        t = prediction_length_in_months*30
+        time_months = prediction_length_in_months
+    elif frequency == 'W':
+        t = prediction_length_in_months*4.345
+        time_months = prediction_length_in_months
+    elif frequency == 'M':
+        t = prediction_length_in_months
+        time_months = prediction_length_in_months
+        
+    else:
+        logging.error('Please either choose D, W or M as input for freuency'
+                    )
+        print('Please either choose D, W or M as input for freuency')
+
+    # Predict all horizons in the same pass, clv uses prediction_length_in_months
+    clv_months = time_months
+    time_months = sorted(set(prediction_horizons_in_months or []) | {clv_months})
+    t = [t * months / clv_months for months in time_months]
+    return (t, time_months, clv_months)
+
+
+# Function that loads transactions from Bigquery
+def load_transactions_from_bq(training_data_query):
+    """Load the transactions returned by a query from Bigquery.
+    Args:
+        training_data_query: Query that returns userId, order_date, order_value
+    Returns:
+        training_df
+    """
+    try:
+        from google.cloud import bigquery
+
+        query = file_to_string(training_data_query)
+        client = bigquery.Client()
+        return client.query(query).to_dataframe()
+    except Exception as error_message:
+        logger.error("Fatal in error load_transactions_from_bq function", exc_info=True)
+
+
+# Function that loads the RFM state of the whole customer base
+def load_rfm_state(bucket_name, state_file_name, local_storage_folder):
+    """Downloads the RFM state saved by the previous aging run.
+    Args:
+        bucket_name: Google Cloud Storage bucket the state is stored in
+        state_file_name: Name of the state file in Google Cloud Storage
+        local_storage_folder: The local folder the state is downloaded to
+    Returns:
+        (state, seed), state made by rfm_state and the seed it records, both None when no state has been saved yet
+    """
+    try:
+        import rfm_state
+
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        blob = storage_client.bucket(bucket_name).blob(state_file_name)
+        if not blob.exists():
+            return (None, None)
+        download_blob(bucket_name, state_file_name, state_file_name,
+                      local_storage_folder)
+        return rfm_state.load_state(local_storage_folder+state_file_name)
+    except Exception as error_message:
+        logger.error("Fatal in error load_rfm_state function", exc_info=True)
+
+
+# Function that finds the date of the newest models in GCS
+def newest_model_date(gcs_bucket_models, prefix):
+    """Date of the newest models trained by the weekly function.
+    Args:
+        gcs_bucket_models:  The name of the bucket your models are stored in
+        prefix:             Prefix to model names
+    Returns:
+        Date in the names of the newest models, None when there are none
+    """
+    try:
+        clv_models = list_blobs_with_prefix(gcs_bucket_models, prefix)
+        dates = [date for date in map(extract_date_from_string, clv_models['file']) if date is not None]
+        return max(dates) if dates else None
+    except Exception as error_message:
+        logger.error("Fatal in error newest_model_date function", exc_info=True)
+
+
+def load_clv_sketch(bucket_name, sketch_file_name, local_storage_folder, k=1000):
+    """Downloads the clv sketch saved by the weekly function and the daily aging path.
+    Args:
+        bucket_name: Google Cloud Storage bucket the sketch is stored in
+        sketch_file_name: Name of the sketch file in Google Cloud Storage
+        local_storage_folder: The local folder the sketch is downloaded to
+        k: Size of the sketch made when none has been saved yet
+    Returns:
+        quantile_sketch.KLLSketch, empty when no sketch has been saved yet, None when loading it failed
+    """
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        blob = storage_client.bucket(bucket_name).blob(sketch_file_name)
+        if not blob.exists():
+            logging.info('No clv sketch found, the clv segments are set from the customers of this run')
+            return quantile_sketch.KLLSketch(k)
+        download_blob(bucket_name, sketch_file_name, sketch_file_name,
+                      local_storage_folder)
+        return quantile_sketch.load_sketch(local_storage_folder+sketch_file_name)
+    except Exception as error_message:
+        logger.error("Fatal in error load_clv_sketch function", exc_info=True)
+
+
+def save_clv_sketch(sketch, bucket_name, sketch_file_name, local_storage_folder):
+    """Saves the clv sketch and uploads it for the next run.
+    Returns:
+        blob_link: The uri of the uploaded sketch, None when saving it failed
+    """
+    try:
+        quantile_sketch.save_sketch(sketch, local_storage_folder+sketch_file_name)
+        return upload_blob(bucket_name, local_storage_folder+sketch_file_name, sketch_file_name)
+    except Exception as error_message:
+        logger.error("Fatal in error save_clv_sketch function", exc_info=True)
+
+
+# Function that saves the report of a run next to the models in GCS
+def save_run_report(report, bucket_name, report_file_name, local_storage_folder,
+                    change_threshold=0.5):
+    """Compares the report of this run with the previous run and uploads it.
+    The report is uploaded under report_file_name, which the next run
+    compares with, and under a name with the run date, so the reports of
+    all runs are kept.
+    Args:
+        report: RunReport of this run
+        bucket_name: Google Cloud Storage bucket the reports are stored in
+        report_file_name: Name of the report of the last run in Google Cloud Storage
+        local_storage_folder: The local folder the reports are saved to
+        change_threshold: Relative change of a count or drop in throughput that gives a warning
+    Returns:
+        The report as a dict
+    """
+    try:
+        storage_client = gcs_transfer.storage_client(GCS_LOCAL_ROOT)
+        previous = None
+        if storage_client.bucket(bucket_name).blob(report_file_name).exists():
+            download_blob(bucket_name, report_file_name, report_file_name,
+                          local_storage_folder)
+            previous = run_report.load_report(local_storage_folder+report_file_name)
+        finished_report = report.finish(previous, change_threshold)
+        dated_file_name = run_report.suffixed_name(report_file_name, finished_report['run_date'])
+        # The latest and the dated copy are saved as separate files and both uploaded
+        run_report.save_report(finished_report, local_storage_folder+report_file_name)
+        run_report.save_report(finished_report, local_storage_folder+dated_file_name)
+        # The report is finished, so a failed upload can only be logged
+        for file_name in [report_file_name, dated_file_name]:
+            if upload_blob(bucket_name, local_storage_folder+file_name, file_name) is None:
+                logging.error('Uploading the run report {} failed'.format(file_name))
+        return finished_report
+    except Exception as error_message:
+        logger.error("Fatal in error save_run_report function", exc_info=True)
+
+
+def age_customer_base(
+    training_data_query,
+    aging_seed_query,
+    prediction_length_in_months,
+    gcs_bucket_models,
+    gcs_bucket_predictions,
+    prefix,
+    local_storage_folder,
+    frequency='M',
+    penalizer_coef=0,
+    discount_rate=0.01,
+    prediction_horizons_in_months=None,
+    scoring_only=True,
+    stream_export_chunk_size=None,
+    aging_state_file='clv_rfm_state.parquet',
+    report=None,
+    publish_lease=None,
+    segment_sketch_file=None,
+    segment_sketch_k=1000,
+    aging_reseed_days=7):
+    """Rescore the whole customer base as of today and write the rows that changed.
+    Customers who did not buy still age, as T grows, so their churn
+    probability and clv are recomputed from a compact per-customer RFM
+    state kept in GCS. The purchases since yesterday are merged into the
+    state, every customer is scored and only customers whose rounded
+    outputs or models changed since the last run are written to BigQuery.
+    The first run builds the state from the full history, and it is built
+    again whenever the weekly function trained new models and at least
+    every aging_reseed_days. Merging only the purchases since yesterday
+    misses the purchases of days without a run, refunds and customers
+    leaving the customers of the seed query, rebuilding the state brings
+    them in. As every customer is scored, the clv segments are set from a
+    sketch of the clv of the whole customer base made on this run.
+  Args:
+        training_data_query:        Query that returns userId, order_date, order_value of customers who bought since yesterday
+        aging_seed_query:           Query that returns userId, order_date, order_value of all customers
+        aging_state_file:           Name of the RFM state file in the models bucket
+        report:                     RunReport the counts and stages are recorded in
+        publish_lease:              run_coordinator.Lease held while writing the BigQuery tables shared with other runs
+        segment_sketch_file:        Name of the clv sketch file in the models bucket, None does not save it
+        aging_reseed_days:          Days after which the state is built again from the full history, None only when
+                                    there are new models
+        see run_btyd for the other arguments
+  """
+    if report is None:
+        report = run_report.RunReport('daily')
+    try:
+        # Only the aging mode reads and writes the RFM state, which needs pyarrow.parquet
+        import rfm_state
+
+        start_time = time.time()
+        today = pd.Timestamp(datetime.today().date())
+        (state, seed) = load_rfm_state(gcs_bucket_models, aging_state_file, local_storage_folder) or (None, None)
+        models_date = newest_model_date(gcs_bucket_models, prefix)
+        models_date = None if models_date is None else models_date.strftime('%Y-%m-%d')
+        reseed_reason = None
+        if state is None:
+            reseed_reason = 'no RFM state found'
+        elif seed is None:
+            reseed_reason = 'the RFM state does not record when it was built'
+        elif models_date is not None and seed.get('models_date') != models_date:
+            reseed_reason = 'the weekly function trained new models on {}'.format(models_date)
+        elif aging_reseed_days and (today - pd.Timestamp(seed['seeded_on'])).days >= aging_reseed_days:
+            reseed_reason = 'the RFM state was built on {}'.format(seed['seeded_on'])
+        report.detail('rfm_state_seeded', reseed_reason is not None)
+        if reseed_reason is not None:
+            logging.info('Building the RFM state from the full history, {}'.format(reseed_reason))
+            report.detail('rfm_state_seed_reason', reseed_reason)
+            seed = {'seeded_on': today.strftime('%Y-%m-%d'), 'models_date': models_date}
+            training_df = load_transactions_from_bq(aging_seed_query)
+        else:
+            training_df = load_transactions_from_bq(training_data_query)
+        if training_df is None:
+            raise IOError('Loading the transactions from BigQuery failed')
+        if state is None:
+            state = rfm_state.empty_state()
+        logging.info('Loaded RFM state of {} customers and {} new transactions in {:.1f}s'.format(
+            len(state), len(training_df), time.time() - start_time))
+        report.count('transactions', len(training_df))
+        report.add_stage('load', start_time, len(state) + len(training_df),
+                         state.memory_usage(index=False).sum() + training_df.memory_usage(index=False).sum())
+
+        transform_start_time = time.time()
+        if reseed_reason is not None:
+            state = rfm_state.reseed_state(state,
+                                           rfm_state.state_from_transactions(training_df,
+                                                                             frequency,
+                                                                             today,
+                                                                             report)
+                                           if not training_df.empty else rfm_state.empty_state())
+            report.add_stage('transform', transform_start_time, len(training_df))
+        elif not training_df.empty:
+            state = rfm_state.update_state(state,
+                                           rfm_state.state_from_transactions(training_df,
+                                                                             frequency,
+                                                                             today,
+                                                                             report))
+            report.add_stage('transform', transform_start_time, len(training_df))
+        report.count('customers_in_state', len(state))
+        if state.empty:
+            logging.warning('No customers to calculate CLV for / BigQuery did not return any results')
+            return
+
+        models = load_newest_models(gcs_bucket_models,
+                                    prefix,
+                                    local_storage_folder,
+                                    penalizer_coef,
+                                    scoring_only)
+        if models is None:
+            raise IOError('Loading the newest models failed')
+        (fitter, ggf) = models
+        (t, time_months, clv_months) = prediction_periods(prediction_length_in_months,
+                                                          frequency,
+                                                          prediction_horizons_in_months)
+
+        score_start_time = time.time()
+        model_output = rfm_state.score_state(state, fitter, ggf, t, time_months,
+                                             discount_rate, frequency, today, clv_months)
+        hashes = rfm_state.output_hashes(model_output, models_date)
+        changed = hashes != state['output_hash'].to_numpy()
+        sketch = quantile_sketch.KLLSketch(segment_sketch_k).update(model_output['clv'])
+        clv_thresholds = quantile_sketch.clv_thresholds(sketch)
+        report.detail('clv_thresholds', clv_thresholds)
+        model_output = model_output[changed]
+        logging.info('{} of {} customers have changed predictions'.format(len(model_output), len(state)))
+        report.add_stage('score', score_start_time, len(state))
+        report.check_outputs(model_output)
+
+        if len(model_output):
+            write_start_time = time.time()
+            today_string = today.strftime("%Y%m%d")
+            if stream_export_chunk_size:
+                output_chunks = (model_output.iloc[start:start + stream_export_chunk_size]
+                                 for start in range(0, len(model_output), stream_export_chunk_size))
+                blob_link = stream_predictions_to_gcs(output_chunks,
+                                                      gcs_bucket_predictions,
+                                                      'daily_predictions_'+today_string+'.parquet')
+            else:
+                blob_link = upload_predictions_to_gcs(model_output,
+                                                      gcs_bucket_predictions,
+                                                      local_storage_folder,
+                                                      'daily_predictions_'+today_string+'.csv')
+            report.add_stage('write', write_start_time, len(model_output),
+                             gcs_transfer.blob_size(gcs_transfer.storage_client(GCS_LOCAL_ROOT), blob_link))
+            if blob_link is None:
+                raise IOError('Uploading the predictions failed')
+            publish_start_time = time.time()
+            if publish_predictions(blob_link,
+                                   UPDATE_BIGQUERY_RESULT_TABLE,
+                                   'ml_models_production.new_predictions',
+                                   publish_lease,
+                                   clv_thresholds,
+                                   time_months) is None:
+                raise IOError('Publishing the predictions to BigQuery failed')
+            report.add_stage('publish', publish_start_time, len(model_output))
+
+        # Save the state once the changed rows are written, so a failed write is repeated tomorrow
+        state['output_hash'] = hashes
+        rfm_state.save_state(state, local_storage_folder+aging_state_file, seed)
+        if upload_blob(gcs_bucket_models, local_storage_folder+aging_state_file, aging_state_file) is None:
+            report.error('Uploading the RFM state failed')
+        if segment_sketch_file and save_clv_sketch(sketch, gcs_bucket_models, segment_sketch_file,
+                                                   local_storage_folder) is None:
+            report.error('Uploading the clv sketch failed')
+        logging.info('Aged the customer base in {:.1f}s'.format(time.time() - start_time))
+    except Exception as error_message:
+        logger.error("Fatal in error age_customer_base function", exc_info=True)
+        report.error(repr(error_message))
+
+
 def run_btyd(
     training_data_query,
     actual_customer_value_query,
@@ -395,7 +1093,19 @@ def run_btyd(
     local_storage_folder,
     frequency='M',
     penalizer_coef=0,
-    discount_rate=0.01):
+    discount_rate=0.01,
+    prediction_horizons_in_months=None,
+    scoring_only=True,
+    stream_export_chunk_size=None,
+    aging_state_file=None,
+    aging_seed_query=None,
+    run_report_file=None,
+    run_report_change_threshold=0.5,
+    publish_lease=None,
+    segment_sketch_file=None,
+    segment_sketch_k=1000,
+    aging_reseed_days=7,
+    run_lease=None):
     """Run selected BTYD model on data loaded from BigQuery and save model to GCS and predictions to BQ
   Args:
         training_data_query:        Query that returns userId, order_date, order_value
@@ -408,92 +1118,184 @@ def run_btyd(
         frequency:                  The frequency used to calculate your summary table
         penalizer_coef:             Penalizer used in fitter and ggf models
         discount_rate:              Used to discount future revenue to current day value
+        prediction_horizons_in_months: Additional horizons in months to predict value for in the same pass
+        scoring_only:               Score with the saved model parameters without importing lifetimes
+        stream_export_chunk_size:   Number of customers scored and uploaded at a time, None scores everyone before uploading
+        aging_state_file:           Name of the RFM state file in the models bucket, None only scores customers who bought since yesterday
+        aging_seed_query:           Query that returns the transactions of all customers, used to build the RFM state
+        run_report_file:            Name of the run report in the models bucket, None does not save a report
+        run_report_change_threshold: Relative change since the previous run report that gives a warning
+        publish_lease:              run_coordinator.Lease held while writing the BigQuery tables shared with other runs
+        segment_sketch_file:        Name of the clv sketch file in the models bucket the thresholds of the clv segments are
+                                    read from. Only the weekly function and the aging path save it, as this run only
+                                    scores customers who are already in it. None, or no saved sketch, uses this run
+        segment_sketch_k:           Size of the clv sketch, see quantile_sketch
+        aging_reseed_days:          Days after which the RFM state is built again from the full history, it is also built
+                                    again when the weekly function trained new models
+        run_lease:                  run_coordinator.Lease of the run, renewed after each stage so a long run keeps it
+    Returns:
+        Report of the run as a dict, see run_report.RunReport
   """
+    report = run_report.RunReport('daily')
+    if run_lease is not None:
+        report.stage_callbacks.append(run_lease.renew)
+    report.detail('frequency', frequency)
+    report.detail('scoring_only', scoring_only)
+    report.detail('aging', bool(aging_state_file))
     try:
-        (training_df, actual_customer_value_df) = load_data_from_bq(training_data_query,
-                                                                    actual_customer_value_query)
+        if aging_state_file:
+            age_customer_base(training_data_query,
+                              aging_seed_query,
+                              prediction_length_in_months,
+                              gcs_bucket_models,
+                              gcs_bucket_predictions,
+                              prefix,
+                              local_storage_folder,
+                              frequency,
+                              penalizer_coef,
+                              discount_rate,
+                              prediction_horizons_in_months,
+                              scoring_only,
+                              stream_export_chunk_size,
+                              aging_state_file,
+                              report,
+                              publish_lease,
+                              segment_sketch_file,
+                              segment_sketch_k,
+                              aging_reseed_days)
+            return report.report
+
+        load_start_time = time.time()
+        loaded = load_data_from_bq(training_data_query, actual_customer_value_query)
+        if loaded is None:
+            raise IOError('Loading the transactions from BigQuery failed')
+        (training_df, actual_customer_value_df) = loaded
+        report.count('transactions', len(training_df))
+        report.count('actual_customer_values', len(actual_customer_value_df))
+        report.add_stage('load', load_start_time, len(training_df),
+                         training_df.memory_usage(index=False).sum())
         
         if (training_df.empty or actual_customer_value_df.empty):
-            sys.exit('No new customers to calculate CLV for / BigQuery did not return any results. Script will not continue to run')
+            # Returned, so the run is recorded as empty instead of the event being delivered again
+            logging.warning('No new customers to calculate CLV for / BigQuery did not return any results')
+            return report.report
 
         # load training transaction data
 
+        transform_start_time = time.time()
         (summary, actual_df) = transform_data(training_df,
-                actual_customer_value_df, frequency)
-
-        # Find newest trained fitter and ggf model in GCS and download.
-        clv_models = list_blobs_with_prefix(gcs_bucket_models, prefix)
-        files_to_download = find_newest_models(clv_models)
-        for file in files_to_download:
-            download_blob(gcs_bucket_models, 
-                        file, 
-                        file, 
-                        local_storage_folder)
-    # Load fitter and ggf model for last trained model
-        logging.info('Loading model...')
+                actual_customer_value_df, frequency, scoring_only, report)
+        report.add_stage('transform', transform_start_time, len(training_df))
+        report.count('customers_scored', len(actual_df))
+
+        # Find newest trained fitter and ggf model in GCS and load them
+        models = load_newest_models(gcs_bucket_models,
+                                    prefix,
+                                    local_storage_folder,
+                                    penalizer_coef,
+                                    scoring_only)
+        if models is None:
+            raise IOError('Loading the newest models failed')
+        (fitter, ggf) = models
 
-        for file in files_to_download:
-            if 'BGNBD' in file:
-                fitter = BetaGeoFitter(penalizer_coef=penalizer_coef)
-                fitter.load_model(local_storage_folder+file)
-            if 'PARETO' in file:
-                fitter = ParetoNBDFitter(penalizer_coef=penalizer_coef)
-                fitter.load_model(local_storage_folder+file)
-            if 'ggf' in file:
-                ggf = GammaGammaFitter(penalizer_coef=penalizer_coef)
-                ggf.load_model(local_storage_folder+file)
+        # use loaded fitter to predicted ltv for each user
+        (t, time_months, clv_months) = prediction_periods(prediction_length_in_months,
+                                                          frequency,
+                                                          prediction_horizons_in_months)
 
-        logging.info('Done.')
+        # The thresholds of the clv segments are read from the sketch of the customer base. The customers scored
+        # are already in it, so it is not updated, the customers of this run are only used when none was saved
+        base_sketch = None
+        if segment_sketch_file:
+            base_sketch = load_clv_sketch(gcs_bucket_models, segment_sketch_file, local_storage_folder, segment_sketch_k)
+        sketch = quantile_sketch.KLLSketch(segment_sketch_k)
 
-    
-        # use loaded fitter to predicted ltv for each user
-    
-        # compute the number of days in the prediction period
-
-        if frequency == 'D':
-            t = prediction_length_in_months/30
-            time_months = prediction_length_in_months
-        elif frequency == 'w':
-            t = prediction_length_in_months/4
-            time_months = prediction_length_in_months
-        elif frequency == 'M':
-            t = prediction_length_in_months
-            time_months = prediction_length_in_months
-            
-        else:
-            logging.error('Please either choose D, W or M as input for freuency'
-                        )
-            print('Please either choose D, W or M as input for freuency')
-
-        # Get new predictions
-        model_output = predict_value(summary,
-                                    actual_df,
-                                    fitter,
-                                    ggf,
-                                    t,
-                                    time_months,
-                                    discount_rate,
-                                    frequency)
-
-        # Upload model predictions to temporary BigQuery table
         today = datetime.today().strftime("%Y%m%d")
-        csv_file_name = 'daily_predictions_'+today+'.csv'
-        upload_new_predictions_to_bigquery(model_output,
-                                            gcs_bucket_predictions,
-                                            local_storage_folder,
-                                            csv_file_name,
-                                            'ml_models_production.new_predictions')
+        if stream_export_chunk_size:
+            # Score, write and upload the predictions one chunk of customers at a time
+            score_start_time = time.time()
+            output_chunks = predict_value_in_chunks(summary,
+                                                    actual_df,
+                                                    fitter,
+                                                    ggf,
+                                                    t,
+                                                    time_months,
+                                                    discount_rate,
+                                                    frequency,
+                                                    clv_months,
+                                                    stream_export_chunk_size)
+            blob_link = stream_predictions_to_gcs(report.track_outputs(sketch.track(output_chunks, 'clv')),
+                                                  gcs_bucket_predictions,
+                                                  'daily_predictions_'+today+'.parquet')
+            report.add_stage('score_and_write', score_start_time, report.output_rows,
+                             gcs_transfer.blob_size(gcs_transfer.storage_client(GCS_LOCAL_ROOT), blob_link))
+        else:
+            # Get new predictions
+            score_start_time = time.time()
+            model_output = predict_value(summary,
+                                        actual_df,
+                                        fitter,
+                                        ggf,
+                                        t,
+                                        time_months,
+                                        discount_rate,
+                                        frequency,
+                                        clv_months)
+            report.check_outputs(model_output)
+            if model_output is not None:
+                sketch.update(model_output['clv'])
+            report.add_stage('score', score_start_time, len(actual_df))
+
+            # Upload model predictions to GCS
+            write_start_time = time.time()
+            csv_file_name = 'daily_predictions_'+today+'.csv'
+            blob_link = upload_predictions_to_gcs(model_output,
+                                                  gcs_bucket_predictions,
+                                                  local_storage_folder,
+                                                  csv_file_name)
+            report.add_stage('write', write_start_time, report.output_rows,
+                             gcs_transfer.blob_size(gcs_transfer.storage_client(GCS_LOCAL_ROOT), blob_link))
+        if blob_link is None and report.output_rows:
+            report.error('Uploading the predictions failed')
+        clv_thresholds = quantile_sketch.clv_thresholds(base_sketch if base_sketch else sketch)
+        report.detail('clv_thresholds', clv_thresholds)
         
-        # Add new predictions to the clv_and_churn_prediction table and update segments
-        update_or_add_new_predictions_to_clv_and_churn_predictions_table(UPDATE_BIGQUERY_RESULT_TABLE)
+        # Load the predictions to a temporary BigQuery table and add them to the clv_and_churn_prediction table
+        if blob_link is not None:
+            publish_start_time = time.time()
+            if publish_predictions(blob_link,
+                                   UPDATE_BIGQUERY_RESULT_TABLE,
+                                   'ml_models_production.new_predictions',
+                                   publish_lease,
+                                   clv_thresholds,
+                                   time_months) is None:
+                report.error('Publishing the predictions to BigQuery failed')
+            report.add_stage('publish', publish_start_time, report.output_rows)
 
         logging.info('CLV and Churn Predections has been uploaded to BigQuery')
     except Exception as error_message:
         logger.error("Fatal in error run_btyd function", exc_info=True)
+        report.error(repr(error_message))
+    finally:
+        if run_report_file:
+            save_run_report(report,
+                            gcs_bucket_models,
+                            run_report_file,
+                            local_storage_folder,
+                            run_report_change_threshold)
+        else:
+            report.finish()
+    return report.report
 
 
 def main(data, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
+    Events older than RUN_MAX_EVENT_AGE_SECONDS are dropped. With a
+    RUN_COORDINATOR_PREFIX redelivered events of runs that completed, and
+    events of a RUN_WINDOW that already has a completed run, are skipped,
+    see run_coordinator. A run that failed, or an event that arrived while
+    another run was still going on, raises, so the event is delivered
+    again when the function is deployed with retries enabled.
     Args:
         data (dict): Event payload.
         context (google.cloud.functions.Context): Metadata for the event.
@@ -504,8 +1306,16 @@ def main(data, context):
         log_message = Template('Cloud Function was triggered on $time')
         logging.info(log_message.safe_substitute(time=current_time))
 
-        try:
-            run_btyd(TRAINING_DATA_QUERY,
+        published = getattr(context, 'timestamp', None)
+        published = pd.Timestamp(published).timestamp() if published else None
+        if RUN_MAX_EVENT_AGE_SECONDS and published and time.time() - published > RUN_MAX_EVENT_AGE_SECONDS:
+            # Returning acknowledges the event, the next scheduled event runs instead
+            logging.warning('Dropping event {} published {:.0f}s ago, older than RUN_MAX_EVENT_AGE_SECONDS'.format(
+                getattr(context, 'event_id', None), time.time() - published))
+            return
+
+        def run(publish_lease=None, run_lease=None):
+            return run_btyd(TRAINING_DATA_QUERY,
                      ACTUAL_CUSTOMER_VALUE_QUERY,
                      PREDICTION_LENGTH_IN_MONTHS,
                      GCS_BUCKET_MODELS,
@@ -514,15 +1324,40 @@ def main(data, context):
                      LOCAL_STORAGE_FOLDER,
                      FREQUENZY,
                      PENALIZER_COEF,
-                     DISCOUNT_RATE)           
-
-        except Exception as error:
-            log_message = Template('Predictions failed due to '
-                                   '$message.')
-            logging.error(log_message.safe_substitute(message=error))
+                     DISCOUNT_RATE,
+                     PREDICTION_HORIZONS_IN_MONTHS,
+                     SCORING_ONLY,
+                     STREAM_EXPORT_CHUNK_SIZE,
+                     AGING_STATE_FILE,
+                     AGING_SEED_QUERY,
+                     RUN_REPORT_FILE,
+                     RUN_REPORT_CHANGE_THRESHOLD,
+                     publish_lease,
+                     SEGMENT_SKETCH_FILE,
+                     SEGMENT_SKETCH_K,
+                     AGING_RESEED_DAYS,
+                     run_lease)
+
+        if RUN_COORDINATOR_PREFIX:
+            coordinator = run_coordinator.RunCoordinator(gcs_transfer.storage_client(GCS_LOCAL_ROOT),
+                                                         GCS_BUCKET_MODELS,
+                                                         'daily',
+                                                         RUN_COORDINATOR_PREFIX,
+                                                         RUN_LEASE_SECONDS,
+                                                         RUN_PUBLISH_WAIT_SECONDS)
+            window = str(pd.Timestamp(published or time.time(), unit='s').to_period(RUN_WINDOW)) if RUN_WINDOW else None
+            coordinator.run(getattr(context, 'event_id', None),
+                            run,
+                            published,
+                            window)
+        else:
+            report = run()
+            if report.get('status') == 'failed':
+                raise run_coordinator.RunNotCompleted('Run failed with {}'.format(report.get('errors')))
 
     except Exception as error:
-        log_message = Template('$error').substitute(error=error)
-        logging.error(log_message)
-
-
+        log_message = Template('Predictions failed due to '
+                               '$message.')
+        logging.error(log_message.safe_substitute(message=error))
+        # Raised, so Pub/Sub delivers the event again
+        raise
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import json
+import logging
+import numpy as np
+
+# Set variables
+logger = logging.getLogger(__name__)
+# Increase when the keys of a saved sketch change, sketches of other versions are not loaded
+SKETCH_VERSION = 1
+# Capacity of the top level of the sketch. The rank error of a quantile is typically below 2 / k
+# of the number of values and below 3 / k for the worst of many quantiles, merged sketches included.
+# Sketches of up to k values are exact
+DEFAULT_K = 1000
+# Each level below the top keeps this share of the capacity of the level above it
+CAPACITY_DECAY = 2.0 / 3.0
+MIN_LEVEL_CAPACITY = 2
+# Quantiles of clv that separate the clv segments, named as the parameters of the update queries
+CLV_SEGMENT_QUANTILES = {'p25': 0.25, 'p50': 0.5, 'p75': 0.75}
+
+
+class KLLSketch(object):
+    """Streaming quantile sketch of Karnin, Lang and Liberty (KLL).
+    Values are added to the bottom level. When a level is over capacity it
+    is sorted and every other value, starting at a random offset, moves
+    up a level with twice the weight, so the sketch keeps O(k) values
+    however many are added. Sketches with the same k can be merged, which
+    gives the same accuracy as one sketch of all their values, so chunks
+    of customers and runs of other days can be sketched apart.
+    """
+
+    def __init__(self, k=DEFAULT_K, seed=0):
+        """
+        Args:
+            k:      Capacity of the top level, a larger k is more accurate
+            seed:   Seed of the offsets of the compactions, None draws them at random
+        """
+        self.k = int(k)
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.levels = [np.empty(0)]
+        self._random = np.random.default_rng(seed)
+
+    def __len__(self):
+        """Number of values added to the sketch."""
+        return self.count
+
+    def _capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(MIN_LEVEL_CAPACITY, int(np.ceil(self.k * CAPACITY_DECAY ** depth)))
+
+    def _compress(self):
+        """Compact levels until every level is within its capacity."""
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(values)
+                # An odd value stays behind, so the weight of the sketch does not change
+                kept = values[:len(values) % 2]
+                promoted = values[len(kept) + self._random.integers(2)::2]
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                # Adding a level lowers the capacity of the levels below it
+                level = 0
+            else:
+                level += 1
+
+    def update(self, values):
+        """Add values to the sketch, NaN and infinite values are skipped."""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.min = float(values.min()) if self.min is None else min(self.min, float(values.min()))
+        self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Add the values of another sketch with the same k to this sketch."""
+        if other.k != self.k:
+            raise ValueError('Cannot merge sketches with k {} and {}'.format(self.k, other.k))
+        if other.count == 0:
+            return self
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for (level, values) in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+        return self
+
+    def track(self, output_chunks, column):
+        """Pass chunks of outputs on to the writer, adding their column to the sketch."""
+        for chunk in output_chunks:
+            if chunk is not None:
+                self.update(chunk[column])
+            yield chunk
+
+    def quantiles(self, quantiles):
+        """Values at the quantiles, the smallest value whose rank is at least quantile * count.
+        Args:
+            quantiles:  Quantiles between 0 and 1
+        Returns:
+            Array with a value for each quantile, NaN when the sketch is empty
+        """
+        quantiles = np.atleast_1d(np.asarray(quantiles, dtype=float))
+        if self.count == 0:
+            return np.full(len(quantiles), np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_values), 2.0 ** level)
+                                  for (level, level_values) in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values = values[order]
+        ranks = np.cumsum(weights[order])
+        positions = np.searchsorted(ranks, quantiles * ranks[-1], side='left')
+        result = values[np.minimum(positions, len(values) - 1)]
+        # The smallest and largest values are kept apart, they may have been compacted away
+        result = np.where(quantiles <= 0, self.min, result)
+        return np.where(quantiles >= 1, self.max, result)
+
+    def to_dict(self):
+        """Sketch as a dict of lists that can be saved as JSON."""
+        return {'sketch_version': SKETCH_VERSION,
+                'k': self.k,
+                'count': self.count,
+                'min': self.min,
+                'max': self.max,
+                'levels': [values.tolist() for values in self.levels]}
+
+    @classmethod
+    def from_dict(cls, content, seed=0):
+        """Sketch saved with to_dict."""
+        if content.get('sketch_version') != SKETCH_VERSION:
+            raise ValueError('Sketch version {} is not {}'.format(content.get('sketch_version'),
+                                                                  SKETCH_VERSION))
+        sketch = cls(content['k'], seed)
+        sketch.count = int(content['count'])
+        sketch.min = content['min']
+        sketch.max = content['max']
+        sketch.levels = [np.asarray(values, dtype=float) for values in content['levels']] or [np.empty(0)]
+        return sketch
+
+
+def clv_thresholds(sketch):
+    """Thresholds of the clv segments, the parameters p25, p50 and p75 of the update queries.
+    Returns:
+        Dict of the threshold of each parameter, None when the sketch is empty
+    """
+    if len(sketch) == 0:
+        return None
+    values = sketch.quantiles(list(CLV_SEGMENT_QUANTILES.values()))
+    return {name: round(float(value), 2) for (name, value) in zip(CLV_SEGMENT_QUANTILES, values)}
+
+
+def save_sketch(sketch, file_path):
+    """Save a sketch to a local JSON file."""
+    with open(file_path, 'w') as sketch_file:
+        json.dump(sketch.to_dict(), sketch_file)
+
+
+def load_sketch(file_path, seed=0):
+    """Load a sketch saved with save_sketch."""
+    with open(file_path, 'r') as sketch_file:
+        return KLLSketch.from_dict(json.load(sketch_file), seed)
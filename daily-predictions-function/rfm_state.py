@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import json
+import logging
+import time
+import numpy as np
+import pandas as pd
+import btyd_scoring
+
+# Set variables
+logger = logging.getLogger(__name__)
+EPOCH = np.datetime64('1970-01-01', 'D')
+# Compact per-customer state, periods are stored as the day their period starts
+STATE_DTYPES = {'first_day': np.int32,
+                'last_day': np.int32,
+                'frequency': np.int32,
+                'monetary_value': np.float64,
+                'current_total_revenue': np.float64,
+                'output_hash': np.uint64}
+# Key of the Parquet metadata that records when the state was built from the full history
+SEED_METADATA_KEY = b'clv_rfm_state_seed'
+
+
+def period_start_day(date, frequency):
+    """Days since 1970-01-01 of the first day of the period date falls in."""
+    period_start = pd.Timestamp(date).to_period(frequency).to_timestamp()
+    return int((np.datetime64(period_start, 'D') - EPOCH).astype(np.int64))
+
+
+def empty_state():
+    """State without customers."""
+    state = pd.DataFrame({column: pd.Series(dtype=dtype)
+                          for column, dtype in STATE_DTYPES.items()})
+    state.index.name = 'userId'
+    return state
+
+
+def state_from_transactions(transactions, frequency, observation_period_end, report=None):
+    """Build state rows from the full history of a set of customers.
+    Keeps the same customers as transform_data, those with repeat
+    purchases and a positive monetary value. current_total_revenue is
+    the sum of the order values, as in the customer summary query.
+    Args:
+        transactions:           Transactions with userId, order_date, order_value
+        frequency:              The frequency used to calculate your summary table (D, W, M)
+        observation_period_end: Date of this run
+        report:                 RunReport that counts the customers dropped, None does not count
+    Returns:
+        Dataframe indexed on userId with the STATE_DTYPES columns, output_hash is 0
+    """
+    summary = btyd_scoring.summary_data_from_transaction_data(transactions, frequency,
+                                                              observation_period_end)
+    if report is not None:
+        report.count_filtered_customers(summary)
+    summary = summary[(summary['monetary_value'] > 0) & (summary['frequency'] > 0)]
+    period_length = btyd_scoring.PERIOD_LENGTH_IN_DAYS[frequency]
+    end_day = period_start_day(observation_period_end, frequency)
+
+    state = pd.DataFrame(index=summary.index)
+    state['first_day'] = end_day - np.rint(summary['T'] * period_length)
+    state['last_day'] = state['first_day'] + np.rint(summary['recency'] * period_length)
+    state['frequency'] = summary['frequency']
+    state['monetary_value'] = summary['monetary_value']
+    state['current_total_revenue'] = transactions.groupby('userId')['order_value'].sum() \
+        .reindex(summary.index)
+    state['output_hash'] = 0
+    state.index.name = 'userId'
+    return state.astype(STATE_DTYPES)
+
+
+def update_state(state, updates):
+    """Replace the rows of customers with new purchases and add new customers.
+    The output_hash of existing customers is kept, so only customers whose
+    outputs actually change are written.
+    Args:
+        state:      State of all customers
+        updates:    State rows made by state_from_transactions
+    Returns:
+        Updated state
+    """
+    # isin hashes the few updated customers, reindex would hash the whole state
+    existing = state.index.isin(updates.index)
+    updates = updates.copy()
+    updates['output_hash'] = state.loc[existing, 'output_hash'].reindex(updates.index).fillna(0) \
+        .astype(np.uint64)
+    return pd.concat([state[~existing], updates])
+
+
+def reseed_state(state, seed_rows):
+    """Replace the state with rows built from the full history.
+    Customers who are no longer in the full history are dropped and the
+    output_hash of the customers in both is kept, so only customers whose
+    outputs change are written.
+    Args:
+        state:      State of all customers, None when there is none
+        seed_rows:  State rows of all customers made by state_from_transactions
+    Returns:
+        New state
+    """
+    seed_rows = seed_rows.copy()
+    if state is not None:
+        seed_rows['output_hash'] = state['output_hash'].reindex(seed_rows.index).fillna(0) \
+            .astype(np.uint64)
+    return seed_rows
+
+
+def decay_table(keys, fitter, t, time_months, discount_rate, frequency, end_day):
+    """Churn and discounted purchases for each distinct purchase history.
+    Customers with the same number of repeat purchases and the same first
+    and last purchase period share p_alive and expected purchases. The
+    models are evaluated once per history and not once per customer.
+    Args:
+        keys:           Dataframe with frequency, first_day and last_day of each distinct history
+        fitter:         lifetimes fitter or btyd_scoring model, previously fit to data
+        t:              time(s) to predict purchases in periods of frequency, one for each horizon
+        time_months:    horizon(s) to predict value for in months
+        discount_rate:  Used to discount future revenue to current day value
+        frequency:      The frequency used to calculate your summary table (D, W, M)
+        end_day:        First day of the period of this run
+    Returns:
+        Dataframe with p_alive and, for each horizon, discounted_purchases_<months>.
+        Multiplied with the gamma-gamma profit this is the predicted value.
+    """
+    t = np.atleast_1d(t)
+    time_months = np.atleast_1d(time_months)
+    periods_per_month = t[0] / time_months[0]
+    fitter = btyd_scoring.scoring_model(fitter)
+    period_length = btyd_scoring.PERIOD_LENGTH_IN_DAYS[frequency]
+    x = keys['frequency'].to_numpy(dtype=float)
+    recency = (keys['last_day'].to_numpy(dtype=float) - keys['first_day'].to_numpy(dtype=float)) / period_length
+    T = (end_day - keys['first_day'].to_numpy(dtype=float)) / period_length
+
+    table = pd.DataFrame(index=keys.index)
+    table['p_alive'] = np.asarray(fitter.conditional_probability_alive(x, recency, T))
+    previous_purchases = 0
+    discounted_purchases = 0
+    for month in range(1, int(time_months.max()) + 1):
+        purchases = np.asarray(fitter.conditional_expected_number_of_purchases_up_to_time(
+            month * periods_per_month, x, recency, T))
+        discounted_purchases = discounted_purchases \
+            + (purchases - previous_purchases) / (1 + discount_rate) ** month
+        previous_purchases = purchases
+        if month in time_months:
+            table['discounted_purchases_{}'.format(month)] = discounted_purchases
+    return table
+
+
+def score_state(state,
+                fitter,
+                ggf,
+                t,
+                time_months,
+                discount_rate,
+                frequency,
+                observation_period_end,
+                clv_months=None):
+    """Predict lifetime values for every customer in the state as of a date.
+    Gives the rows of predict_value for the whole customer base, with T
+    aged to observation_period_end.
+    Args:
+        state:                  State of all customers
+        fitter:                 lifetimes fitter or btyd_scoring model, previously fit to data
+        ggf:                    lifetimes gamma/gamma fitter or btyd_scoring model, already fit to data
+        t:                      time(s) to predict purchases in periods of frequency
+        time_months:            time(s) to predict value in months
+        discount_rate:          Used to discount future revenue to current day value
+        frequency:              The frequency used to calculate your summary table (D, W, M)
+        observation_period_end: Date of this run
+        clv_months:             the horizon used for clv, defaults to the longest horizon
+    Returns:
+        model_output with the columns of predict_value
+    """
+    start_time = time.time()
+    time_months = sorted(np.atleast_1d(time_months))
+    if clv_months is None:
+        clv_months = int(np.max(time_months))
+    end_day = period_start_day(observation_period_end, frequency)
+
+    # One key per distinct purchase history, first and last day fit in 16 bits each
+    first_day = state['first_day'].to_numpy(dtype=np.int64)
+    last_day = state['last_day'].to_numpy(dtype=np.int64)
+    x = state['frequency'].to_numpy(dtype=np.int64)
+    min_day = first_day.min() if len(first_day) else 0
+    (codes, keys) = pd.factorize((x << 32) | ((first_day - min_day) << 16) | (last_day - first_day))
+    keys = pd.DataFrame({'frequency': keys >> 32,
+                         'first_day': ((keys >> 16) & 0xFFFF) + min_day,
+                         'last_day': ((keys >> 16) & 0xFFFF) + min_day + (keys & 0xFFFF)})
+    table = decay_table(keys, fitter, t, time_months, discount_rate, frequency, end_day)
+    table_seconds = time.time() - start_time
+
+    # use the Gamma-Gamma estimates for the monetary_values
+    adjusted_monetary_value = np.asarray(ggf.conditional_expected_average_profit(
+        state['frequency'].to_numpy(dtype=float), state['monetary_value'].to_numpy()))
+    current_total_revenue = state['current_total_revenue'].to_numpy()
+
+    model_output = pd.DataFrame({'userId': state.index})
+    model_output['clv'] = current_total_revenue + adjusted_monetary_value \
+        * table['discounted_purchases_{}'.format(clv_months)].to_numpy()[codes]
+    model_output['churn_probability'] = 1 - table['p_alive'].to_numpy()[codes]
+    for months in time_months:
+        model_output['predicted_value_next_{}_month'.format(months)] = adjusted_monetary_value \
+            * table['discounted_purchases_{}'.format(months)].to_numpy()[codes]
+    model_output['current_total_revenue'] = current_total_revenue
+    # Set number of decimals
+    value_columns = model_output.columns[~model_output.columns.isin(['userId', 'churn_probability'])]
+    model_output[value_columns] = model_output[value_columns].round(2)
+    model_output['churn_probability'] = model_output['churn_probability'].round(4)
+
+    logging.info('Aged {} customers with {} distinct purchase histories in {:.2f}s, '
+                 'decay table took {:.2f}s'.format(len(state), len(keys),
+                                                   time.time() - start_time, table_seconds))
+    return model_output
+
+
+def output_hashes(model_output, model_version=None):
+    """64 bit hash of the rounded outputs of each customer, without the userId.
+    The model version is part of the hash, so every customer counts as
+    changed once new models are used, even when the rounded outputs are
+    the same. The weekly function has written its own predictions by then.
+    """
+    hashes = pd.util.hash_pandas_object(model_output.drop(columns='userId'), index=False).to_numpy()
+    if model_version is not None:
+        hashes = hashes ^ pd.util.hash_pandas_object(pd.Series([str(model_version)]), index=False).to_numpy()[0]
+    return hashes
+
+
+def save_state(state, file_path, seed=None):
+    """Save the state to a local Parquet file.
+    Args:
+        state:      State of all customers
+        file_path:  path+filename of local file
+        seed:       Dict describing when the state was built from the full history, kept in the file metadata
+    """
+    import pyarrow
+    import pyarrow.parquet as pq
+
+    table = pyarrow.Table.from_pandas(state.reset_index(), preserve_index=False)
+    if seed is not None:
+        metadata = dict(table.schema.metadata or {})
+        metadata[SEED_METADATA_KEY] = json.dumps(seed)
+        table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, file_path)
+
+
+def load_state(file_path):
+    """Load a state saved with save_state.
+    Returns:
+        (state, seed), seed is None when the file does not record it
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(file_path)
+    seed = (table.schema.metadata or {}).get(SEED_METADATA_KEY)
+    return (table.to_pandas().set_index('userId').astype(STATE_DTYPES),
+            None if seed is None else json.loads(seed))
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+from datetime import datetime
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import time
+import traceback
+import numpy as np
+import pandas as pd
+
+# Set variables
+logger = logging.getLogger(__name__)
+# Increase when the keys of a baseline change, baselines of other versions are not compared
+BASELINE_VERSION = 1
+# Relative slowdown or memory growth since the baseline that is flagged
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.25
+# Cases faster or smaller than this are too noisy to flag
+MIN_COMPARED_SECONDS = 0.5
+MIN_COMPARED_MEMORY_MB = 20.0
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB."""
+    with open('/proc/self/status', 'r') as status_file:
+        for line in status_file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def max_rss_mb():
+    """Peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def environment():
+    """Versions and machine the results were measured on, results of other environments compare poorly."""
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def _run_in_child(function, repeat, results):
+    """Run function repeat times and put the fastest time and the memory it used on results."""
+    try:
+        start_rss = current_rss_mb()
+        times = []
+        info = None
+        for _ in range(repeat):
+            start_time = time.time()
+            info = function()
+            times.append(time.time() - start_time)
+        results.put({'seconds': round(min(times), 3),
+                     'start_rss_mb': round(start_rss, 1),
+                     'peak_rss_mb': round(max_rss_mb(), 1),
+                     'rss_growth_mb': round(max_rss_mb() - start_rss, 1),
+                     'info': info if isinstance(info, dict) else {}})
+    except Exception:
+        results.put({'error': traceback.format_exc(limit=5)})
+
+
+def run_case(name, size, function, repeat=1):
+    """Time a case of the suite in its own forked process.
+    The inputs made before the fork are shared with the process, so only
+    the memory the case itself takes shows in rss_growth_mb, and the peak
+    of one case does not hide the next.
+    Args:
+        name:       Name of the case, usually the function it times
+        size:       Number of customers, or of files, the case runs on
+        function:   Called without arguments, may return a dict of counts to keep with the result
+        repeat:     Number of runs, the fastest is kept
+    Returns:
+        Dict with case, size, seconds, start_rss_mb, peak_rss_mb, rss_growth_mb
+        and info, or with error when the case failed
+    """
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=_run_in_child, args=(function, repeat, results))
+    process.start()
+    process.join()
+    try:
+        result = results.get(timeout=5)
+    except queue.Empty:
+        result = {'error': 'Process exited with code {}'.format(process.exitcode)}
+    result = dict({'case': name, 'size': int(size)}, **result)
+    if 'error' in result:
+        logging.error('Benchmark {} at {} failed: {}'.format(name, size, result['error']))
+    else:
+        logging.info('Benchmark {} at {}: {}s, {} MB'.format(name, size, result['seconds'],
+                                                              result['rss_growth_mb']))
+    return result
+
+
+def case_sizes(cases, sizes):
+    """Sizes to run each case at.
+    Args:
+        cases:  Names of the cases
+        sizes:  Sizes to run every case at, or dict of case name to its sizes
+    Returns:
+        Dict of case name to its sizes
+    """
+    if isinstance(sizes, dict):
+        return {name: list(sizes[name]) for name in cases}
+    return {name: list(sizes) for name in cases}
+
+
+def run_suite(suite_name, cases, sizes, repeat=1, selected=None):
+    """Run the cases of a suite at each size.
+    The cases run size by size, so the inputs made for a size are shared
+    by every case that runs at it.
+    Args:
+        suite_name: Name of the suite, weekly or daily
+        cases:      Dict of case name to a function of the size that returns the function to time.
+                    The inputs are made when it is called, before the fork, and are not timed
+        sizes:      Sizes to run every case at, or dict of case name to its sizes
+        repeat:     Number of runs of each case, the fastest is kept
+        selected:   Names of the cases to run, None runs them all
+    Returns:
+        Baseline as a dict, see save_baseline
+    """
+    sizes = case_sizes(cases, sizes)
+    results = []
+    for size in sorted(set(size for name in sizes for size in sizes[name])):
+        for (name, make_case) in cases.items():
+            if (selected and name not in selected) or size not in sizes[name]:
+                continue
+            results.append(run_case(name, size, make_case(size), repeat))
+    return {'baseline_version': BASELINE_VERSION,
+            'suite': suite_name,
+            'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'environment': environment(),
+            'repeat': repeat,
+            'results': results}
+
+
+def _relative_change(previous, current):
+    """(current - previous) / previous, None when there is nothing to compare."""
+    if previous is None or current is None or previous <= 0:
+        return None
+    return round((current - previous) / previous, 4)
+
+
+def compare_baselines(baseline, current,
+                      time_tolerance=TIME_TOLERANCE,
+                      memory_tolerance=MEMORY_TOLERANCE):
+    """Compare the results of a run with a baseline.
+    A case is flagged when it got slower or its memory grew by more than
+    the tolerance, or when it fails and did not fail in the baseline.
+    Cases that are only in one of them are noted. Time is only compared
+    for cases that take MIN_COMPARED_SECONDS and memory for cases that
+    take MIN_COMPARED_MEMORY_MB.
+    Args:
+        baseline:           Baseline made by run_suite
+        current:            Results of this run made by run_suite
+        time_tolerance:     Relative slowdown that is flagged
+        memory_tolerance:   Relative growth of rss_growth_mb that is flagged
+    Returns:
+        Dict with the changes of each case, the regressions and notes
+    """
+    if baseline.get('baseline_version') != BASELINE_VERSION:
+        raise ValueError('Baseline version {} is not {}'.format(baseline.get('baseline_version'),
+                                                                BASELINE_VERSION))
+    notes = []
+    if baseline['suite'] != current['suite']:
+        notes.append('Comparing suite {} with a baseline of suite {}'.format(current['suite'],
+                                                                            baseline['suite']))
+    if baseline['environment'] != current['environment']:
+        notes.append('Environment changed from {} to {}'.format(baseline['environment'],
+                                                                current['environment']))
+    previous_results = {(result['case'], result['size']): result for result in baseline['results']}
+    current_keys = set()
+    changes = []
+    regressions = []
+    for result in current['results']:
+        key = (result['case'], result['size'])
+        current_keys.add(key)
+        previous = previous_results.get(key)
+        if previous is None:
+            notes.append('{} at {} is not in the baseline'.format(*key))
+            continue
+        if 'error' in result:
+            if 'error' not in previous:
+                regressions.append('{} at {} failed'.format(*key))
+            continue
+        if 'error' in previous:
+            continue
+        change = {'case': key[0],
+                  'size': key[1],
+                  'seconds': result['seconds'],
+                  'baseline_seconds': previous['seconds'],
+                  'time_change': _relative_change(previous['seconds'], result['seconds']),
+                  'rss_growth_mb': result['rss_growth_mb'],
+                  'baseline_rss_growth_mb': previous['rss_growth_mb'],
+                  'memory_change': _relative_change(previous['rss_growth_mb'], result['rss_growth_mb'])}
+        changes.append(change)
+        if change['time_change'] is not None and change['time_change'] > time_tolerance \
+                and max(result['seconds'], previous['seconds']) >= MIN_COMPARED_SECONDS:
+            regressions.append('{} at {} slowed down by {:+.0%}, {}s to {}s'.format(
+                key[0], key[1], change['time_change'], previous['seconds'], result['seconds']))
+        if change['memory_change'] is not None and change['memory_change'] > memory_tolerance \
+                and max(result['rss_growth_mb'], previous['rss_growth_mb']) >= MIN_COMPARED_MEMORY_MB:
+            regressions.append('{} at {} memory grew by {:+.0%}, {} MB to {} MB'.format(
+                key[0], key[1], change['memory_change'], previous['rss_growth_mb'], result['rss_growth_mb']))
+    for key in sorted(set(previous_results) - current_keys):
+        notes.append('{} at {} did not run'.format(*key))
+    return {'baseline_created': baseline['created'],
+            'changes': changes,
+            'regressions': regressions,
+            'notes': notes}
+
+
+def save_baseline(baseline, file_path):
+    """Save the results of run_suite to a local JSON file."""
+    with open(file_path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+
+
+def load_baseline(file_path):
+    """Load results saved with save_baseline."""
+    with open(file_path, 'r') as baseline_file:
+        return json.load(baseline_file)
+
+
+def print_comparison(comparison):
+    """Print the changes of each case, the notes and the regressions."""
+    print('{:<28} {:>10} {:>10} {:>10} {:>8} {:>12} {:>12} {:>8}'.format(
+        'case', 'size', 'baseline s', 'seconds', 'change', 'baseline MB', 'MB', 'change'))
+    for change in comparison['changes']:
+        print('{:<28} {:>10} {:>10} {:>10} {:>8} {:>12} {:>12} {:>8}'.format(
+            change['case'], change['size'], change['baseline_seconds'], change['seconds'],
+            '' if change['time_change'] is None else '{:+.0%}'.format(change['time_change']),
+            change['baseline_rss_growth_mb'], change['rss_growth_mb'],
+            '' if change['memory_change'] is None else '{:+.0%}'.format(change['memory_change'])))
+    for note in comparison['notes']:
+        print('Note: {}'.format(note))
+    for regression in comparison['regressions']:
+        print('Regression: {}'.format(regression))
+    if not comparison['regressions']:
+        print('No regressions since the baseline of {}'.format(comparison['baseline_created']))
+
+
+def command_line(suite_name, cases, default_sizes, description, baseline_file=None):
+    """Command line of a suite with a run and a compare command.
+    run times the cases and writes the results to a JSON file, which is
+    kept as the baseline. compare compares a run with a baseline, or runs
+    the suite first when only the baseline is given, and exits with 1 when
+    a case regressed. Without a baseline compare uses baseline_file, the
+    baseline committed next to the suite. default_sizes are the sizes of
+    every case, or a dict of case name to its sizes, --sizes replaces them
+    for every case.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Run the suite and save the results as a baseline')
+    compare_parser = commands.add_parser('compare', help='Compare results with a baseline')
+    compare_parser.add_argument('baseline', nargs='?', default=baseline_file,
+                                help='JSON file written by run, {} when left out'.format(baseline_file))
+    compare_parser.add_argument('current', nargs='?',
+                                help='JSON file written by run, runs the suite when left out')
+    compare_parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+    compare_parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE)
+    for command_parser in [run_parser, compare_parser]:
+        command_parser.add_argument('--sizes', type=int, nargs='+',
+                                    help='Sizes to run every case at, the default sizes of each case when left out')
+        command_parser.add_argument('--cases', nargs='+', choices=list(cases),
+                                    help='Cases to run, all when left out')
+        command_parser.add_argument('--repeat', type=int, default=1)
+        command_parser.add_argument('--output', help='Write the results of the run to this JSON file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.command == 'compare' and (not args.baseline or not os.path.exists(args.baseline)):
+        parser.error('No baseline at {}, write one with run --output'.format(args.baseline))
+
+    if args.command == 'compare' and args.current:
+        current = load_baseline(args.current)
+    else:
+        current = run_suite(suite_name, cases, args.sizes or default_sizes, args.repeat, args.cases)
+        if args.output:
+            save_baseline(current, args.output)
+    if args.command == 'run':
+        if not args.output:
+            print(json.dumps(current, indent=2))
+        return 0
+    comparison = compare_baselines(load_baseline(args.baseline), current,
+                                   args.time_tolerance, args.memory_tolerance)
+    print_comparison(comparison)
+    return 1 if comparison['regressions'] else 0
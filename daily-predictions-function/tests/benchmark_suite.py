@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load Libaries
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import benchmark_baseline
+
+FUNCTION_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules of the function are imported by name, as Cloud Functions does
+sys.path.insert(0, FUNCTION_FOLDER)
+
+import btyd_scoring
+import main
+import rfm_state
+
+# Set variables
+logger = logging.getLogger(__name__)
+# Model files in the bucket of the model cases, customers of the aging cases and new interpreters of the import case
+MODEL_FILE_SIZES = [100, 1000, 10000]
+CUSTOMER_SIZES = [100000, 1000000, 10000000]
+IMPORT_SIZES = [1]
+# Baseline committed with the suite, compare uses it when no baseline is given
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_suite_baseline.json')
+MODEL_FILES = [('clv_model_BGNBD_{}.json', {'model_type': 'BGNBD',
+                                            'params': {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}}),
+               ('clv_model_BGNBD_{}.pkl', None),
+               ('clv_model_ggf_{}.json', {'model_type': 'GGF', 'params': {'p': 6.0, 'q': 4.0, 'v': 15.0}}),
+               ('clv_model_ggf_{}.pkl', None)]
+FITTER_PARAMS = {'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}
+GGF_PARAMS = {'p': 6.0, 'q': 4.0, 'v': 15.0}
+# Day the customer base is aged to, and share of the customers who bought the day before
+RUN_DATE = '2026-10-20'
+NEW_BUYERS = 0.001
+_inputs = {}
+_states = {}
+
+
+def synthetic_state(customers, seed=0, observation_period_end='2026-10-19', history_months=60):
+    """Generate a seeded monthly RFM state without generating transactions.
+    Args:
+        customers:              Number of customers
+        seed:                   Seed for the random generator
+        observation_period_end: Date of the run the state is aged to
+        history_months:         Longest customer history in months
+    Returns:
+        State in the rfm_state format
+    """
+    rng = np.random.default_rng(seed)
+    end_month = np.datetime64(pd.Timestamp(observation_period_end).strftime('%Y-%m'), 'M')
+    first_month = end_month - rng.integers(1, history_months + 1, customers)
+    span = rng.integers(1, (end_month - first_month).astype(int) + 1)
+    last_month = first_month + span
+    frequency = 1 + rng.binomial(span - 1, 0.3)
+
+    state = pd.DataFrame(index=pd.Index(['customer_{:08d}'.format(customer) for customer in range(customers)],
+                                        name='userId'))
+    state['first_day'] = (first_month.astype('datetime64[D]') - rfm_state.EPOCH).astype(np.int32)
+    state['last_day'] = (last_month.astype('datetime64[D]') - rfm_state.EPOCH).astype(np.int32)
+    state['frequency'] = frequency
+    state['monetary_value'] = np.round(rng.gamma(6.0, 2.5, customers) * 10, 2)
+    state['current_total_revenue'] = np.round(state['monetary_value'] * (frequency + 1), 2)
+    state['output_hash'] = 0
+    return state.astype(rfm_state.STATE_DTYPES)
+
+
+def inputs(size):
+    """Models bucket with size model files, four for each weekly run, and as many run records.
+    Made once per size before the cases fork, so every case shares them.
+    """
+    if _inputs.get('size') != size:
+        _inputs.clear()
+        bucket_folder = os.path.join(main.GCS_LOCAL_ROOT, 'models_{}'.format(size))
+        os.makedirs(os.path.join(bucket_folder, 'clv_runs', 'daily', 'all', 'events'))
+        weeks = max(1, size // len(MODEL_FILES))
+        for date in pd.date_range(end='2026-10-19', periods=weeks, freq='7D'):
+            for (file_name, content) in MODEL_FILES:
+                with open(os.path.join(bucket_folder, file_name.format(date.strftime('%Y-%m-%d'))), 'w') as model_file:
+                    json.dump(content, model_file)
+        for event in range(weeks * len(MODEL_FILES)):
+            with open(os.path.join(bucket_folder, 'clv_runs', 'daily', 'all', 'events',
+                                   '{}.json'.format(event)), 'w') as record_file:
+                json.dump({'event_id': event}, record_file)
+        _inputs.update(size=size,
+                       bucket_name='models_{}'.format(size),
+                       clv_models=main.list_blobs_with_prefix('models_{}'.format(size), main.PREFIX))
+    return _inputs
+
+
+def _checked(result, name):
+    """Result of a function of main, which logs its errors and returns None."""
+    if result is None:
+        raise RuntimeError('{} failed, see the log'.format(name))
+    return result
+
+
+def list_blobs_with_prefix_case(size):
+    data = inputs(size)
+
+    def case():
+        clv_models = _checked(main.list_blobs_with_prefix(data['bucket_name'], main.PREFIX),
+                              'list_blobs_with_prefix')
+        return {'files': len(clv_models)}
+    return case
+
+
+def find_newest_models_case(size):
+    data = inputs(size)
+
+    def case():
+        files = _checked(main.find_newest_models(data['clv_models']), 'find_newest_models')
+        return {'files': len(data['clv_models']), 'newest_files': len(files)}
+    return case
+
+
+def load_newest_models_case(size):
+    data = inputs(size)
+
+    def case():
+        local_storage_folder = tempfile.mkdtemp(dir=os.path.dirname(main.GCS_LOCAL_ROOT)) + '/'
+        _checked(main.load_newest_models(data['bucket_name'], main.PREFIX,
+                                         local_storage_folder, main.PENALIZER_COEF, True),
+                 'load_newest_models')
+        return {'files': len(data['clv_models'])}
+    return case
+
+
+def state_inputs(size):
+    """RFM state of size customers, scored as of the day before RUN_DATE, and the customers who bought since.
+    Made once per size before the cases fork, so every case shares them.
+    """
+    if _states.get('size') != size:
+        _states.clear()
+        fitter = btyd_scoring.BetaGeoModel(FITTER_PARAMS)
+        ggf = btyd_scoring.GammaGammaModel(GGF_PARAMS)
+        periods = main.prediction_periods(main.PREDICTION_LENGTH_IN_MONTHS, 'M', main.PREDICTION_HORIZONS_IN_MONTHS)
+        state = synthetic_state(size)
+        state['output_hash'] = rfm_state.output_hashes(rfm_state.score_state(
+            state, fitter, ggf, periods[0], periods[1], main.DISCOUNT_RATE, 'M', '2026-10-19', periods[2]))
+
+        rng = np.random.default_rng(1)
+        buyers = state.iloc[rng.choice(size, int(size * NEW_BUYERS), replace=False)].copy()
+        run_day = rfm_state.period_start_day(RUN_DATE, 'M')
+        buyers['frequency'] = np.where(buyers['last_day'] < run_day, buyers['frequency'] + 1, buyers['frequency'])
+        buyers['last_day'] = run_day
+        buyers['current_total_revenue'] = buyers['current_total_revenue'] + buyers['monetary_value']
+        _states.update(size=size,
+                       fitter=fitter,
+                       ggf=ggf,
+                       periods=periods,
+                       state=state,
+                       buyers=buyers.drop(columns='output_hash'))
+    return _states
+
+
+def age_state_case(size):
+    """Case that merges the buyers into the state, scores every customer and finds the rows that changed, like age_customer_base."""
+    data = state_inputs(size)
+    (t, time_months, clv_months) = data['periods']
+
+    def case():
+        state = rfm_state.update_state(data['state'], data['buyers'])
+        model_output = rfm_state.score_state(state, data['fitter'], data['ggf'], t, time_months,
+                                             main.DISCOUNT_RATE, 'M', RUN_DATE, clv_months)
+        changed = rfm_state.output_hashes(model_output) != state['output_hash'].to_numpy()
+        return {'customers': len(state), 'changed_rows': int(changed.sum())}
+    return case
+
+
+def predict_value_case(size):
+    """Case that scores every customer of the state on its own with predict_value, what the aging replaced."""
+    data = state_inputs(size)
+    (t, time_months, clv_months) = data['periods']
+    state = data['state']
+    end_day = rfm_state.period_start_day(RUN_DATE, 'M')
+    summary = pd.DataFrame(index=state.index)
+    summary['frequency'] = state['frequency'].astype(float)
+    summary['recency'] = (state['last_day'] - state['first_day']) / btyd_scoring.PERIOD_LENGTH_IN_DAYS['M']
+    summary['T'] = (end_day - state['first_day']) / btyd_scoring.PERIOD_LENGTH_IN_DAYS['M']
+    summary['monetary_value'] = state['monetary_value']
+
+    def case():
+        model_output = _checked(main.predict_value(summary, state[['current_total_revenue']].copy(),
+                                                   data['fitter'], data['ggf'], t, time_months,
+                                                   main.DISCOUNT_RATE, 'M', clv_months),
+                                'predict_value')
+        return {'rows': len(model_output)}
+    return case
+
+
+def import_main_case(size):
+    """Case that imports main in size new interpreters, the import of a cold start."""
+    def case():
+        for _ in range(size):
+            subprocess.run([sys.executable, '-c', 'import main'], cwd=FUNCTION_FOLDER, check=True)
+        return {'imports': size}
+    return case
+
+
+CASES = {'list_blobs_with_prefix': list_blobs_with_prefix_case,
+         'find_newest_models': find_newest_models_case,
+         'load_newest_models': load_newest_models_case,
+         'age_state': age_state_case,
+         'predict_value': predict_value_case,
+         'import_main': import_main_case}
+DEFAULT_SIZES = {'list_blobs_with_prefix': MODEL_FILE_SIZES,
+                 'find_newest_models': MODEL_FILE_SIZES,
+                 'load_newest_models': MODEL_FILE_SIZES,
+                 'age_state': CUSTOMER_SIZES,
+                 # Scores each customer on its own, too slow for the largest base
+                 'predict_value': CUSTOMER_SIZES[:2],
+                 'import_main': IMPORT_SIZES}
+
+
+if __name__ == '__main__':
+    # The config names the SQL files relative to the function folder
+    os.chdir(FUNCTION_FOLDER)
+    root = tempfile.mkdtemp(prefix='benchmark_suite_')
+    try:
+        main.GCS_LOCAL_ROOT = os.path.join(root, 'buckets')
+        exit_code = benchmark_baseline.command_line(
+            'daily', CASES, DEFAULT_SIZES,
+            'Time finding and loading the newest models in a bucket of model files, and aging a synthetic '
+            'customer base, and compare them with a baseline.',
+            BASELINE_FILE)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    sys.exit(exit_code)
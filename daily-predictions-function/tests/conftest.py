@@ -0,0 +1,13 @@
+import os
+import sys
+import pytest
+
+FUNCTION_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules of the function are imported by name, as Cloud Functions does
+sys.path.insert(0, FUNCTION_FOLDER)
+
+
+@pytest.fixture(autouse=True)
+def function_folder(monkeypatch):
+    """Run each test in the function folder, the config names the SQL files relative to it."""
+    monkeypatch.chdir(FUNCTION_FOLDER)
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+import benchmark_suite
+import btyd_scoring
+import main
+import rfm_state
+import run_report
+
+RUN_DATE = '2026-10-19'
+
+
+@pytest.fixture(scope='module')
+def models():
+    fitter = btyd_scoring.BetaGeoModel(benchmark_suite.FITTER_PARAMS)
+    ggf = btyd_scoring.GammaGammaModel(benchmark_suite.GGF_PARAMS)
+    (t, time_months, clv_months) = main.prediction_periods(main.PREDICTION_LENGTH_IN_MONTHS, 'M',
+                                                           main.PREDICTION_HORIZONS_IN_MONTHS)
+    return (fitter, ggf, t, time_months, clv_months)
+
+
+def _score(state, models, run_date=RUN_DATE):
+    (fitter, ggf, t, time_months, clv_months) = models
+    return rfm_state.score_state(state, fitter, ggf, t, time_months, main.DISCOUNT_RATE, 'M', run_date, clv_months)
+
+
+def test_aged_state_scores_like_predict_value(models):
+    (fitter, ggf, t, time_months, clv_months) = models
+    state = benchmark_suite.synthetic_state(5000, 0)
+    end_day = rfm_state.period_start_day(RUN_DATE, 'M')
+    summary = pd.DataFrame(index=state.index)
+    summary['frequency'] = state['frequency'].astype(float)
+    summary['recency'] = (state['last_day'] - state['first_day']) / btyd_scoring.PERIOD_LENGTH_IN_DAYS['M']
+    summary['T'] = (end_day - state['first_day']) / btyd_scoring.PERIOD_LENGTH_IN_DAYS['M']
+    summary['monetary_value'] = state['monetary_value']
+
+    expected = main.predict_value(summary, state[['current_total_revenue']].copy(), fitter, ggf, t, time_months,
+                                  main.DISCOUNT_RATE, 'M', clv_months)
+    aged = _score(state, models)
+
+    pd.testing.assert_frame_equal(aged.set_index('userId').sort_index(),
+                                  expected.set_index('userId').sort_index()[aged.columns.drop('userId')],
+                                  check_exact=True)
+    assert not aged.isna().any().any()
+
+
+def test_only_changed_customers_are_written(models):
+    state = benchmark_suite.synthetic_state(5000, 0)
+    state['output_hash'] = rfm_state.output_hashes(_score(state, models), '2026-10-12')
+
+    buyers = state.iloc[:50].copy()
+    buyers['frequency'] += 1
+    buyers['last_day'] = rfm_state.period_start_day('2026-10-20', 'M')
+    buyers['current_total_revenue'] += buyers['monetary_value']
+    state = rfm_state.update_state(state, buyers.drop(columns='output_hash'))
+
+    # The next day in the same month only the buyers change
+    changed = rfm_state.output_hashes(_score(state, models, '2026-10-20'), '2026-10-12') \
+        != state['output_hash'].to_numpy()
+    assert set(state.index[changed]) == set(buyers.index)
+
+    # New models rewrite every customer, the weekly function replaced their predictions
+    changed = rfm_state.output_hashes(_score(state, models, '2026-10-20'), '2026-10-19') \
+        != state['output_hash'].to_numpy()
+    assert changed.all()
+
+
+def test_empty_customer_base_returns_without_exiting(tmp_path, monkeypatch):
+    transactions = pd.DataFrame({'userId': pd.Series(dtype=str),
+                                 'order_date': pd.Series(dtype='datetime64[ns]'),
+                                 'order_value': pd.Series(dtype=float)})
+    monkeypatch.setattr(main, 'load_rfm_state', lambda *args: None)
+    monkeypatch.setattr(main, 'newest_model_date', lambda *args: None)
+    monkeypatch.setattr(main, 'load_transactions_from_bq', lambda query: transactions)
+    report = run_report.RunReport('daily')
+
+    assert main.age_customer_base('daily', 'seed', 6, 'models', 'predictions', 'clv_model',
+                                  str(tmp_path) + '/', report=report) is None
+    assert report.report['errors'] == []
+    assert report.report['counts']['customers_in_state'] == 0
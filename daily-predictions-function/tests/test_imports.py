@@ -0,0 +1,23 @@
+import json
+import subprocess
+import sys
+
+MODULES_AFTER = 'import json, sys; {}; print(json.dumps(sorted(sys.modules)))'
+# Imported where they are used, only by runs that need them
+LAZY_MODULES = ['google.cloud.bigquery', 'google.cloud.storage', 'lifetimes', 'pyarrow.parquet', 'requests',
+                'rfm_state', 'zstandard']
+
+
+def imported_modules(statement):
+    """Modules in sys.modules after statement ran in a new interpreter in the function folder."""
+    process = subprocess.run([sys.executable, '-c', MODULES_AFTER.format(statement)],
+                             stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return set(json.loads(process.stdout))
+
+
+def test_main_imports_no_lazy_module():
+    modules = imported_modules('import main')
+
+    assert not modules & set(LAZY_MODULES)
+    # Some pandas versions import pyarrow themselves, main may not add it
+    assert 'pyarrow' not in modules or 'pyarrow' in imported_modules('import pandas')
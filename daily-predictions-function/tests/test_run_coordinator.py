@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+import pandas as pd
+import gcs_transfer
+import main
+
+
+def test_empty_load_is_recorded_as_an_empty_run_of_its_window(tmp_path, monkeypatch):
+    transactions = pd.DataFrame({'userId': pd.Series(dtype=str),
+                                 'order_date': pd.Series(dtype='datetime64[ns]'),
+                                 'order_value': pd.Series(dtype=float)})
+    customer_values = pd.DataFrame({'userId': pd.Series(dtype=str),
+                                    'current_total_revenue': pd.Series(dtype=float)})
+    loads = []
+    monkeypatch.setattr(main, 'load_data_from_bq',
+                        lambda *args: loads.append(args) or (transactions, customer_values))
+    monkeypatch.setattr(main, 'GCS_LOCAL_ROOT', str(tmp_path / 'buckets'))
+    monkeypatch.setattr(main, 'LOCAL_STORAGE_FOLDER', str(tmp_path) + '/')
+    monkeypatch.setattr(main, 'AGING_STATE_FILE', None)
+    now = pd.Timestamp.utcnow()
+
+    # Returns instead of raising, so the event is acknowledged
+    main.main({}, SimpleNamespace(event_id='e1', timestamp=now.isoformat()))
+
+    bucket = gcs_transfer.storage_client(main.GCS_LOCAL_ROOT).bucket(main.GCS_BUCKET_MODELS)
+    window = str(now.tz_localize(None).to_period(main.RUN_WINDOW))
+    window_marker = bucket.blob('{}daily/windows/{}.json'.format(main.RUN_COORDINATOR_PREFIX, window))
+    assert window_marker.exists()
+    assert main.run_coordinator.read_json(window_marker)[0]['status'] == 'empty'
+    # Another event of the same day is skipped
+    main.main({}, SimpleNamespace(event_id='e2', timestamp=now.isoformat()))
+    assert len(loads) == 1
@@ -0,0 +1,63 @@
+import re
+import numpy as np
+import pandas as pd
+import pytest
+import btyd_scoring
+import main
+import quantile_sketch
+
+
+@pytest.mark.parametrize('time_months', [None, [6], [1, 6, 24]])
+def test_update_query_has_a_column_for_each_horizon(time_months):
+    query = main.update_query(main.UPDATE_BIGQUERY_RESULT_TABLE, time_months)
+
+    if time_months is None:
+        time_months = set(main.PREDICTION_HORIZONS_IN_MONTHS) | {main.PREDICTION_LENGTH_IN_MONTHS}
+    assert set(int(months) for months in re.findall(r'predicted_value_next_(\d+)_month', query)) == set(time_months)
+    # New and existing predictions are read with the same columns
+    for months in time_months:
+        assert query.count('excisting_predictions.predicted_value_next_{}_month'.format(months)) == 1
+        assert query.count('predicted_value_next_{}_month'.format(months)) == 4
+    assert '$' not in query
+
+
+def test_update_query_computes_the_clv_thresholds_without_a_sketch():
+    sketched = main.update_query(main.UPDATE_BIGQUERY_RESULT_TABLE, None, {'p25': 1.0, 'p50': 2.0, 'p75': 3.0})
+    assert 'APPROX_QUANTILES(' not in sketched
+    assert 'SELECT @p25 AS p25, @p50 AS p50, @p75 AS p75' in sketched
+
+    query = main.update_query(main.UPDATE_BIGQUERY_RESULT_TABLE, None, None)
+    assert query.count('APPROX_QUANTILES(clv, 100)') == 1
+    assert 'percentiles[OFFSET(25)] AS p25' in query
+    assert not re.search(r'@p\d+ AS', query)
+    assert '$' not in query
+
+
+def test_daily_run_reads_the_clv_thresholds_from_the_saved_sketch_without_adding_to_it(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    user_ids = ['u{}'.format(user) for user in rng.integers(0, 200, 1000)]
+    transactions = pd.DataFrame({'userId': user_ids,
+                                 'order_date': pd.Timestamp('2026-10-19') - pd.to_timedelta(rng.integers(0, 900, 1000),
+                                                                                             unit='D'),
+                                 'order_value': rng.gamma(2.0, 20.0, 1000)})
+    customer_values = transactions.groupby('userId')['order_value'].sum().to_frame('current_total_revenue')
+    models = (btyd_scoring.BetaGeoModel({'r': 0.25, 'alpha': 4.0, 'a': 0.8, 'b': 2.5}),
+              btyd_scoring.GammaGammaModel({'p': 6.0, 'q': 4.0, 'v': 15.0}))
+    published = []
+    monkeypatch.setattr(main, 'GCS_LOCAL_ROOT', str(tmp_path / 'buckets'))
+    monkeypatch.setattr(main, 'load_data_from_bq', lambda *args: (transactions, customer_values))
+    monkeypatch.setattr(main, 'load_newest_models', lambda *args: models)
+    monkeypatch.setattr(main, 'publish_predictions', lambda *args: published.append(args[4]) or args[0])
+    local_storage_folder = str(tmp_path) + '/'
+    base_sketch = quantile_sketch.KLLSketch(100).update(np.arange(1000.0))
+    quantile_sketch.save_sketch(base_sketch, local_storage_folder + 'sketch.json')
+    main.upload_blob('models', local_storage_folder + 'sketch.json', 'sketch.json')
+
+    for _ in range(2):
+        report = main.run_btyd('daily', 'values', 6, 'models', 'predictions', 'clv_model', local_storage_folder,
+                               aging_state_file=None, segment_sketch_file='sketch.json', segment_sketch_k=100)
+        assert report['errors'] == []
+
+    # Every run uses the thresholds of the customer base, and the saved sketch is left as it was
+    assert published == [quantile_sketch.clv_thresholds(base_sketch)] * 2
+    assert len(main.load_clv_sketch('models', 'sketch.json', local_storage_folder)) == 1000